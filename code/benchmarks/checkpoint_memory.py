@@ -0,0 +1,95 @@
+"""
+Memory/time trade-off of activation checkpointing for the 3D segmentation backbones.
+
+For every checkpointing policy (none, encoder, decoder, all, and the stages selected for a few
+fractions of the unconstrained activation memory) the script reports the activation memory
+estimated from a saved-tensor profile, the measured peak memory (CUDA only) and the time of a
+forward/backward step.
+
+Usage (from `code/`):
+    python -m benchmarks.checkpoint_memory --model unet_3D --patch_size 112 112 80 --batch_size 4
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from networks.net_factory_3d import net_factory_3d
+from networks import checkpointing
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', type=str, choices=['unet_3D', 'vnet'], default='unet_3D', help='Model architecture')
+    parser.add_argument('--patch_size', type=int, nargs=3, default=[64, 64, 48], help='Input patch size')
+    parser.add_argument('--batch_size', type=int, default=2, help='Batch size')
+    parser.add_argument('--feature_scaler', type=int, default=2, help='Feature scaling factor of the projection head')
+    parser.add_argument('--budgets', type=float, nargs='+', default=[0.75, 0.5, 0.25], help='Budgets as fractions of the activation memory without checkpointing')
+    parser.add_argument('--iters', type=int, default=3, help='Timed iterations per policy')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help='Device')
+    parser.add_argument('--json', type=str, default=None, help='Write the results to this file')
+    return parser.parse_args()
+
+
+def time_step(model, x, iters, device):
+    def step():
+        model.zero_grad(set_to_none=True)
+        _, logits, features = model(x)
+        (logits.float().square().mean() + features.float().mean()).backward()
+
+    step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    seconds = (time.perf_counter() - start) / iters
+    peak = torch.cuda.max_memory_allocated(device) if device.type == 'cuda' else None
+    return seconds, peak
+
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device)
+    input_shape = (args.batch_size, 1) + tuple(args.patch_size)
+    model = net_factory_3d(net_type=args.model, in_chns=1, class_num=2, scaler=args.feature_scaler).to(device)
+    model.train()
+
+    profile = checkpointing.profile_stages(model, input_shape, device)
+    total = checkpointing.activation_bytes(profile)
+    policies = [(policy, checkpointing.parse_stages(policy, model.CHECKPOINT_GROUPS)) for policy in ['', 'encoder', 'decoder', 'all']]
+    policies[0] = ('none', set())
+    for fraction in args.budgets:
+        stages, _ = checkpointing.select_stages(profile, fraction * total)
+        policies.append(('budget {:.0%}'.format(fraction), stages))
+
+    x = torch.randn(input_shape, device=device)
+    results = []
+    for policy, stages in policies:
+        model.checkpoint_stages = stages
+        seconds, peak = time_step(model, x, args.iters, device)
+        results.append({'policy': policy, 'stages': sorted(stages), 'activation_mb': checkpointing.activation_bytes(profile, stages) / 2**20,
+                        'peak_mb': peak / 2**20 if peak is not None else None, 'seconds': seconds})
+
+    base = results[0]['seconds']
+    print("{:<12} {:>9} {:>14} {:>10} {:>10} {:>9}".format('policy', '#stages', 'activations MB', 'peak MB', 'step s', 'overhead'))
+    for r in results:
+        r['overhead'] = r['seconds'] / base - 1
+        print("{:<12} {:>9d} {:>14.1f} {:>10} {:>10.3f} {:>8.1%}".format(
+            r['policy'], len(r['stages']), r['activation_mb'], '-' if r['peak_mb'] is None else '{:.1f}'.format(r['peak_mb']),
+            r['seconds'], r['overhead']))
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'config': vars(args), 'profile': profile, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
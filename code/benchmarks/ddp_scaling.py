@@ -0,0 +1,141 @@
+"""
+Throughput scaling of a DyCON training step with DistributedDataParallel (gloo).
+
+Spawns 1..N worker processes on the local machine, each running the student/teacher step of
+`train_DyCON_*.py` (CE + Dice + FeCL + UnCL + consistency, SGD, EMA update) on synthetic
+volumes, and reports the aggregate samples/s and the parallel efficiency against one process.
+The CPU threads are split evenly between the ranks so every run uses the same cores.
+
+Usage (from `code/`):
+    python -m benchmarks.ddp_scaling --max_procs 4 --patch_size 64 64 48 --json ddp_scaling.json
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+
+import torch
+import torch.multiprocessing as mp
+import torch.distributed as dist
+from torch.nn import functional as F
+from torch.nn.parallel import DistributedDataParallel as DDP
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from networks.net_factory_3d import net_factory_3d
+from utils import dycon_losses, util
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--max_procs', type=int, default=os.cpu_count(), help='Largest number of processes to benchmark')
+    parser.add_argument('--world_sizes', type=int, nargs='+', default=None, help='Explicit list of process counts (overrides --max_procs)')
+    parser.add_argument('--patch_size', type=int, nargs=3, default=[64, 64, 48], help='Synthetic patch size')
+    parser.add_argument('--batch_size', type=int, default=2, help='Batch size per process')
+    parser.add_argument('--labeled_bs', type=int, default=1, help='Labeled batch size per process')
+    parser.add_argument('--model', type=str, choices=['unet_3D', 'vnet'], default='unet_3D', help='Model architecture')
+    parser.add_argument('--feature_scaler', type=int, default=2, help='Feature scaling factor for contrastive loss')
+    parser.add_argument('--warmup', type=int, default=2, help='Untimed iterations per run')
+    parser.add_argument('--iters', type=int, default=5, help='Timed iterations per run')
+    parser.add_argument('--backend', type=str, default='gloo', help='torch.distributed backend')
+    parser.add_argument('--json', type=str, default=None, help='Write the results to this file')
+    return parser.parse_args()
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def _worker(rank, world_size, args, port, result_queue):
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    util.distributed_setup(rank, world_size, backend=args.backend, master_addr='localhost', master_port=port)
+    torch.manual_seed(1337 + rank)
+    device = torch.device('cpu')
+
+    model = net_factory_3d(net_type=args.model, in_chns=1, class_num=2, scaler=args.feature_scaler).to(device)
+    ema_model = net_factory_3d(net_type=args.model, in_chns=1, class_num=2, scaler=args.feature_scaler).to(device)
+    for param in ema_model.parameters():
+        param.detach_()
+    util.broadcast_module(model)
+    util.broadcast_module(ema_model)
+    net = model
+    model = DDP(model, find_unused_parameters=True)
+
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01, momentum=0.9, weight_decay=0.0001)
+    objective = dycon_losses.DyCONObjective(labeled_bs=args.labeled_bs)
+    fecl_criterion = dycon_losses.FeCLoss(device=device, temperature=0.6, gamma=2.0, use_focal=True, rampup_epochs=1500)
+
+    B, lbs = args.batch_size, args.labeled_bs
+    volume_batch = torch.randn(B, 1, *args.patch_size, device=device)
+    label_batch = (volume_batch[:, 0] > 0.5).long()
+
+    def step():
+        _, stud_logits, stud_features = model(volume_batch)
+        with torch.no_grad():
+            _, ema_logits, ema_features = ema_model(volume_batch + torch.clamp(torch.randn_like(volume_batch) * 0.1, -0.2, 0.2))
+        terms = objective(stud_logits, ema_logits, label_batch, 2.0)
+
+        C = stud_features.shape[1]
+        stud_embedding = F.normalize(stud_features.view(B, C, -1).transpose(1, 2), dim=-1)
+        ema_embedding = F.normalize(ema_features.view(B, C, -1).transpose(1, 2), dim=-1)
+        mask_con = F.interpolate(label_batch.unsqueeze(1).float(), scale_factor=1 / (args.feature_scaler * 4), mode='trilinear', align_corners=False)
+        mask_con = (mask_con > 0.5).float().reshape(B, -1).unsqueeze(1)
+
+        f_loss = fecl_criterion(feat=stud_embedding[lbs:], mask=mask_con[lbs:], teacher_feat=ema_embedding[lbs:], epoch=0)
+        loss = terms['loss_ce'] + terms['loss_dice'] + 0.1 * terms['consistency_loss'] + 0.5 * (f_loss + terms['u_loss'])
+
+        optimizer.zero_grad()
+        loss.backward()
+        torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
+        optimizer.step()
+        with torch.no_grad():
+            for ema_param, param in zip(ema_model.parameters(), net.parameters()):
+                ema_param.mul_(0.99).add_(param, alpha=0.01)
+        util.average_buffers(ema_model)
+
+    for _ in range(args.warmup):
+        step()
+    dist.barrier()
+    start = time.perf_counter()
+    for _ in range(args.iters):
+        step()
+    dist.barrier()
+    elapsed = time.perf_counter() - start
+
+    if rank == 0:
+        result_queue.put(elapsed)
+    util.distributed_cleanup()
+
+
+def run(world_size, args):
+    ctx = mp.get_context('spawn')
+    result_queue = ctx.SimpleQueue()
+    mp.spawn(_worker, args=(world_size, args, _free_port(), result_queue), nprocs=world_size, join=True)
+    elapsed = result_queue.get()
+    samples = args.iters * args.batch_size * world_size
+    return {'world_size': world_size, 'seconds': elapsed, 'samples_per_s': samples / elapsed}
+
+
+def main():
+    args = parse_args()
+    world_sizes = args.world_sizes or list(range(1, max(1, args.max_procs) + 1))
+
+    results = []
+    for world_size in world_sizes:
+        result = run(world_size, args)
+        base = results[0] if results else result
+        result['speedup'] = result['samples_per_s'] / base['samples_per_s']
+        result['efficiency'] = result['speedup'] * base['world_size'] / world_size
+        results.append(result)
+        print("procs {world_size:3d} | {samples_per_s:8.3f} samples/s | speedup {speedup:5.2f}x | efficiency {efficiency:6.1%}".format(**result), flush=True)
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'config': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Wall time of `test_3d_patch.evaluate_all_cases` with an `EvaluationCache`.
+
+The script writes `--cases` synthetic h5 cases (as `benchmarks.evaluation`), fits the model on the
+first one and evaluates it four times against one cache database:
+  - `cold`: an empty cache, every case runs the inference and the metrics;
+  - `warm`: the same settings again, every metric is read back;
+  - `nms`: `nms` toggled, the predictions are reused and only the metrics are computed;
+  - `partial`: a fresh cache holding the predictions of the first half of the cases, as left by an
+    interrupted run.
+It reports the time of every run and whether its metrics equal those of an uncached evaluation
+with the same settings, and the size of the database.
+
+Usage (from `code/`):
+    python -m benchmarks.eval_cache --cases 8
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from networks.net_factory_3d import net_factory_3d
+from utils import test_3d_patch
+from utils.eval_cache import EvaluationCache
+from benchmarks.evaluation import write_cases, fit
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', type=str, choices=['unet_3D', 'vnet'], default='unet_3D', help='Model architecture')
+    parser.add_argument('--cases', type=int, default=6, help='Number of synthetic cases')
+    parser.add_argument('--volume', type=int, nargs=3, default=[96, 96, 64], help='Synthetic volume shape')
+    parser.add_argument('--patch_size', type=int, nargs=3, default=[64, 64, 64], help='Window shape')
+    parser.add_argument('--stride', type=int, nargs=2, default=[32, 32], help='Strides xy, z')
+    parser.add_argument('--batch_size', type=int, default=4, help='Windows per forward')
+    parser.add_argument('--fit_steps', type=int, default=30, help='Fit the model on the first case for this many steps')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help='Device')
+    parser.add_argument('--json', type=str, default=None, help='Write the results to this file')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    model = net_factory_3d(net_type=args.model, in_chns=1, class_num=2).to(device)
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        paths = write_cases(directory, args.cases, tuple(args.volume), np.random.default_rng(0))
+        if args.fit_steps:
+            fit(model, paths[0], args.fit_steps, device)
+        model.eval()
+
+        def evaluate(paths, nms, cache):
+            start = time.perf_counter()
+            metrics = test_3d_patch.evaluate_all_cases(model, paths, 2, args.patch_size, args.stride[0], args.stride[1],
+                                                       nms=nms, batch_size=args.batch_size, workers=0, cache=cache)
+            return metrics, time.perf_counter() - start
+
+        reference = {nms: evaluate(paths, nms, None)[0] for nms in (0, 1)}
+        database = os.path.join(directory, 'eval_cache.sqlite')
+        partial = os.path.join(directory, 'partial.sqlite')
+        evaluate(paths[:len(paths) // 2], 0, partial)
+        runs = [('cold', 0, database), ('warm', 0, database), ('nms', 1, database), ('partial', 0, partial)]
+        print("{:<10} {:>9} {:>10} {:>10}".format('run', 'seconds', 'Dice', 'same'))
+        for name, nms, path in runs:
+            with EvaluationCache(path) as cache:
+                metrics, seconds = evaluate(paths, nms, cache)
+            results.append({'run': name, 'nms': nms, 'seconds': seconds, 'metrics': metrics.tolist(),
+                            'same': bool(np.array_equal(metrics, reference[nms]))})
+            print("{:<10} {:>9.2f} {:>10.4f} {:>10}".format(name, seconds, metrics[:, 0].mean(), str(results[-1]['same'])))
+        size = os.path.getsize(database)
+        print("database: {:.1f} kB for {} cases".format(size / 2**10, args.cases))
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'config': vars(args), 'database_bytes': size, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Wall time of the evaluation driver `test_3d_patch.evaluate_all_cases` against its reader threads and
+metric processes.
+
+The script writes `--cases` synthetic h5 cases (a bright ellipsoid on a noisy background, of
+`--volume` shape) to a temporary directory, evaluates a model on them with every combination of
+`--readers` and `--workers` and reports the time of the run and whether the per-case metrics equal
+those of the first (serial) setting. The model is fitted for `--fit_steps` steps on the first case so
+that the predictions, and with them the HD95/ASD computations, are not degenerate.
+
+Usage (from `code/`):
+    python -m benchmarks.evaluation --cases 8 --readers 0 2 --workers 0 2 4
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+
+import h5py
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from networks.net_factory_3d import net_factory_3d
+from utils import test_3d_patch
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', type=str, choices=['unet_3D', 'vnet'], default='unet_3D', help='Model architecture')
+    parser.add_argument('--cases', type=int, default=6, help='Number of synthetic cases')
+    parser.add_argument('--volume', type=int, nargs=3, default=[96, 96, 64], help='Synthetic volume shape')
+    parser.add_argument('--patch_size', type=int, nargs=3, default=[64, 64, 64], help='Window shape')
+    parser.add_argument('--stride', type=int, nargs=2, default=[32, 32], help='Strides xy, z')
+    parser.add_argument('--batch_size', type=int, default=4, help='Windows per forward')
+    parser.add_argument('--fit_steps', type=int, default=30, help='Fit the model on the first case for this many steps')
+    parser.add_argument('--readers', type=int, nargs='+', default=[0, 2], help='Reader threads')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2], help='Metric processes')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help='Device')
+    parser.add_argument('--json', type=str, default=None, help='Write the results to this file')
+    return parser.parse_args()
+
+
+def write_cases(directory, count, shape, generator):
+    paths = []
+    grid = np.stack(np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing='ij'))
+    for i in range(count):
+        center = generator.uniform(-0.3, 0.3, size=3).reshape(3, 1, 1, 1)
+        label = (np.square((grid - center) / 0.4).sum(0) < 1).astype(np.uint8)
+        image = (label + 0.5 * generator.standard_normal(shape)).astype(np.float32)
+        paths.append(os.path.join(directory, 'case{:03d}.h5'.format(i)))
+        with h5py.File(paths[-1], 'w') as h5f:
+            h5f['image'], h5f['label'] = image, label
+    return paths
+
+
+def fit(model, path, steps, device):
+    image, label = test_3d_patch.read_case(path)
+    volume = torch.from_numpy(image)[None, None].to(device)
+    target = torch.from_numpy(label.astype(np.int64))[None].to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    model.train()
+    for _ in range(steps):
+        _, logits, _ = model(volume)
+        loss = F.cross_entropy(logits, target)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    model.eval()
+
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    model = net_factory_3d(net_type=args.model, in_chns=1, class_num=2).to(device)
+    results, reference = [], None
+    with tempfile.TemporaryDirectory() as directory:
+        paths = write_cases(directory, args.cases, tuple(args.volume), np.random.default_rng(0))
+        if args.fit_steps:
+            fit(model, paths[0], args.fit_steps, device)
+        model.eval()
+        print("{:>8} {:>8} {:>9} {:>10} {:>10}".format('readers', 'workers', 'seconds', 'Dice', 'same'))
+        for readers in args.readers:
+            for workers in args.workers:
+                start = time.perf_counter()
+                metrics = test_3d_patch.evaluate_all_cases(model, paths, 2, args.patch_size, args.stride[0], args.stride[1],
+                                                           batch_size=args.batch_size, readers=readers, workers=workers)
+                seconds = time.perf_counter() - start
+                if reference is None:
+                    reference = metrics
+                results.append({'readers': readers, 'workers': workers, 'seconds': seconds,
+                                'metrics': metrics.tolist(), 'same': bool(np.array_equal(metrics, reference))})
+                print("{:>8d} {:>8d} {:>9.2f} {:>10.4f} {:>10}".format(readers, workers, seconds, metrics[:, 0].mean(),
+                                                                      str(results[-1]['same'])))
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'config': vars(args), 'cpus': os.cpu_count(), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Anchor-subsampled FeCLoss against the exact loss.
+
+On synthetic foreground/background patch embeddings (B, N, D) the script reports, for every
+(num_anchors, hard_negatives) setting and a few epochs of the threshold schedule:
+  - the time of a forward/backward pass,
+  - the cosine between the sampled and the exact gradient (mean over `--draws` anchor draws),
+and, for convergence, the exact loss reached after `--steps` SGD steps on a linear projection
+of the embeddings trained with each loss.
+
+Usage (from `code/`):
+    python -m benchmarks.fecl_sampling --num_patches 1960 --anchors 128 512 --hard_negatives 0 256
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import dycon_losses
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch_size', type=int, default=4, help='Unlabeled volumes per step')
+    parser.add_argument('--num_patches', type=int, default=1960, help='Patches per volume (N)')
+    parser.add_argument('--dim', type=int, default=256, help='Embedding dimension')
+    parser.add_argument('--fg_ratio', type=float, default=0.1, help='Fraction of foreground patches')
+    parser.add_argument('--anchors', type=int, nargs='+', default=[128, 512], help='Anchors per volume (A)')
+    parser.add_argument('--hard_negatives', type=int, nargs='+', default=[0, 256], help='Hard negatives per anchor (0: all negatives)')
+    parser.add_argument('--epochs', type=int, nargs='+', default=[0, 750, 1500], help='Epochs of the threshold schedule')
+    parser.add_argument('--rampup_epochs', type=int, default=1500, help='FeCLoss rampup_epochs, as in the trainers')
+    parser.add_argument('--draws', type=int, default=5, help='Anchor draws averaged for the gradient cosine')
+    parser.add_argument('--steps', type=int, default=50, help='SGD steps of the convergence run (0 to skip)')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help='Device')
+    parser.add_argument('--json', type=str, default=None, help='Write the results to this file')
+    return parser.parse_args()
+
+
+def synthetic_batch(args, device, generator):
+    mask = (torch.rand(args.batch_size, 1, args.num_patches, generator=generator) < args.fg_ratio).float()
+    centers = torch.randn(2, args.dim, generator=generator)
+    raw = centers[mask.long().squeeze(1)] + 2.0 * torch.randn(args.batch_size, args.num_patches, args.dim, generator=generator)
+    return raw.to(device), mask.to(device)
+
+
+def make_loss(device, epoch_rampup, num_anchors=None, hard_negatives=None):
+    return dycon_losses.FeCLoss(device=device, temperature=0.6, gamma=2.0, use_focal=True, rampup_epochs=epoch_rampup,
+                                num_anchors=num_anchors, hard_negatives=hard_negatives)
+
+
+def loss_and_grad(criterion, raw, mask, epoch):
+    feat = F.normalize(raw, dim=-1).requires_grad_()
+    loss = criterion(feat=feat, mask=mask, epoch=epoch)
+    loss.backward()
+    return loss.item(), feat.grad.flatten()
+
+
+def timed(fn, device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    out = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return out, time.perf_counter() - start
+
+
+def converge(criterion, raw, mask, exact, steps, epoch):
+    """Train a linear projection of the embeddings with `criterion`, return the final exact loss."""
+    torch.manual_seed(0)
+    projection = torch.nn.Linear(raw.shape[-1], raw.shape[-1]).to(raw.device)
+    optimizer = torch.optim.SGD(projection.parameters(), lr=0.1, momentum=0.9)
+    for _ in range(steps):
+        optimizer.zero_grad()
+        criterion(feat=F.normalize(projection(raw), dim=-1), mask=mask, epoch=epoch).backward()
+        optimizer.step()
+    with torch.no_grad():
+        return exact(feat=F.normalize(projection(raw), dim=-1), mask=mask, epoch=epoch).item()
+
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device)
+    raw, mask = synthetic_batch(args, device, torch.Generator().manual_seed(0))
+    exact = make_loss(device, args.rampup_epochs)
+
+    settings = [(a, k or None) for a in args.anchors for k in args.hard_negatives]
+    results = []
+    print("{:>6} {:>6} {:>6} {:>10} {:>10} {:>9} {:>12}".format('epoch', 'A', 'k', 'loss', 'step s', 'grad cos', 'conv. loss'))
+    for epoch in args.epochs:
+        (exact_loss, exact_grad), exact_seconds = timed(lambda: loss_and_grad(exact, raw, mask, epoch), device)
+        exact_conv = converge(exact, raw, mask, exact, args.steps, epoch) if args.steps else None
+        rows = [{'epoch': epoch, 'anchors': None, 'hard_negatives': None, 'loss': exact_loss,
+                 'seconds': exact_seconds, 'grad_cos': 1.0, 'converged_loss': exact_conv}]
+        for num_anchors, hard_negatives in settings:
+            sampled = make_loss(device, args.rampup_epochs, num_anchors, hard_negatives)
+            losses, grads, seconds = [], [], 0.0
+            for _ in range(args.draws):
+                (loss, grad), elapsed = timed(lambda: loss_and_grad(sampled, raw, mask, epoch), device)
+                losses.append(loss)
+                grads.append(grad)
+                seconds += elapsed / args.draws
+            grad_cos = F.cosine_similarity(torch.stack(grads).mean(0), exact_grad, dim=0).item()
+            conv = converge(sampled, raw, mask, exact, args.steps, epoch) if args.steps else None
+            rows.append({'epoch': epoch, 'anchors': num_anchors, 'hard_negatives': hard_negatives, 'loss': sum(losses) / len(losses),
+                         'seconds': seconds, 'grad_cos': grad_cos, 'converged_loss': conv})
+        for r in rows:
+            print("{:>6} {:>6} {:>6} {:>10.4f} {:>10.4f} {:>9.3f} {:>12}".format(
+                r['epoch'], r['anchors'] or 'all', r['hard_negatives'] or 'all', r['loss'], r['seconds'], r['grad_cos'],
+                '-' if r['converged_loss'] is None else '{:.4f}'.format(r['converged_loss'])))
+        results.extend(rows)
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'config': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
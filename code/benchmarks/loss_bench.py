@@ -0,0 +1,189 @@
+"""
+Micro-benchmark of the DyCON losses with a JSON baseline for regression checks.
+
+Sweeps FeCLoss over the batch size B, the number of patches N, the embedding dimension D, the
+dtype, focal weighting and the teacher cross-negative term, and UnCLoss over the logit shape and
+dtype (optionally also the fused implementation). For every case it reports the median forward
+and backward time and the peak memory of a forward/backward pass above the inputs:
+`torch.cuda.max_memory_allocated` on CUDA, and on CPU the running total of the allocator events
+of a memory profile (`torch.profiler` with `profile_memory=True`).
+
+`--save` writes the results as a baseline; `--baseline` compares a run against one and exits with
+status 1 if a case got slower (or needs more memory) than the baseline by more than the tolerance.
+
+Usage (from `code/`):
+    python -m benchmarks.loss_bench --save loss_baseline.json
+    python -m benchmarks.loss_bench --baseline loss_baseline.json --time_tolerance 0.25
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import statistics
+
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import dycon_losses
+
+DTYPES = {'float32': torch.float32, 'float64': torch.float64, 'float16': torch.float16, 'bfloat16': torch.bfloat16}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fecl_batch', type=int, nargs='+', default=[4], help='FeCLoss batch sizes B')
+    parser.add_argument('--fecl_patches', type=int, nargs='+', default=[512, 1960], help='FeCLoss patches per volume N')
+    parser.add_argument('--fecl_dim', type=int, nargs='+', default=[64, 256], help='FeCLoss embedding dimensions D')
+    parser.add_argument('--focal', type=int, nargs='+', default=[0, 1], help='FeCLoss focal weighting (1 for True, 0 for False)')
+    parser.add_argument('--teacher', type=int, nargs='+', default=[0, 1], help='FeCLoss teacher cross-negative term (1 for True, 0 for False)')
+    parser.add_argument('--uncl_shapes', type=str, nargs='+', default=['4,2,64,64,64', '8,2,96,96,96'], help='UnCLoss logit shapes B,C,H,W,D')
+    parser.add_argument('--uncl_fused', type=int, nargs='+', default=[0], help='UnCLoss implementations (0: autograd, 1: fused)')
+    parser.add_argument('--dtypes', type=str, nargs='+', default=['float32'], choices=sorted(DTYPES), help='Input dtypes')
+    parser.add_argument('--iters', type=int, default=5, help='Timed iterations per case (the median is kept)')
+    parser.add_argument('--warmup', type=int, default=1, help='Untimed iterations per case')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help='Device')
+    parser.add_argument('--save', type=str, default=None, help='Write the results to this JSON file (a new baseline)')
+    parser.add_argument('--baseline', type=str, default=None, help='Compare against the results of this JSON file')
+    parser.add_argument('--time_tolerance', type=float, default=0.2, help='Allowed relative slowdown against the baseline')
+    parser.add_argument('--memory_tolerance', type=float, default=0.05, help='Allowed relative peak memory increase against the baseline')
+    return parser.parse_args()
+
+
+def fecl_cases(args):
+    for B, N, D, dtype, focal, teacher in itertools.product(args.fecl_batch, args.fecl_patches, args.fecl_dim,
+                                                            args.dtypes, args.focal, args.teacher):
+        yield 'fecl', {'B': B, 'N': N, 'D': D, 'dtype': dtype, 'focal': bool(focal), 'teacher': bool(teacher)}
+
+
+def uncl_cases(args):
+    for shape, dtype, fused in itertools.product(args.uncl_shapes, args.dtypes, args.uncl_fused):
+        yield 'uncl', {'shape': [int(v) for v in shape.split(',')], 'dtype': dtype, 'fused': bool(fused)}
+
+
+def case_key(loss, config):
+    return loss + ' ' + ' '.join('{}={}'.format(k, 'x'.join(str(v) for v in config[k]) if isinstance(config[k], list) else config[k])
+                                 for k in sorted(config))
+
+
+def make_case(loss, config, device):
+    """Inputs and a closure returning the loss of one forward pass, with the tensor to differentiate."""
+    generator = torch.Generator(device=device).manual_seed(0)
+    dtype = DTYPES[config['dtype']]
+    if loss == 'fecl':
+        B, N, D = config['B'], config['N'], config['D']
+        feat = F.normalize(torch.randn(B, N, D, generator=generator, device=device), dim=-1).to(dtype).requires_grad_()
+        mask = (torch.rand(B, 1, N, generator=generator, device=device) < 0.3).to(dtype)
+        teacher = F.normalize(torch.randn(B, N, D, generator=generator, device=device), dim=-1).to(dtype) if config['teacher'] else None
+        criterion = dycon_losses.FeCLoss(device=device, use_focal=config['focal'], lambda_cross=float(config['teacher']))
+        return feat, lambda: criterion(feat=feat, mask=mask, teacher_feat=teacher, epoch=0)
+    shape = config['shape']
+    s_logits = (3 * torch.randn(shape, generator=generator, device=device)).to(dtype).requires_grad_()
+    t_logits = (3 * torch.randn(shape, generator=generator, device=device)).to(dtype)
+    criterion = dycon_losses.UnCLoss(fused=config['fused'])
+    return s_logits, lambda: criterion(s_logits, t_logits, 2.0)
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def time_case(x, forward, iters, warmup, device):
+    forward_times, backward_times = [], []
+    for i in range(warmup + iters):
+        x.grad = None
+        synchronize(device)
+        start = time.perf_counter()
+        loss = forward()
+        synchronize(device)
+        middle = time.perf_counter()
+        loss.backward()
+        synchronize(device)
+        if i >= warmup:
+            forward_times.append(middle - start)
+            backward_times.append(time.perf_counter() - middle)
+    return statistics.median(forward_times), statistics.median(backward_times)
+
+
+def peak_memory(x, forward, device):
+    """Peak bytes allocated during one forward/backward pass, above what was allocated before it."""
+    x.grad = None
+    if device.type == 'cuda':
+        synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+        forward().backward()
+        synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - base
+
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        forward().backward()
+    events = [e for e in prof.profiler.kineto_results.events() if e.name() == '[memory]']
+    current = peak = 0
+    for event in sorted(events, key=lambda e: e.start_ns()):
+        current += event.nbytes()
+        peak = max(peak, current)
+    return peak
+
+
+def compare(results, baseline, time_tolerance, memory_tolerance):
+    """Relative change of every case present in the baseline, and the keys of the regressions."""
+    reference = {r['key']: r for r in baseline['results']}
+    regressions = []
+    for r in results:
+        ref = reference.get(r['key'])
+        if ref is None:
+            continue
+        r['time_change'] = (r['forward_ms'] + r['backward_ms']) / (ref['forward_ms'] + ref['backward_ms']) - 1
+        r['memory_change'] = r['peak_mb'] / ref['peak_mb'] - 1 if ref['peak_mb'] else 0.0
+        if r['time_change'] > time_tolerance or r['memory_change'] > memory_tolerance:
+            regressions.append(r['key'])
+    return regressions
+
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device)
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = []
+    print("{:<60} {:>10} {:>10} {:>9}".format('case', 'fwd ms', 'bwd ms', 'peak MB'))
+    for loss, config in itertools.chain(fecl_cases(args), uncl_cases(args)):
+        x, forward = make_case(loss, config, device)
+        forward_s, backward_s = time_case(x, forward, args.iters, args.warmup, device)
+        peak = peak_memory(x, forward, device)
+        results.append({'key': case_key(loss, config), 'loss': loss, 'config': config, 'forward_ms': 1e3 * forward_s,
+                        'backward_ms': 1e3 * backward_s, 'peak_mb': peak / 2**20})
+        r = results[-1]
+        print("{:<60} {:>10.2f} {:>10.2f} {:>9.1f}".format(r['key'], r['forward_ms'], r['backward_ms'], r['peak_mb']))
+        del x, forward
+
+    status = 0
+    if baseline is not None:
+        if baseline['config']['device'] != args.device:
+            print("warning: the baseline was measured on {}".format(baseline['config']['device']))
+        regressions = compare(results, baseline, args.time_tolerance, args.memory_tolerance)
+        print("\n{:<60} {:>10} {:>10}".format('against ' + args.baseline, 'time', 'memory'))
+        for r in results:
+            if 'time_change' in r:
+                print("{:<60} {:>+9.1%} {:>+9.1%}{}".format(r['key'], r['time_change'], r['memory_change'],
+                                                            '  REGRESSION' if r['key'] in regressions else ''))
+        missing = len(results) - sum('time_change' in r for r in results)
+        if missing:
+            print("{} case(s) not in the baseline".format(missing))
+        status = 1 if regressions else 0
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump({'config': vars(args), 'torch': torch.__version__, 'results': results}, f, indent=2)
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    main()
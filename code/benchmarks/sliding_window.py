@@ -0,0 +1,244 @@
+"""
+Time and accuracy of the sliding-window evaluator `test_3d_patch.test_single_case` across its options.
+
+The script predicts one case for
+  - every window batch size (`--batch_sizes`) at the first stride with uniform blending, and
+  - every stride (`--strides`, "xy,z") with every blending (`--blends`: uniform, gaussian), and
+  - every set of mirrored axes (`--tta`, e.g. "0,1,2") at the first stride, with the flips of the
+    windows stacked into one forward and, for comparison, with one forward per flip, and
+  - every region-of-interest mode (`--roi`: intensity, coarse) at the first stride, which only
+    evaluates the windows intersecting the ROI, and
+  - every streaming dtype (`--stream`: float16, uint8) at the first stride, which writes the score
+    map slab by slab to a temporary memory map,
+and reports the windows of the grid and how many were skipped, the time per case and the speedup
+against the first setting (the reference: batch 1, first stride, uniform), the largest difference
+of the score map against the reference, the Dice of the label map against the reference and, when
+a ground truth is available, against the ground truth. With `--profile_memory` every setting is run
+once more to report the peak of the tensor memory it allocates (`torch.cuda.max_memory_allocated`
+on CUDA, the allocator events of a memory profile on CPU).
+
+With `--stream` the slabs of `SlidingWindowPredictor.stream` are also checked against `__call__` for
+a two-class softmax output (whose background channel is 1) and an ROI that skips the leading and
+trailing rows of windows: every voxel must be yielded once, with the value of `__call__`.
+
+The windows are accumulated in the same order whatever the batch size, so batched and unbatched
+score maps only differ by the rounding of the convolution kernels for another batch size.
+
+The case is a synthetic volume (bright ellipsoids on a noisy background, the ellipsoids being the
+ground truth, `--lesion_scale` shrinks them towards small targets such as the pancreas; with
+`--zero_background` the noise is confined to a "body" ellipsoid as in BraTS) or an h5 case (`--case`, with `image`/`label` datasets; `--transpose` for the BraTS19
+layout). The model is randomly initialised, loaded from `--checkpoint`, or fitted on random crops of
+the case for `--fit_steps` steps, so that the accuracy columns mean something without a checkpoint.
+
+Usage (from `code/`):
+    python -m benchmarks.sliding_window --volume 160 160 128 --patch_size 96 96 96 --batch_sizes 1 4 8
+    python -m benchmarks.sliding_window --fit_steps 300 --strides 16,16 32,32 48,48 --blends uniform gaussian
+    python -m benchmarks.sliding_window --fit_steps 300 --strides 32,32 --tta 2 0,1,2
+    python -m benchmarks.sliding_window --fit_steps 300 --zero_background 1 --roi intensity coarse
+    python -m benchmarks.sliding_window --volume 256 256 192 --stream float16 uint8 --profile_memory 1
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+import h5py
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from networks.net_factory_3d import net_factory_3d
+from utils import test_3d_patch
+from utils.sliding_window import SlidingWindowPredictor
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', type=str, choices=['unet_3D', 'vnet'], default='unet_3D', help='Model architecture')
+    parser.add_argument('--feature_scaler', type=int, default=4, help='Feature scaling factor of the projection head')
+    parser.add_argument('--checkpoint', type=str, default=None, help='Model weights (default: random initialisation)')
+    parser.add_argument('--case', type=str, default=None, help='h5 case with image/label (default: synthetic volume)')
+    parser.add_argument('--transpose', type=int, default=0, help='Transpose the h5 arrays (2, 1, 0) as for BraTS19 (1 for True, 0 for False)')
+    parser.add_argument('--volume', type=int, nargs=3, default=[128, 128, 96], help='Synthetic volume shape')
+    parser.add_argument('--lesion_scale', type=float, default=1.0, help='Scale of the ellipsoids of the synthetic volume')
+    parser.add_argument('--zero_background', type=int, default=0, help='Zero the synthetic volume outside a body ellipsoid (1 for True, 0 for False)')
+    parser.add_argument('--patch_size', type=int, nargs=3, default=[64, 64, 64], help='Window shape')
+    parser.add_argument('--fit_steps', type=int, default=0, help='Fit the model on random crops of the case for this many steps')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4], help='Windows per forward')
+    parser.add_argument('--memory_budget', type=float, default=None, help='Also run with this activation budget (MB)')
+    parser.add_argument('--strides', type=str, nargs='+', default=['16,16'], help='Strides "xy,z" (the first one is the reference)')
+    parser.add_argument('--blends', type=str, nargs='+', default=['uniform'], choices=['uniform', 'gaussian'], help='Window blending')
+    parser.add_argument('--tta', type=str, nargs='*', default=[], help='Mirrored axes "a,b,..." for test-time augmentation')
+    parser.add_argument('--roi', type=str, nargs='*', default=[], choices=['intensity', 'coarse'], help='Region-of-interest modes')
+    parser.add_argument('--roi_scale', type=int, default=2, help='Downsampling of the coarse ROI pass')
+    parser.add_argument('--roi_threshold', type=float, default=0.1, help='Foreground threshold of the coarse ROI pass')
+    parser.add_argument('--roi_margin', type=int, default=8, help='Margin grown around the ROI (voxels)')
+    parser.add_argument('--stream', type=str, nargs='*', default=[], choices=['float16', 'uint8'], help='Streaming score map dtypes')
+    parser.add_argument('--profile_memory', type=int, default=0, help='Report the peak tensor memory of every setting (1 for True, 0 for False)')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help='Device')
+    parser.add_argument('--json', type=str, default=None, help='Write the results to this file')
+    return parser.parse_args()
+
+
+def synthetic_case(shape, generator, zero_background=False, lesion_scale=1.0):
+    """Two bright ellipsoids on a noisy background (zero outside a body ellipsoid), and their mask."""
+    grid = np.stack(np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing='ij'))
+    label = np.zeros(shape, dtype=np.uint8)
+    for center, radii in (((-0.3, -0.2, 0.0), (0.4, 0.3, 0.3)), ((0.45, 0.4, 0.2), (0.25, 0.2, 0.35))):
+        offset = (grid - np.array(center).reshape(3, 1, 1, 1)) / (lesion_scale * np.array(radii).reshape(3, 1, 1, 1))
+        label |= (np.square(offset).sum(0) < 1).astype(np.uint8)
+    image = label + 0.5 * generator.standard_normal(shape)
+    if zero_background:
+        offset = (grid - np.array((0.05, 0.05, 0.05)).reshape(3, 1, 1, 1)) / np.array((0.8, 0.75, 0.7)).reshape(3, 1, 1, 1)
+        image[np.square(offset).sum(0) >= 1] = 0
+    return image.astype(np.float32), label
+
+
+def load_case(path, transpose):
+    with h5py.File(path, 'r') as h5f:
+        image, label = h5f['image'][:], h5f['label'][:].astype(np.uint8)
+    if transpose:
+        image, label = np.transpose(image, (2, 1, 0)), np.transpose(label, (2, 1, 0))
+    return image, label
+
+
+def fit(model, image, label, patch_size, steps, device, generator):
+    """A few SGD steps of CE on random crops, so that the model segments the case."""
+    volume = torch.from_numpy(np.ascontiguousarray(image, dtype=np.float32)).to(device)
+    target = torch.from_numpy(label.astype(np.int64)).to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    model.train()
+    for _ in range(steps):
+        xs, ys, zs = [int(generator.integers(0, max(1, s - p + 1))) for s, p in zip(image.shape, patch_size)]
+        window = (slice(xs, xs + patch_size[0]), slice(ys, ys + patch_size[1]), slice(zs, zs + patch_size[2]))
+        _, logits, _ = model(volume[window][None, None])
+        loss = F.cross_entropy(logits, target[window][None])
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+    model.eval()
+
+
+def dice(a, b):
+    denominator = a.sum() + b.sum()
+    return 2.0 * np.logical_and(a, b).sum() / denominator if denominator else 1.0
+
+
+def timed(fn, device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    out = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return out, time.perf_counter() - start
+
+
+def peak_tensor_memory(fn, device):
+    """Peak bytes of tensor memory allocated while running `fn`, above what was allocated before."""
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+        fn()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - base
+
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    events = [e for e in prof.profiler.kineto_results.events() if e.name() == '[memory]']
+    current = peak = 0
+    for event in sorted(events, key=lambda e: e.start_ns()):
+        current += event.nbytes()
+        peak = max(peak, current)
+    return peak
+
+
+def stream_equivalence(model, image, patch_size, stride_xy, stride_z):
+    """Largest difference of the streamed slabs from `__call__`, and the voxels not yielded exactly once."""
+    predictor = SlidingWindowPredictor(model, patch_size, strides=(stride_xy, stride_xy, stride_z), output_index=1,
+                                       nonlin=lambda logits: torch.softmax(logits, dim=1))
+    roi = np.zeros(image.shape, dtype=bool)
+    middle = image.shape[0] // 2
+    roi[middle:middle + 1] = True  # only the rows of windows around the middle of x
+    expected = predictor(image[None], roi=roi).cpu().numpy()
+    streamed = np.full(expected.shape, np.nan, dtype=np.float32)
+    yielded = np.zeros(image.shape[0], dtype=np.int64)
+    for index, probs in predictor.stream(image[None], roi=roi):
+        streamed[:, index] = probs.cpu().numpy()
+        yielded[index] += 1
+    return float(np.nanmax(np.abs(streamed - expected))), int(np.isnan(streamed).sum()) + int((yielded != 1).sum())
+
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device)
+    generator = np.random.default_rng(0)
+    torch.manual_seed(0)
+    model = net_factory_3d(net_type=args.model, in_chns=1, class_num=2, scaler=args.feature_scaler).to(device)
+    if args.checkpoint is not None:
+        model.load_state_dict(torch.load(args.checkpoint, map_location=device))
+    if args.case is not None:
+        image, label = load_case(args.case, args.transpose)
+    else:
+        image, label = synthetic_case(tuple(args.volume), generator, args.zero_background, args.lesion_scale)
+    if args.fit_steps:
+        fit(model, image, label, args.patch_size, args.fit_steps, device, generator)
+    model.eval()
+
+    strides = [tuple(int(v) for v in stride.split(',')) for stride in args.strides]
+    settings = [('batch {}'.format(k), strides[0], {'batch_size': k}) for k in args.batch_sizes]
+    if args.memory_budget is not None:
+        settings.append(('budget {:g} MB'.format(args.memory_budget), strides[0], {'memory_budget': args.memory_budget}))
+    for stride in strides:
+        for blend in args.blends:
+            if (stride, blend) != (strides[0], 'uniform'):
+                settings.append((blend, stride, {'batch_size': max(args.batch_sizes), 'gaussian': blend == 'gaussian'}))
+    for axes in args.tta:
+        mirror_axes = [int(a) for a in axes.split(',')]
+        for batch_flips in (False, True):
+            settings.append(('tta {}{}'.format(axes, '' if batch_flips else ' seq'), strides[0],
+                             {'batch_size': max(args.batch_sizes), 'mirror_axes': mirror_axes, 'batch_flips': batch_flips}))
+    for roi in args.roi:
+        settings.append(('roi ' + roi, strides[0], {'batch_size': max(args.batch_sizes), 'roi': roi, 'roi_scale': args.roi_scale,
+                                                    'roi_threshold': args.roi_threshold, 'roi_margin': args.roi_margin}))
+    for dtype in args.stream:
+        settings.append(('stream ' + dtype, strides[0], {'batch_size': max(args.batch_sizes), 'score_out': dtype}))
+
+    reference, results = None, []
+    print("{:<16} {:>8} {:>8} {:>8} {:>9} {:>8} {:>9} {:>12} {:>10} {:>9}".format(
+        'setting', 'stride', 'windows', 'skipped', 'case s', 'speedup', 'peak MB', 'max diff', 'Dice ref', 'Dice GT'))
+    for name, (stride_xy, stride_z), options in settings:
+        stats = {}
+        run = lambda: test_3d_patch.test_single_case(model, image, stride_xy, stride_z, args.patch_size, num_classes=2,
+                                                     stats=stats, **options)
+        (label_map, score_map), seconds = timed(run, device)
+        score_map = np.asarray(score_map, dtype=np.float32) / (255 if score_map.dtype == np.uint8 else 1)
+        peak = peak_tensor_memory(run, device) / 2**20 if args.profile_memory else float('nan')
+        if reference is None:
+            reference = (label_map, score_map, seconds)
+        results.append({'setting': name, 'stride': [stride_xy, stride_z], 'options': options, 'seconds': seconds,
+                        'speedup': reference[2] / seconds, 'peak_mb': peak, 'windows': stats['windows'], 'skipped': stats['skipped'],
+                        'coarse_windows': stats['coarse_windows'], 'max_diff': float(np.abs(score_map - reference[1]).max()),
+                        'dice_ref': float(dice(label_map > 0, reference[0] > 0)), 'dice_gt': float(dice(label_map > 0, label > 0))})
+        r = results[-1]
+        print("{:<16} {:>8} {:>8d} {:>8d} {:>9.3f} {:>7.2f}x {:>9.1f} {:>12.2e} {:>10.4f} {:>9.4f}".format(
+            name, '{},{}'.format(stride_xy, stride_z), r['windows'], r['skipped'], seconds, r['speedup'], peak, r['max_diff'],
+            r['dice_ref'], r['dice_gt']))
+
+    stream_check = None
+    if args.stream:
+        difference, missing = stream_equivalence(model, image, args.patch_size, *strides[0])
+        stream_check = {'max_diff': difference, 'missing': missing}
+        print("stream vs __call__ (leading rows skipped, 2 channels): max diff {:.2e}, voxels not yielded once: {}".format(
+            difference, missing))
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'config': vars(args), 'results': results, 'stream_check': stream_check}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Surface-distance metrics: `metrics.surface_metrics` against medpy's `hd95` + `asd`.
+
+For every `--volume` shape and `--spacing` the script draws `--pairs` pairs of noisy ellipsoids
+(a reference of `--radius` times the volume and a prediction shifted and rescaled from it), times
+`calculate_metric_percase`'s former medpy calls (`hd95` and `asd`, each of which extracts both
+surfaces and distance-transforms the full volume) against one `surface_metrics` call, and reports
+the largest difference of HD, HD95, ASD and ASSD from medpy's.
+
+Usage (from `code/`):
+    python -m benchmarks.surface_metrics --volume 112,112,80 160,160,128 --spacing 1,1,1 0.8,0.8,2.5
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+
+import numpy as np
+from medpy.metric import binary
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import metrics
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--volume', type=str, nargs='+', default=['112,112,80', '160,160,128'], help='Volume shapes X,Y,Z')
+    parser.add_argument('--spacing', type=str, nargs='+', default=['1,1,1', '0.625,0.625,2.5'], help='Voxel spacings X,Y,Z')
+    parser.add_argument('--radius', type=float, default=0.2, help='Reference radius as a fraction of the volume')
+    parser.add_argument('--pairs', type=int, default=3, help='Mask pairs per setting (the median time is kept)')
+    parser.add_argument('--json', type=str, default=None, help='Write the results to this file')
+    return parser.parse_args()
+
+
+def mask_pair(shape, radius, generator):
+    grid = np.stack(np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing='ij'))
+    center = generator.uniform(-0.2, 0.2, size=3).reshape(3, 1, 1, 1)
+    shift = generator.uniform(-0.05, 0.05, size=3).reshape(3, 1, 1, 1)
+    scale = generator.uniform(0.85, 1.15, size=3).reshape(3, 1, 1, 1)
+    reference = np.square((grid - center) / radius).sum(0) + 0.1 * generator.standard_normal(shape) < 1
+    prediction = np.square((grid - center - shift) / (radius * scale)).sum(0) + 0.1 * generator.standard_normal(shape) < 1
+    return prediction, reference
+
+
+def main():
+    args = parse_args()
+    generator = np.random.default_rng(0)
+    results = []
+    print("{:<14} {:<16} {:>10} {:>10} {:>8} {:>10}".format('volume', 'spacing', 'medpy s', 'engine s', 'speedup', 'max diff'))
+    for volume in args.volume:
+        shape = tuple(int(v) for v in volume.split(','))
+        for spacing in args.spacing:
+            voxelspacing = tuple(float(v) for v in spacing.split(','))
+            medpy_times, engine_times, difference = [], [], 0.0
+            for _ in range(args.pairs):
+                prediction, reference = mask_pair(shape, args.radius, generator)
+                start = time.perf_counter()
+                expected = {'hd95': binary.hd95(prediction, reference, voxelspacing),
+                            'asd': binary.asd(prediction, reference, voxelspacing)}
+                medpy_times.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                surface = metrics.surface_metrics(prediction, reference, voxelspacing)
+                engine_times.append(time.perf_counter() - start)
+                expected['hd'] = binary.hd(prediction, reference, voxelspacing)
+                expected['assd'] = binary.assd(prediction, reference, voxelspacing)
+                difference = max([difference] + [abs(surface[k] - expected[k]) for k in expected])
+            results.append({'volume': shape, 'spacing': voxelspacing, 'medpy_s': statistics.median(medpy_times),
+                            'engine_s': statistics.median(engine_times), 'max_diff': float(difference)})
+            r = results[-1]
+            print("{:<14} {:<16} {:>10.3f} {:>10.3f} {:>7.1f}x {:>10.2e}".format(volume, spacing, r['medpy_s'], r['engine_s'],
+                                                                              r['medpy_s'] / r['engine_s'], r['max_diff']))
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'config': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
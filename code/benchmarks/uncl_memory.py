@@ -0,0 +1,126 @@
+"""
+Memory and time of UnCLoss against the fused (recompute-in-backward) implementation.
+
+For the logit shapes of the trainers (BraTS19: 8 x 2 x 96^3, Pancreas: 8 x 2 x 112 x 112 x 96 by
+default) the script reports, for `UnCLoss`, `UnCLoss(fused=True)` and the UnCL term of
+`DyCONObjective` with and without `fused_uncl`:
+  - the memory of the tensors the loss keeps for backward (from a saved-tensor profile, counting
+    the logits themselves once),
+  - the peak memory of a forward/backward pass (CUDA only),
+  - the forward/backward time,
+  - the relative max difference of the loss and of the student gradient against `UnCLoss`.
+
+Usage (from `code/`):
+    python -m benchmarks.uncl_memory --shapes 8,2,96,96,96 8,2,112,112,96 --json uncl_memory.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import dycon_losses
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shapes', type=str, nargs='+', default=['8,2,96,96,96', '8,2,112,112,96'], help='Logit shapes B,C,H,W,D')
+    parser.add_argument('--beta', type=float, default=2.0, help='UnCL beta')
+    parser.add_argument('--iters', type=int, default=3, help='Timed iterations per implementation')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help='Device')
+    parser.add_argument('--json', type=str, default=None, help='Write the results to this file')
+    return parser.parse_args()
+
+
+def implementations(beta):
+    uncl, fused = dycon_losses.UnCLoss(), dycon_losses.UnCLoss(fused=True)
+    objective = dycon_losses.DyCONObjective(labeled_bs=0, binary=True)
+    objective_fused = dycon_losses.DyCONObjective(labeled_bs=0, binary=True, fused_uncl=True)
+    labels = {}
+
+    def term(obj):
+        def fn(s, t):
+            if s.shape not in labels:
+                labels[s.shape] = torch.zeros((s.shape[0],) + s.shape[2:], dtype=torch.long, device=s.device)
+            return obj(s, t, labels[s.shape], beta)['u_loss']
+        return fn
+
+    return [('UnCLoss', lambda s, t: uncl(s, t, beta)), ('UnCLoss(fused)', lambda s, t: fused(s, t, beta)),
+            ('objective', term(objective)), ('objective(fused)', term(objective_fused))]
+
+
+def saved_bytes(fn, s, t):
+    seen = {s.untyped_storage().data_ptr(), t.untyped_storage().data_ptr()}
+    total = [s.untyped_storage().nbytes()]
+
+    def pack(tensor):
+        ptr = tensor.untyped_storage().data_ptr()
+        if ptr not in seen:
+            seen.add(ptr)
+            total[0] += tensor.untyped_storage().nbytes()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda x: x):
+        loss = fn(s, t)
+    del loss
+    return total[0]
+
+
+def run(fn, s, t, iters, device):
+    def step():
+        s.grad = None
+        loss = fn(s, t)
+        loss.backward()
+        return loss
+
+    step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+    base = torch.cuda.memory_allocated(device) if device.type == 'cuda' else 0
+    start = time.perf_counter()
+    for _ in range(iters):
+        loss = step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    seconds = (time.perf_counter() - start) / iters
+    peak = torch.cuda.max_memory_allocated(device) - base if device.type == 'cuda' else None
+    return loss.item(), s.grad.clone(), seconds, peak
+
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device)
+    results = []
+    print("{:<18} {:<16} {:>9} {:>9} {:>8} {:>10} {:>10}".format('shape', 'loss', 'saved MB', 'peak MB', 'step s', 'loss err', 'grad err'))
+    for shape in args.shapes:
+        shape = tuple(int(v) for v in shape.split(','))
+        generator = torch.Generator(device=device).manual_seed(0)
+        s = (3 * torch.randn(shape, generator=generator, device=device)).requires_grad_()
+        t = 3 * torch.randn(shape, generator=generator, device=device)
+        reference = None
+        for name, fn in implementations(args.beta):
+            saved = saved_bytes(fn, s, t)
+            loss, grad, seconds, peak = run(fn, s, t, args.iters, device)
+            if reference is None:
+                reference = (loss, grad)
+            loss_err = abs(loss - reference[0]) / abs(reference[0])
+            grad_err = ((grad - reference[1]).abs().max() / reference[1].abs().max()).item()
+            results.append({'shape': list(shape), 'loss': name, 'saved_mb': saved / 2**20, 'peak_mb': peak / 2**20 if peak is not None else None,
+                            'seconds': seconds, 'loss_err': loss_err, 'grad_err': grad_err})
+            r = results[-1]
+            print("{:<18} {:<16} {:>9.1f} {:>9} {:>8.3f} {:>10.2e} {:>10.2e}".format(
+                'x'.join(str(v) for v in shape), name, r['saved_mb'], '-' if peak is None else '{:.1f}'.format(r['peak_mb']),
+                seconds, loss_err, grad_err))
+        del s, t
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'config': vars(args), 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
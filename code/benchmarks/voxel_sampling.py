@@ -0,0 +1,112 @@
+"""
+Speed against gradient variance of the voxel-sampled UnCL/consistency estimator.
+
+On synthetic teacher/student logits of a trainer-sized batch (a spherical foreground with an
+uncertain boundary, the student being the teacher plus noise) the script reports, for every
+sampling ratio and for uniform and stratified sampling:
+  - the time of a forward/backward pass of UnCL + consistency,
+  - the relative standard deviation of the loss estimate,
+  - the relative gradient variance E||g - g_full||^2 / ||g_full||^2 over `--draws` samples,
+  - the cosine between the mean sampled gradient and the full gradient (a check of unbiasedness).
+
+Usage (from `code/`):
+    python -m benchmarks.voxel_sampling --shape 8 2 96 96 96 --ratios 0.5 0.25 0.1 0.05
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import dycon_losses
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--shape', type=int, nargs=5, default=[8, 2, 96, 96, 96], help='Logit shape B C H W D')
+    parser.add_argument('--labeled_bs', type=int, default=4, help='Labeled volumes at the front of the batch')
+    parser.add_argument('--ratios', type=float, nargs='+', default=[0.5, 0.25, 0.1, 0.05], help='Sampling ratios')
+    parser.add_argument('--bins', type=int, default=4, help='Entropy strata of the stratified sampler')
+    parser.add_argument('--beta', type=float, default=2.0, help='UnCL beta')
+    parser.add_argument('--consistency_type', type=str, default='mse', help='mse or kl')
+    parser.add_argument('--binary', type=int, default=1, help='Use the two-class fast path of DyCONObjective')
+    parser.add_argument('--draws', type=int, default=20, help='Samples per setting')
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu', help='Device')
+    parser.add_argument('--json', type=str, default=None, help='Write the results to this file')
+    return parser.parse_args()
+
+
+def synthetic_logits(shape, device, generator):
+    B, C, H, W, D = shape
+    grid = torch.stack(torch.meshgrid(*[torch.linspace(-1, 1, n) for n in (H, W, D)], indexing='ij'))
+    centers = 0.3 * torch.randn(B, 3, 1, 1, 1, generator=generator)
+    dist = (grid.unsqueeze(0) - centers).norm(dim=1)  # (B, H, W, D)
+    margin = 8.0 * (0.35 - dist) + 0.5 * torch.randn(dist.shape, generator=generator)
+    t = torch.randn(B, C, H, W, D, generator=generator)
+    t[:, 1] += margin
+    s = t + torch.randn(t.shape, generator=generator)
+    return s.to(device), t.to(device)
+
+
+def loss_and_grad(objective, s, t, labels, beta):
+    s = s.detach().requires_grad_()
+    terms = objective(s, t, labels, beta)
+    loss = terms['u_loss'] + terms['consistency_loss']
+    loss.backward()
+    return loss.item(), s.grad.flatten()
+
+
+def timed(fn, device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    out = fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return out, time.perf_counter() - start
+
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device)
+    s, t = synthetic_logits(args.shape, device, torch.Generator().manual_seed(0))
+    labels = (t[:, 1] > t[:, 0]).long()
+
+    full = dycon_losses.DyCONObjective(args.labeled_bs, args.consistency_type, binary=bool(args.binary))
+    loss_and_grad(full, s, t, labels, args.beta)
+    (full_loss, full_grad), full_seconds = timed(lambda: loss_and_grad(full, s, t, labels, args.beta), device)
+    results = [{'sampler': 'full', 'ratio': 1.0, 'seconds': full_seconds, 'loss_rel_std': 0.0, 'grad_rel_var': 0.0, 'grad_cos': 1.0}]
+
+    for ratio in args.ratios:
+        for sampler, bins in (('uniform', 0), ('stratified', args.bins)):
+            objective = dycon_losses.DyCONObjective(args.labeled_bs, args.consistency_type, binary=bool(args.binary),
+                                                    voxel_ratio=ratio, voxel_bins=bins)
+            losses, grads, seconds = [], [], 0.0
+            for _ in range(args.draws):
+                (loss, grad), elapsed = timed(lambda: loss_and_grad(objective, s, t, labels, args.beta), device)
+                losses.append(loss)
+                grads.append(grad)
+                seconds += elapsed / args.draws
+            losses = torch.tensor(losses, dtype=torch.float64)
+            grads = torch.stack(grads)
+            grad_rel_var = ((grads - full_grad).square().sum(1).mean() / full_grad.square().sum()).item()
+            results.append({'sampler': sampler, 'ratio': ratio, 'seconds': seconds,
+                            'loss_rel_std': (losses.std() / abs(full_loss)).item(), 'grad_rel_var': grad_rel_var,
+                            'grad_cos': F.cosine_similarity(grads.mean(0), full_grad, dim=0).item()})
+
+    print("{:<11} {:>6} {:>9} {:>8} {:>12} {:>13} {:>9}".format('sampler', 'ratio', 'step s', 'speedup', 'loss rel std', 'grad rel var', 'grad cos'))
+    for r in results:
+        print("{:<11} {:>6.3f} {:>9.4f} {:>7.2f}x {:>12.2e} {:>13.2e} {:>9.4f}".format(
+            r['sampler'], r['ratio'], r['seconds'], full_seconds / r['seconds'], r['loss_rel_std'], r['grad_rel_var'], r['grad_cos']))
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump({'config': vars(args), 'full_loss': full_loss, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -212,29 +212,39 @@ class TwoStreamBatchSampler(Sampler):
     An 'epoch' is one iteration through the primary indices.
     During the epoch, the secondary indices are iterated through
     as many times as needed.
+
+    For distributed training every rank draws the same permutations
+    (NumPy must be seeded identically on all ranks) and keeps every
+    `num_replicas`-th batch starting at `rank`, so ranks see disjoint
+    batches and all of them get the same number of batches.
     """
 
-    def __init__(self, primary_indices, secondary_indices, batch_size, secondary_batch_size):
+    def __init__(self, primary_indices, secondary_indices, batch_size, secondary_batch_size, num_replicas=1, rank=0):
         self.primary_indices = primary_indices
         self.secondary_indices = secondary_indices
         self.secondary_batch_size = secondary_batch_size
         self.primary_batch_size = batch_size - secondary_batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
 
         assert len(self.primary_indices) >= self.primary_batch_size > 0
         assert len(self.secondary_indices) >= self.secondary_batch_size > 0
+        assert 0 <= self.rank < self.num_replicas
+        assert len(self) > 0, "not enough labeled batches for {} replicas".format(self.num_replicas)
 
     def __iter__(self):
         primary_iter = iterate_once(self.primary_indices)
         secondary_iter = iterate_eternally(self.secondary_indices)
-        return (
+        batches = (
             primary_batch + secondary_batch
             for (primary_batch, secondary_batch)
             in zip(grouper(primary_iter, self.primary_batch_size),
                    grouper(secondary_iter, self.secondary_batch_size))
         )
+        return itertools.islice(batches, self.rank, len(self) * self.num_replicas, self.num_replicas)
 
     def __len__(self):
-        return len(self.primary_indices) // self.primary_batch_size
+        return len(self.primary_indices) // self.primary_batch_size // self.num_replicas
 
 
 def iterate_once(iterable):
@@ -20,6 +20,7 @@ from .networks_other import init_weights
 from .utils import UnetConv3, UnetUp3_CT
 
 from .assp import build_aspp3d
+from .checkpointing import parse_stages, run_stage
 
 
 class UNET_3D_SDF(nn.Module):
@@ -205,11 +206,19 @@ class unet_3D_dt(nn.Module):
     
 
 class UNet3D(nn.Module):
-    def __init__(self, in_channels=3, feature_scale=4, n_classes=2, scale_factor=4, use_aspp=True, is_deconv=True, is_batchnorm=True):
+    # Stages that can be activation-checkpointed, see `networks.checkpointing`
+    CHECKPOINT_GROUPS = {
+        'encoder': ('conv1', 'conv2', 'conv3', 'conv4', 'center'),
+        'decoder': ('up_concat4', 'up_concat3', 'up_concat2', 'up_concat1'),
+    }
+
+    def __init__(self, in_channels=3, feature_scale=4, n_classes=2, scale_factor=4, use_aspp=True, is_deconv=True, is_batchnorm=True,
+                 checkpoint_stages=None):
         super(UNet3D, self).__init__()
 
         self.use_aspp = use_aspp
         self.scale_factor = scale_factor
+        self.checkpoint_stages = parse_stages(checkpoint_stages, self.CHECKPOINT_GROUPS)
 
         self.is_deconv = is_deconv
         self.in_channels = in_channels
@@ -273,20 +282,23 @@ class UNet3D(nn.Module):
             elif isinstance(m, nn.BatchNorm3d):
                 init_weights(m, init_type='kaiming')
             
+    def stage(self, name, *inputs):
+        return run_stage(getattr(self, name), *inputs, use_checkpoint=name in self.checkpoint_stages)
+
     def encode(self, inputs):
-        conv1 = self.conv1(inputs)      
+        conv1 = self.stage('conv1', inputs)      
         maxpool1 = self.maxpool1(conv1) 
 
-        conv2 = self.conv2(maxpool1)   
+        conv2 = self.stage('conv2', maxpool1)   
         maxpool2 = self.maxpool2(conv2) 
 
-        conv3 = self.conv3(maxpool2)    
+        conv3 = self.stage('conv3', maxpool2)    
         maxpool3 = self.maxpool3(conv3) 
 
-        conv4 = self.conv4(maxpool3)    
+        conv4 = self.stage('conv4', maxpool3)    
         maxpool4 = self.maxpool4(conv4) 
         
-        center = self.center(maxpool4)
+        center = self.stage('center', maxpool4)
         center = self.dropout1(center)  
 
         return conv1, conv2, conv3, conv4, center
@@ -295,10 +307,10 @@ class UNet3D(nn.Module):
     def forward(self, x):
         conv1, conv2, conv3, conv4, center = self.encode(x)
 
-        up4 = self.up_concat4(conv4, center) 
-        up3 = self.up_concat3(conv3, up4) 
-        up2 = self.up_concat2(conv2, up3) 
-        up1 = self.up_concat1(conv1, up2) 
+        up4 = self.stage('up_concat4', conv4, center) 
+        up3 = self.stage('up_concat3', conv3, up4) 
+        up2 = self.stage('up_concat2', conv2, up3) 
+        up1 = self.stage('up_concat1', conv1, up2) 
         up1 = self.dropout2(up1)
 
         # ASSP module
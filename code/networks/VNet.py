@@ -2,6 +2,7 @@ import torch
 from torch import nn
 import torch.nn.functional as F
 from .assp import build_aspp3d
+from .checkpointing import parse_stages, run_stage
 
 class ConvBlock(nn.Module):
     def __init__(self, n_stages, n_filters_in, n_filters_out, normalization='none'):
@@ -144,11 +145,19 @@ class Upsampling(nn.Module):
 
 
 class VNet(nn.Module):
-    def __init__(self, n_channels=3, n_classes=2, n_filters=16, scale_factor=4, normalization='none', use_aspp=False, has_dropout=False):
+    # ConvBlock stages that can be activation-checkpointed, see `networks.checkpointing`
+    CHECKPOINT_GROUPS = {
+        'encoder': ('block_one', 'block_two', 'block_three', 'block_four', 'block_five'),
+        'decoder': ('block_six', 'block_seven', 'block_eight', 'block_nine'),
+    }
+
+    def __init__(self, n_channels=3, n_classes=2, n_filters=16, scale_factor=4, normalization='none', use_aspp=False, has_dropout=False,
+                 checkpoint_stages=None):
         super(VNet, self).__init__()
         self.has_dropout = has_dropout
-        self.use_aspp = use_assp
+        self.use_assp = use_aspp
         self.scale_factor = scale_factor
+        self.checkpoint_stages = parse_stages(checkpoint_stages, self.CHECKPOINT_GROUPS)
 
         self.block_one = ConvBlock(1, n_channels, n_filters, normalization=normalization)
         self.block_one_dw = DownsamplingConvBlock(n_filters, 2 * n_filters, normalization=normalization)
@@ -195,20 +204,23 @@ class VNet(nn.Module):
                 nn.Conv3d(512, 256, kernel_size=1)
             )
         
+    def stage(self, name, *inputs):
+        return run_stage(getattr(self, name), *inputs, use_checkpoint=name in self.checkpoint_stages)
+
     def encoder(self, input):
-        x1 = self.block_one(input)
+        x1 = self.stage('block_one', input)
         x1_dw = self.block_one_dw(x1)
 
-        x2 = self.block_two(x1_dw)
+        x2 = self.stage('block_two', x1_dw)
         x2_dw = self.block_two_dw(x2)
 
-        x3 = self.block_three(x2_dw)
+        x3 = self.stage('block_three', x2_dw)
         x3_dw = self.block_three_dw(x3)
 
-        x4 = self.block_four(x3_dw)
+        x4 = self.stage('block_four', x3_dw)
         x4_dw = self.block_four_dw(x4)
 
-        x5 = self.block_five(x4_dw)
+        x5 = self.stage('block_five', x4_dw)
         if self.has_dropout:
             x5 = self.dropout(x5)
 
@@ -234,18 +246,18 @@ class VNet(nn.Module):
         x5_up = self.block_five_up(center)
         x5_up = x5_up + x4
 
-        x6 = self.block_six(x5_up)
+        x6 = self.stage('block_six', x5_up)
         x6_up = self.block_six_up(x6)
         x6_up = x6_up + x3
 
-        x7 = self.block_seven(x6_up)
+        x7 = self.stage('block_seven', x6_up)
         x7_up = self.block_seven_up(x7)
         x7_up = x7_up + x2
 
-        x8 = self.block_eight(x7_up)
+        x8 = self.stage('block_eight', x7_up)
         x8_up = self.block_eight_up(x8)
         x8_up = x8_up + x1
-        x9 = self.block_nine(x8_up)
+        x9 = self.stage('block_nine', x8_up)
 
         if self.has_dropout:
             x9 = self.dropout(x9)
@@ -278,7 +290,7 @@ if __name__ == '__main__':
     from thop import profile
     from thop import clever_format
 
-    model = VNet(n_channels=1, n_classes=2, scale_factor=4, has_dropout=True, use_assp=False).cuda(2)
+    model = VNet(n_channels=1, n_classes=2, scale_factor=4, has_dropout=True, use_aspp=False).cuda(2)
     input = torch.randn(4, 1, 96, 96, 64).cuda(2)
 
     output, regression, embeddings = model(input)
@@ -0,0 +1,186 @@
+"""
+Activation checkpointing of encoder/decoder stages.
+
+A checkpointed stage only keeps its inputs for backward and recomputes its activations when the
+gradient reaches it, trading one extra stage forward for the activation memory of the stage.
+Models list their stages in `CHECKPOINT_GROUPS` ({'encoder': (...), 'decoder': (...)}) and call
+`run_stage` for each of them; `profile_stages` and `select_stages` pick the stages to checkpoint
+from a memory budget.
+"""
+import time
+import contextlib
+from collections import OrderedDict
+
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+_BATCHNORM = (nn.BatchNorm1d, nn.BatchNorm2d, nn.BatchNorm3d, nn.SyncBatchNorm)
+
+
+def parse_stages(stages, groups):
+    """
+    Resolve a checkpointing policy to a set of stage names.
+
+    Args:
+        stages: None/'' (no checkpointing), 'all', a group name of `groups`, a stage name, or a
+            comma-separated string / list mixing them.
+        groups (dict): Group name -> tuple of stage names, as in `Model.CHECKPOINT_GROUPS`.
+
+    Returns:
+        set: Stage names.
+    """
+    if not stages:
+        return set()
+    if isinstance(stages, str):
+        stages = [s.strip() for s in stages.split(',') if s.strip()]
+    available = [name for group in groups.values() for name in group]
+    resolved = set()
+    for name in stages:
+        if name == 'all':
+            resolved.update(available)
+        elif name in groups:
+            resolved.update(groups[name])
+        elif name in available:
+            resolved.add(name)
+        else:
+            raise ValueError("Unknown checkpoint stage '{}', expected 'all', one of {} or one of {}".format(
+                name, list(groups), available))
+    return resolved
+
+
+@contextlib.contextmanager
+def frozen_batchnorm_stats(module):
+    """Stop BatchNorm layers of `module` from updating their running statistics (momentum 0)."""
+    layers = [m for m in module.modules() if isinstance(m, _BATCHNORM) and m.track_running_stats]
+    saved = [(m.momentum, m.num_batches_tracked.clone()) for m in layers]
+    for m in layers:
+        m.momentum = 0.0
+    try:
+        yield
+    finally:
+        for m, (momentum, num_batches_tracked) in zip(layers, saved):
+            m.momentum = momentum
+            m.num_batches_tracked.copy_(num_batches_tracked)
+
+
+def run_stage(module, *inputs, use_checkpoint=False):
+    """
+    Call `module(*inputs)`, checkpointed if requested and gradients are being recorded.
+
+    The recomputation replays the dropout RNG state of the first forward and does not update the
+    BatchNorm running statistics a second time.
+    """
+    if not (use_checkpoint and torch.is_grad_enabled()):
+        return module(*inputs)
+    context_fn = lambda: (contextlib.nullcontext(), frozen_batchnorm_stats(module))
+    return checkpoint(module, *inputs, use_reentrant=False, context_fn=context_fn)
+
+
+def _nbytes(tensors):
+    return sum(t.numel() * t.element_size() for t in tensors if torch.is_tensor(t))
+
+
+def profile_stages(model, input_shape, device='cpu'):
+    """
+    Measure the activation memory each stage of `model` keeps for backward, and its forward time.
+
+    Runs a single training forward without checkpointing. Tensors saved for backward are
+    attributed to the innermost stage running when they are saved (outside any stage: '(other)');
+    parameters and storages shared by several saves are counted once. The RNG state and the
+    BatchNorm running statistics are left untouched.
+
+    Args:
+        model (nn.Module): A model with `CHECKPOINT_GROUPS` and `checkpoint_stages` attributes.
+        input_shape (tuple): (B, C, H, W, D) of the training input.
+        device: Device of the model.
+
+    Returns:
+        OrderedDict: name -> {'saved_bytes', 'input_bytes', 'seconds'}, stages in call order.
+    """
+    device = torch.device(device)
+    stages = [name for group in model.CHECKPOINT_GROUPS.values() for name in group]
+    profile = OrderedDict()
+    active, starts, seen = [], {}, set()
+    param_storages = {p.untyped_storage().data_ptr() for p in model.parameters()}
+
+    def sync():
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+
+    def pre_hook(name):
+        def hook(module, inputs):
+            sync()
+            entry = profile.setdefault(name, {'saved_bytes': 0, 'input_bytes': 0, 'seconds': 0.0})
+            entry['input_bytes'] += _nbytes(inputs)
+            active.append(name)
+            starts[name] = time.perf_counter()
+        return hook
+
+    def post_hook(name):
+        def hook(module, inputs, outputs):
+            sync()
+            profile[name]['seconds'] += time.perf_counter() - starts[name]
+            active.pop()
+        return hook
+
+    def pack(tensor):
+        ptr = tensor.untyped_storage().data_ptr()
+        if ptr not in seen and ptr not in param_storages:
+            seen.add(ptr)
+            name = active[-1] if active else '(other)'
+            entry = profile.setdefault(name, {'saved_bytes': 0, 'input_bytes': 0, 'seconds': 0.0})
+            entry['saved_bytes'] += tensor.untyped_storage().nbytes()
+        return tensor
+
+    handles = []
+    for name in stages:
+        module = getattr(model, name)
+        handles.append(module.register_forward_pre_hook(pre_hook(name)))
+        handles.append(module.register_forward_hook(post_hook(name)))
+
+    checkpoint_stages, model.checkpoint_stages = model.checkpoint_stages, set()
+    was_training = model.training
+    model.train()
+    devices = [device.index or 0] if device.type == 'cuda' else []
+    try:
+        with torch.random.fork_rng(devices=devices), frozen_batchnorm_stats(model), \
+                torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+            outputs = model(torch.randn(input_shape, device=device))
+        del outputs
+    finally:
+        for handle in handles:
+            handle.remove()
+        model.checkpoint_stages = checkpoint_stages
+        model.train(was_training)
+    return profile
+
+
+def activation_bytes(profile, stages=()):
+    """Estimated saved activation memory when `stages` are checkpointed (they only keep their inputs)."""
+    return sum(min(entry['input_bytes'], entry['saved_bytes']) if name in stages else entry['saved_bytes']
+               for name, entry in profile.items())
+
+
+def select_stages(profile, budget_bytes):
+    """
+    Choose the stages to checkpoint so that the saved activations fit in `budget_bytes`.
+
+    Stages are added greedily by memory saved per second of recomputation, so the cheapest
+    stages to recompute are checkpointed first.
+
+    Returns:
+        (set, int): Stage names to checkpoint and the estimated activation memory. If even
+        checkpointing every stage does not fit the budget, all stages are returned.
+    """
+    candidates = [(name, entry['saved_bytes'] - min(entry['input_bytes'], entry['saved_bytes']), entry['seconds'])
+                  for name, entry in profile.items() if name != '(other)']
+    candidates.sort(key=lambda c: c[1] / max(c[2], 1e-9), reverse=True)
+
+    selected = set()
+    for name, saving, _ in candidates:
+        if activation_bytes(profile, selected) <= budget_bytes:
+            break
+        if saving > 0:
+            selected.add(name)
+    return selected, activation_bytes(profile, selected)
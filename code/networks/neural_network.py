@@ -18,7 +18,6 @@ import numpy as np
 from batchgenerators.augmentations.utils import pad_nd_image
 from torch import nn
 import torch
-from torch.cuda.amp import autocast 
 from scipy.ndimage.filters import gaussian_filter
 from typing import Union, Tuple, List
 
@@ -126,10 +125,12 @@ class SegmentationNetwork(NeuralNetwork):
         :param pad_kwargs: leave this alone
         :param all_in_gpu: experimental. You probably want to leave this as is it
         :param verbose: Do you want a wall of text? If yes then set this to True
-        :param mixed_precision: if True, will run inference in mixed precision with autocast()
+        :param mixed_precision: if True, will run inference in mixed precision with autocast() (float16 on CUDA,
+        bfloat16 on CPU)
         :return:
         """
-        torch.cuda.empty_cache()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
 
         assert step_size <= 1, 'step_size must be smaller than 1. Otherwise there will be a gap between consecutive ' \
                                'predictions'
@@ -137,7 +138,8 @@ class SegmentationNetwork(NeuralNetwork):
         if verbose:
             print("debug: mirroring", do_mirroring, "mirror_axes", mirror_axes)
 
-        assert self.get_device() != "cpu", "CPU not implemented"
+        # 3D networks run on any device (see utils.sliding_window), the 2D code paths still need CUDA
+        assert self.conv_op == nn.Conv3d or self.get_device() != "cpu", "CPU not implemented for 2D networks"
 
         if pad_kwargs is None:
             pad_kwargs = {'constant_values': 0}
@@ -159,7 +161,8 @@ class SegmentationNetwork(NeuralNetwork):
         assert len(x.shape) == 4, "data must have shape (c,x,y,z)"
 
         if mixed_precision:
-            context = autocast
+            from utils.sliding_window import autocast  # imported here so that `networks` does not depend on `utils`
+            context = lambda: autocast(next(self.parameters()).device)
         else:
             context = no_op
 
@@ -251,7 +254,8 @@ class SegmentationNetwork(NeuralNetwork):
         assert len(x.shape) == 3, "data must have shape (c,x,y)"
 
         if mixed_precision:
-            context = autocast
+            from utils.sliding_window import autocast  # imported here so that `networks` does not depend on `utils`
+            context = lambda: autocast(next(self.parameters()).device)
         else:
             context = no_op
 
@@ -325,7 +329,6 @@ class SegmentationNetwork(NeuralNetwork):
                                           verbose: bool) -> Tuple[np.ndarray, np.ndarray]:
         # better safe than sorry
         assert len(x.shape) == 4, "x must be (c, x, y, z)"
-        assert self.get_device() != "cpu"
         if verbose:
             print("step_size:", step_size)
         if verbose:
@@ -333,143 +336,32 @@ class SegmentationNetwork(NeuralNetwork):
 
         assert patch_size is not None, "patch_size cannot be None for tiled prediction"
 
-        # for sliding window inference the image must at least be as large as the patch size. It does not matter
-        # whether the shape is divisible by 2**num_pool as long as the patch size is
-        data, slicer = pad_nd_image(
-            x, patch_size, pad_border_mode, pad_kwargs, True, None)
-        data_shape = data.shape  # still c, x, y, z
-
-        # compute the steps for sliding window
-        steps = self._compute_steps_for_sliding_window(
-            patch_size, data_shape[1:], step_size)
-        num_tiles = len(steps[0]) * len(steps[1]) * len(steps[2])
-
+        # the tiling, padding, Gaussian weighting and mirroring are shared with the DyCON evaluators. With all_in_gpu
+        # the prediction is aggregated on the network's device, otherwise on the CPU
+        from utils.sliding_window import SlidingWindowPredictor
+        predictor = SlidingWindowPredictor(self, patch_size, step_size=step_size, gaussian=use_gaussian,
+                                           mirror_axes=mirror_axes if do_mirroring else (),
+                                           nonlin=self.inference_apply_nonlin, pad_mode=pad_border_mode,
+                                           pad_kwargs=pad_kwargs,
+                                           accumulate_device=None if all_in_gpu else torch.device('cpu'))
         if verbose:
-            print("data shape:", data_shape)
+            padded_shape = [max(i, j) for i, j in zip(x.shape[1:], patch_size)]
+            steps = predictor.grid(padded_shape)
+            print("data shape:", x.shape)
             print("patch size:", patch_size)
             print("steps (x, y, and z):", steps)
-            print("number of tiles:", num_tiles)
-
-        # we only need to compute that once. It can take a while to compute this due to the large sigma in
-        # gaussian_filter
-        if use_gaussian and num_tiles > 1:
-            if self._gaussian_3d is None or not all(
-                    [i == j for i, j in zip(patch_size, self._patch_size_for_gaussian_3d)]):
-                if verbose:
-                    print('computing Gaussian')
-                gaussian_importance_map = self._get_gaussian(
-                    patch_size, sigma_scale=1. / 8)
-
-                self._gaussian_3d = gaussian_importance_map
-                self._patch_size_for_gaussian_3d = patch_size
-            else:
-                if verbose:
-                    print("using precomputed Gaussian")
-                gaussian_importance_map = self._gaussian_3d
-
-            gaussian_importance_map = torch.from_numpy(gaussian_importance_map).cuda(self.get_device(),
-                                                                                     non_blocking=True)
+            print("number of tiles:", np.prod([len(i) for i in steps]))
 
-        else:
-            gaussian_importance_map = None
-
-        if all_in_gpu:
-            # If we run the inference in GPU only (meaning all tensors are allocated on the GPU, this reduces
-            # CPU-GPU communication but required more GPU memory) we need to preallocate a few things on GPU
-
-            if use_gaussian and num_tiles > 1:
-                # half precision for the outputs should be good enough. If the outputs here are half, the
-                # gaussian_importance_map should be as well
-                gaussian_importance_map = gaussian_importance_map.half()
-
-                # make sure we did not round anything to 0
-                gaussian_importance_map[gaussian_importance_map == 0] = gaussian_importance_map[
-                    gaussian_importance_map != 0].min()
-
-                add_for_nb_of_preds = gaussian_importance_map
-            else:
-                add_for_nb_of_preds = torch.ones(
-                    data.shape[1:], device=self.get_device())
-
-            if verbose:
-                print("initializing result array (on GPU)")
-            aggregated_results = torch.zeros([self.num_classes] + list(data.shape[1:]), dtype=torch.half,
-                                             device=self.get_device())
-
-            if verbose:
-                print("moving data to GPU")
-            data = torch.from_numpy(data).cuda(
-                self.get_device(), non_blocking=True)
-
-            if verbose:
-                print("initializing result_numsamples (on GPU)")
-            aggregated_nb_of_predictions = torch.zeros([self.num_classes] + list(data.shape[1:]), dtype=torch.half,
-                                                       device=self.get_device())
-        else:
-            if use_gaussian and num_tiles > 1:
-                add_for_nb_of_preds = self._gaussian_3d
-            else:
-                add_for_nb_of_preds = np.ones(data.shape[1:], dtype=np.float32)
-            aggregated_results = np.zeros(
-                [self.num_classes] + list(data.shape[1:]), dtype=np.float32)
-            aggregated_nb_of_predictions = np.zeros(
-                [self.num_classes] + list(data.shape[1:]), dtype=np.float32)
-
-        for x in steps[0]:
-            lb_x = x
-            ub_x = x + patch_size[0]
-            for y in steps[1]:
-                lb_y = y
-                ub_y = y + patch_size[1]
-                for z in steps[2]:
-                    lb_z = z
-                    ub_z = z + patch_size[2]
-
-                    predicted_patch = self._internal_maybe_mirror_and_pred_3D(
-                        data[None, :, lb_x:ub_x, lb_y:ub_y,
-                             lb_z:ub_z], mirror_axes, do_mirroring,
-                        gaussian_importance_map)[0]
-
-                    if all_in_gpu:
-                        predicted_patch = predicted_patch.half()
-                    else:
-                        predicted_patch = predicted_patch.cpu().numpy()
-
-                    aggregated_results[:, lb_x:ub_x,
-                                       lb_y:ub_y, lb_z:ub_z] += predicted_patch
-                    aggregated_nb_of_predictions[:, lb_x:ub_x,
-                                                 lb_y:ub_y, lb_z:ub_z] += add_for_nb_of_preds
-
-        # we reverse the padding here (remeber that we padded the input to be at least as large as the patch size
-        slicer = tuple(
-            [slice(0, aggregated_results.shape[i]) for i in
-             range(len(aggregated_results.shape) - (len(slicer) - 1))] + slicer[1:])
-        aggregated_results = aggregated_results[slicer]
-        aggregated_nb_of_predictions = aggregated_nb_of_predictions[slicer]
-
-        # computing the class_probabilities by dividing the aggregated result with result_numsamples
-        class_probabilities = aggregated_results / aggregated_nb_of_predictions
+        class_probabilities = predictor(x)
 
         if regions_class_order is None:
-            predicted_segmentation = class_probabilities.argmax(0)
+            predicted_segmentation = class_probabilities.argmax(0).cpu().numpy()
         else:
-            if all_in_gpu:
-                class_probabilities_here = class_probabilities.detach().cpu().numpy()
-            else:
-                class_probabilities_here = class_probabilities
             predicted_segmentation = np.zeros(
-                class_probabilities_here.shape[1:], dtype=np.float32)
+                class_probabilities.shape[1:], dtype=np.float32)
             for i, c in enumerate(regions_class_order):
-                predicted_segmentation[class_probabilities_here[i] > 0.5] = c
-
-        if all_in_gpu:
-            if verbose:
-                print("copying results to CPU")
-
-            if regions_class_order is None:
-                predicted_segmentation = predicted_segmentation.detach().cpu().numpy()
-
-            class_probabilities = class_probabilities.detach().cpu().numpy()
+                predicted_segmentation[(class_probabilities[i] > 0.5).cpu().numpy()] = c
+        class_probabilities = class_probabilities.cpu().numpy()
 
         if verbose:
             print("prediction done")
@@ -521,7 +413,6 @@ class SegmentationNetwork(NeuralNetwork):
         This one does fully convolutional inference. No sliding window
         """
         assert len(x.shape) == 4, "x must be (c, x, y, z)"
-        assert self.get_device() != "cpu"
         assert self.input_shape_must_be_divisible_by is not None, 'input_shape_must_be_divisible_by must be set to ' \
                                                                   'run _internal_predict_3D_3Dconv'
         if verbose:
@@ -555,59 +446,15 @@ class SegmentationNetwork(NeuralNetwork):
                                            do_mirroring: bool = True,
                                            mult: np.ndarray or torch.tensor = None) -> torch.tensor: # type: ignore
         assert len(x.shape) == 5, 'x must be (b, c, x, y, z)'
-        # everything in here takes place on the GPU. If x and mult are not yet on GPU this will be taken care of here
-        # we now return a cuda tensor! Not numpy array!
-
-        x = to_cuda(maybe_to_torch(x), gpu_id=self.get_device())
-        result_torch = torch.zeros([1, self.num_classes] + list(x.shape[2:]),
-                                   dtype=torch.float).cuda(self.get_device(), non_blocking=True)
+        # everything in here takes place on the network's device. If x and mult are not yet there this will be taken
+        # care of here. We return a tensor on that device! Not numpy array!
+        from utils.sliding_window import SlidingWindowPredictor
+        predictor = SlidingWindowPredictor(self, x.shape[2:], mirror_axes=mirror_axes if do_mirroring else (),
+                                           nonlin=self.inference_apply_nonlin)
+        result_torch = predictor.predict_windows(maybe_to_torch(x).to(predictor.device, non_blocking=True))
 
         if mult is not None:
-            mult = to_cuda(maybe_to_torch(mult), gpu_id=self.get_device())
-
-        if do_mirroring:
-            mirror_idx = 8
-            num_results = 2 ** len(mirror_axes)
-        else:
-            mirror_idx = 1
-            num_results = 1
-
-        for m in range(mirror_idx):
-            if m == 0:
-                pred = self.inference_apply_nonlin(self(x))
-                result_torch += 1 / num_results * pred
-
-            if m == 1 and (2 in mirror_axes):
-                pred = self.inference_apply_nonlin(self(torch.flip(x, (4, ))))
-                result_torch += 1 / num_results * torch.flip(pred, (4,))
-
-            if m == 2 and (1 in mirror_axes):
-                pred = self.inference_apply_nonlin(self(torch.flip(x, (3, ))))
-                result_torch += 1 / num_results * torch.flip(pred, (3,))
-
-            if m == 3 and (2 in mirror_axes) and (1 in mirror_axes):
-                pred = self.inference_apply_nonlin(self(torch.flip(x, (4, 3))))
-                result_torch += 1 / num_results * torch.flip(pred, (4, 3))
-
-            if m == 4 and (0 in mirror_axes):
-                pred = self.inference_apply_nonlin(self(torch.flip(x, (2, ))))
-                result_torch += 1 / num_results * torch.flip(pred, (2,))
-
-            if m == 5 and (0 in mirror_axes) and (2 in mirror_axes):
-                pred = self.inference_apply_nonlin(self(torch.flip(x, (4, 2))))
-                result_torch += 1 / num_results * torch.flip(pred, (4, 2))
-
-            if m == 6 and (0 in mirror_axes) and (1 in mirror_axes):
-                pred = self.inference_apply_nonlin(self(torch.flip(x, (3, 2))))
-                result_torch += 1 / num_results * torch.flip(pred, (3, 2))
-
-            if m == 7 and (0 in mirror_axes) and (1 in mirror_axes) and (2 in mirror_axes):
-                pred = self.inference_apply_nonlin(
-                    self(torch.flip(x, (4, 3, 2))))
-                result_torch += 1 / num_results * torch.flip(pred, (4, 3, 2))
-
-        if mult is not None:
-            result_torch[:, :] *= mult
+            result_torch[:, :] *= maybe_to_torch(mult).to(result_torch.device, non_blocking=True)
 
         return result_torch
 
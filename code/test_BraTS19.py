@@ -24,36 +24,16 @@ parser.add_argument('--consistency_type', type=str, default="mse", help='Consist
 parser.add_argument('--max_iterations', type=int, default=20000, help='Maximum number of training iterations')
 parser.add_argument('--in_ch', type=int, default=1, help='Input channels')
 parser.add_argument('--feature_scaler', type=float, default=2, help='Feature scaler for the model')
-
-args = parser.parse_args()
-
-os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu_id
-
-if args.s_beta is not None:
-    beta_str = f"_beta{args.s_beta}"
-else:
-    beta_str = f"_beta{args.beta_min}-{args.beta_max}"
-
-focal_str = "Focal" if bool(args.use_focal) else "NoFocal"
-gamma_str = f"_gamma{args.gamma}" if bool(args.use_focal) else ""
-teacher_str = "Teacher" if bool(args.use_teacher_loss) else "NoTeacher"
-
-snapshot_path = (
-    f"../models/{args.exp}/{args.model.upper()}_{args.labelnum}labels_"
-    f"{args.consistency_type}{gamma_str}_{focal_str}_{teacher_str}_temp{args.temp}"
-    f"{beta_str}_max_iterations{args.max_iterations}"
-)
-test_save_path = "{}/{}_predictions/".format(snapshot_path, args.exp, args.labelnum, args.model)
-
-num_classes = 2
-
-if not os.path.exists(test_save_path):
-    os.makedirs(test_save_path)
-
-image_list = []
-with open(os.path.join(args.root_path, "val.txt"), 'r') as f:
-    case_ids = [line.strip() for line in f if line.strip()]
-    image_list = [os.path.join(args.root_path, "data", f"{case_id}.h5") for case_id in case_ids]    
+parser.add_argument('--stride_xy', type=int, default=16, help='In-plane sliding-window stride')
+parser.add_argument('--stride_z', type=int, default=4, help='Sliding-window stride along z')
+parser.add_argument('--batch_size', type=int, default=4, help='Sliding windows stacked per forward pass')
+parser.add_argument('--gaussian', type=int, default=0, help='Weight the sliding windows with a Gaussian importance map (1 for True, 0 for False)')
+parser.add_argument('--mirror_axes', type=int, nargs='*', default=[], help='Spatial axes flipped for test-time augmentation (e.g. 0 1 2)')
+parser.add_argument('--stream', type=str, default='none', choices=['none', 'float16', 'uint8'], help='Stream the score maps slab by slab into temporary memory maps of this dtype')
+parser.add_argument('--readers', type=int, default=2, help='Threads reading the next cases ahead of inference')
+parser.add_argument('--workers', type=int, default=0, help='Processes computing the metrics (0: inline in the main process)')
+parser.add_argument('--cache', type=int, default=0, help='Reuse the predictions and metrics cached in eval_cache.sqlite next to the model (1 for True, 0 for False)')
+parser.add_argument('--roi', type=str, default='none', choices=['none', 'intensity', 'coarse'], help='Only evaluate the sliding windows intersecting a region of interest found from the intensities or a coarse pass')
 
 def test_calculate_metric():
     net = net_factory_3d(net_type=args.model, in_chns=args.in_ch, class_num=num_classes, scaler=args.feature_scaler)
@@ -65,13 +45,48 @@ def test_calculate_metric():
     model.eval()
 
     avg_metric = test_all_case_BraTS19(model, image_list, num_classes=num_classes,
-                           patch_size=(96, 96, 96), stride_xy=16, stride_z=4,
+                           patch_size=(96, 96, 96), stride_xy=args.stride_xy, stride_z=args.stride_z,
                            save_result=False, test_save_path=test_save_path,
-                           metric_detail=args.detail, nms=args.nms)
+                           metric_detail=args.detail, nms=args.nms, batch_size=args.batch_size,
+                           gaussian=bool(args.gaussian), mirror_axes=tuple(args.mirror_axes),
+                           roi=None if args.roi == 'none' else args.roi,
+                           stream=None if args.stream == 'none' else args.stream,
+                           readers=args.readers, workers=args.workers,
+                           cache=os.path.join(snapshot_path, 'eval_cache.sqlite') if args.cache else None)
 
     return avg_metric
 
 if __name__ == '__main__':
+    args = parser.parse_args()
+
+    os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu_id
+
+    if args.s_beta is not None:
+        beta_str = f"_beta{args.s_beta}"
+    else:
+        beta_str = f"_beta{args.beta_min}-{args.beta_max}"
+
+    focal_str = "Focal" if bool(args.use_focal) else "NoFocal"
+    gamma_str = f"_gamma{args.gamma}" if bool(args.use_focal) else ""
+    teacher_str = "Teacher" if bool(args.use_teacher_loss) else "NoTeacher"
+
+    snapshot_path = (
+        f"../models/{args.exp}/{args.model.upper()}_{args.labelnum}labels_"
+        f"{args.consistency_type}{gamma_str}_{focal_str}_{teacher_str}_temp{args.temp}"
+        f"{beta_str}_max_iterations{args.max_iterations}"
+    )
+    test_save_path = "{}/{}_predictions/".format(snapshot_path, args.exp, args.labelnum, args.model)
+
+    num_classes = 2
+
+    if not os.path.exists(test_save_path):
+        os.makedirs(test_save_path)
+
+    image_list = []
+    with open(os.path.join(args.root_path, "val.txt"), 'r') as f:
+        case_ids = [line.strip() for line in f if line.strip()]
+        image_list = [os.path.join(args.root_path, "data", f"{case_id}.h5") for case_id in case_ids]
+
     metric = test_calculate_metric()
     print(metric)
 
@@ -1,6 +1,7 @@
 import os
 import sys
 import shutil
+import contextlib
 import random
 import logging
 import argparse
@@ -11,12 +12,15 @@ from tensorboardX import SummaryWriter
 import torch
 import torch.optim as optim
 from torch.nn import functional as F
+import torch.distributed as dist
 import torch.backends.cudnn as cudnn
 from torch.utils.data import DataLoader
+from torch.nn.parallel import DistributedDataParallel as DDP
 from torchvision import transforms as T
 
 from networks.net_factory_3d import net_factory_3d
-from utils import ramps, metrics, losses, dycon_losses, test_3d_patch, monitor
+from networks import checkpointing
+from utils import ramps, metrics, dycon_losses, test_3d_patch, monitor, checkpoint, util, sync_audit
 from dataloaders.brats19 import BraTS2019, SagittalToAxial, RandomCrop, RandomRotFlip, ToTensor, TwoStreamBatchSampler 
 
 # Argument parsing
@@ -34,10 +38,13 @@ parser.add_argument('--model', type=str, choices=['unet_3D', 'vnet'], default='u
 parser.add_argument('--in_ch', type=int, default=1, help='Number of input channels')
 parser.add_argument('--num_classes', type=int, default=2, help='Number of segmentation classes')
 parser.add_argument('--feature_scaler', type=int, default=2, help='Feature scaling factor for contrastive loss')
+parser.add_argument('--checkpoint_stages', type=str, default='', help="Student stages recomputed in backward to save memory: 'all', 'encoder', 'decoder' or a comma-separated list of stage names")
+parser.add_argument('--memory_budget', type=float, default=0, help='Activation memory budget (GB) of a student forward; picks --checkpoint_stages from a profile when > 0')
 
 parser.add_argument('--max_iterations', type=int, default=20000, help='Maximum number of training iterations')
 parser.add_argument('--batch_size', type=int, default=8, help='Total batch size per GPU')
 parser.add_argument('--labeled_bs', type=int, default=4, help='Labeled batch size per GPU')
+parser.add_argument('--accum_steps', type=int, default=1, help='Micro-batches per optimizer step (gradient accumulation), each keeping the labeled/unlabeled ratio')
 parser.add_argument('--base_lr', type=float, default=0.01, help='Base learning rate')
 
 parser.add_argument('--labelnum', type=int, default=8, help='Number of labeled samples per class')
@@ -45,6 +52,9 @@ parser.add_argument('--ema_decay', type=float, default=0.99, help='EMA decay for
 parser.add_argument('--consistency', type=float, default=0.1, help='consistency')
 parser.add_argument('--consistency_type', type=str, default="mse", help='Consistency loss type')
 parser.add_argument('--consistency_rampup', type=float, default=200.0, help='Ramp-up duration for consistency weight')
+parser.add_argument('--binary_fast_path', type=int, default=1, help='Compute the two-class losses from the logit difference (1: on, 0: softmax over both channels)')
+parser.add_argument('--fused_uncl', type=int, default=0, help='Compute UnCLoss in a single autograd node that recomputes its intermediates in backward (1: on, 0: off)')
+parser.add_argument('--voxel_ratio', type=float, default=1.0, help='Estimate UnCL and consistency on this expected fraction of voxels, stratified by teacher entropy and class (1: all voxels)')
 
 # === DyCon-specific Parameters === #
 parser.add_argument('--gamma', type=float, default=2.0, help='Focusing parameter for hard positives/negatives in FeCL (γ)')
@@ -56,6 +66,25 @@ parser.add_argument('--l_weight', type=float, default=1.0, help='Weight for supe
 parser.add_argument('--u_weight', type=float, default=0.5, help='Weight for unsupervised loss')
 parser.add_argument('--use_focal', type=int, default=1, help='Whether to use focal weighting (1 for True, 0 for False)')
 parser.add_argument('--use_teacher_loss', type=int, default=1, help='Use teacher-based auxiliary loss (1 for True, 0 for False)')
+parser.add_argument('--fecl_block_size', type=int, default=0, help='Compute FeCL over N x N tiles of this size (memory linear in the number of patches), 0 for the dense loss')
+parser.add_argument('--fecl_anchors', type=int, default=0, help='Anchors sampled per volume (half foreground, half background) for FeCL, 0 for all patches')
+parser.add_argument('--fecl_hard_negatives', type=int, default=0, help='With --fecl_anchors, keep the top-k negatives above the hard-negative threshold, 0 for all negatives')
+parser.add_argument('--memory_bank', type=int, default=0, help='Past teacher embeddings kept per class (fp16 FIFO) as extra FeCL positives/negatives, 0 to disable')
+parser.add_argument('--global_negatives', type=int, default=0, help='Use the all-gathered teacher embeddings of every rank as extra FeCL negatives (1 for True, 0 for False)')
+
+# === Logging === #
+parser.add_argument('--log_interval', type=int, default=50, help='Iterations buffered on-device before scalars are written to TensorBoard/log')
+parser.add_argument('--async_log', type=int, default=0, help='Write buffered scalars from a background thread (1 for True, 0 for False)')
+parser.add_argument('--sync_audit', type=int, default=0, help='Count and locate the host-device syncs of the first N iterations and log them, 0 to disable')
+parser.add_argument('--sync_free', type=int, default=0, help='Skip non-finite steps on the device instead of reading the loss on the host, and compute HD95 only every log_interval iterations (1 for True, 0 for False). Skipped steps still advance iter_num')
+
+# === Checkpointing === #
+parser.add_argument('--resume', type=str, default=None, help="Full training checkpoint to resume from ('latest' picks the newest in the snapshot path, starting from scratch if there is none)")
+parser.add_argument('--ckpt_interval', type=int, default=3000, help='Iterations between full training-state checkpoints')
+parser.add_argument('--keep_ckpt', type=int, default=3, help='Number of checkpoints kept per kind (0 keeps all)')
+
+# === Distributed (launch with `torchrun --nproc_per_node N`) === #
+parser.add_argument('--dist_backend', type=str, default='gloo', help='torch.distributed backend (gloo also runs on CPU-only nodes, nccl for GPUs)')
 
 args = parser.parse_args()
 
@@ -74,12 +103,25 @@ snapshot_path = (
     f"{beta_str}_max_iterations{args.max_iterations}"
 )
 
-os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu_id) # Only GPU `args.gpu_id` is visible
+# torchrun sets WORLD_SIZE/RANK/LOCAL_RANK; a plain `python train_*.py` is a single process
+world_size = int(os.environ.get('WORLD_SIZE', 1))
+rank = int(os.environ.get('RANK', 0))
+local_rank = int(os.environ.get('LOCAL_RANK', 0))
+distributed = world_size > 1
+is_main = rank == 0
+
+if not distributed:
+    os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu_id) # Only GPU `args.gpu_id` is visible
+device = torch.device('cuda', local_rank) if torch.cuda.is_available() else torch.device('cpu')
 
 batch_size = args.batch_size 
 max_iterations = args.max_iterations
 base_lr = args.base_lr
 labeled_bs = args.labeled_bs
+accum_steps = args.accum_steps
+assert labeled_bs % accum_steps == 0 and (batch_size - labeled_bs) % accum_steps == 0, \
+    "labeled_bs and batch_size - labeled_bs must be divisible by accum_steps"
+micro_labeled_bs = labeled_bs // accum_steps
 
 if not args.deterministic:
     cudnn.benchmark = True
@@ -87,10 +129,11 @@ if not args.deterministic:
 else:
     cudnn.benchmark = True 
     cudnn.deterministic = True
+# NumPy/Python drive the batch sampler and must match across ranks; torch (noise, dropout) differs per rank
 random.seed(args.seed)
 np.random.seed(args.seed)
-torch.manual_seed(args.seed)
-torch.cuda.manual_seed(args.seed)
+torch.manual_seed(args.seed + rank)
+torch.cuda.manual_seed(args.seed + rank)
 
 num_classes = args.num_classes = 2
 patch_size = args.patch_size = (96, 96, 96) # (112, 112, 80)
@@ -99,9 +142,22 @@ def get_current_consistency_weight(epoch):
     # Consistency ramp-up from https://arxiv.org/abs/1610.02242
     return args.consistency * ramps.sigmoid_rampup(epoch, args.consistency_rampup)
 
-def update_ema_variables(model, ema_model, alpha, global_step):
+def split_micro_batches(batch, accum_steps):
+    """Split a [labeled | unlabeled] batch into `accum_steps` micro-batches with the same labeled/unlabeled ratio."""
+    if accum_steps == 1:
+        return [batch]
+    labeled, unlabeled = batch[:labeled_bs].chunk(accum_steps), batch[labeled_bs:].chunk(accum_steps)
+    return [torch.cat(pair) for pair in zip(labeled, unlabeled)]
+
+def update_ema_variables(model, ema_model, alpha, global_step, skip=None):
     # Use the true average until the exponential average is more correct
     alpha = min(1 - 1 / (global_step + 1), alpha)
+    if skip is not None:
+        # Leave the EMA unchanged on a skipped step, without reading `skip` on the host
+        weight = (1 - alpha) * (~skip).float()
+        for ema_param, param in zip(ema_model.parameters(), model.parameters()):
+            ema_param.data.lerp_(param.data, weight.to(ema_param.dtype))
+        return
     for ema_param, param in zip(ema_model.parameters(), model.parameters()):
         ema_param.data.mul_(alpha).add_(1 - alpha, param.data)
 
@@ -118,22 +174,31 @@ def plot_samples(image, mask, epoch):
 
 
 if __name__ == "__main__":
-    # make logger file
-    if not os.path.exists(snapshot_path):
-        os.makedirs(snapshot_path)
-    if os.path.exists(snapshot_path + '/code'):
-        shutil.rmtree(snapshot_path + '/code')
-    shutil.copytree('.', snapshot_path + '/code',
-                    shutil.ignore_patterns(['.git', '__pycache__']))
-
-    logging.basicConfig(filename=snapshot_path+"/log.txt", level=logging.INFO,
-                        format='[%(asctime)s.%(msecs)03d] %(message)s', datefmt='%H:%M:%S')
-    logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+    if distributed:
+        if device.type == 'cuda':
+            torch.cuda.set_device(device)
+        util.distributed_setup(rank, world_size, backend=args.dist_backend)
+
+    # make logger file (logging, validation and checkpointing happen on rank 0 only)
+    if is_main:
+        if not os.path.exists(snapshot_path):
+            os.makedirs(snapshot_path)
+        if os.path.exists(snapshot_path + '/code'):
+            shutil.rmtree(snapshot_path + '/code')
+        shutil.copytree('.', snapshot_path + '/code',
+                        shutil.ignore_patterns(['.git', '__pycache__']))
+
+        logging.basicConfig(filename=snapshot_path+"/log.txt", level=logging.INFO,
+                            format='[%(asctime)s.%(msecs)03d] %(message)s', datefmt='%H:%M:%S')
+        logging.getLogger().addHandler(logging.StreamHandler(sys.stdout))
+    else:
+        logging.basicConfig(level=logging.WARNING, format='[rank {}] %(message)s'.format(rank))
     logging.info(str(args))
 
     def create_model(ema=False):
-        net = net_factory_3d(net_type=args.model, in_chns=args.in_ch, class_num=num_classes, scaler=args.feature_scaler)
-        model = net.cuda() # Now 'cuda:0' refers to physical GPU 3
+        net = net_factory_3d(net_type=args.model, in_chns=args.in_ch, class_num=num_classes, scaler=args.feature_scaler,
+                             checkpoint_stages=None if ema else args.checkpoint_stages)
+        model = net.to(device)
         if ema:
             for param in model.parameters():
                 param.detach_()
@@ -144,6 +209,24 @@ if __name__ == "__main__":
     ema_model = create_model(ema=True)
     logging.info("Total params of model: {:.2f}M".format(sum(p.numel() for p in model.parameters())/1e6))
 
+    # Activation checkpointing policy from a memory budget (profiled once on a micro-batch)
+    if args.memory_budget > 0:
+        stage_profile = checkpointing.profile_stages(model, (batch_size // accum_steps, args.in_ch) + tuple(patch_size), device)
+        model.checkpoint_stages, estimate = checkpointing.select_stages(stage_profile, args.memory_budget * 2**30)
+        logging.info("Checkpointed stages for a {:.2f}GB activation budget: {} (estimated {:.2f}GB, {:.2f}GB without checkpointing)".format(
+            args.memory_budget, sorted(model.checkpoint_stages), estimate / 2**30, checkpointing.activation_bytes(stage_profile) / 2**30))
+    elif model.checkpoint_stages:
+        logging.info("Checkpointed stages: {}".format(sorted(model.checkpoint_stages)))
+
+    # `net` is the bare student used for EMA updates, validation and checkpoints; `model` may be its DDP wrapper.
+    # DDP broadcasts the student from rank 0; the teacher is broadcast once and then kept in sync by the EMA of
+    # the (synchronised) student weights plus an average of its BatchNorm statistics after every update.
+    net = model
+    if distributed:
+        util.broadcast_module(ema_model)
+        # The SDF head is not part of the DyCON objective, hence find_unused_parameters
+        model = DDP(model, device_ids=[device.index] if device.type == 'cuda' else None, find_unused_parameters=True)
+
     # Read dataset
     db_train = BraTS2019(base_dir=args.root_dir, 
                          split='train', 
@@ -158,7 +241,8 @@ if __name__ == "__main__":
     labelnum = args.labelnum
     labeled_idxs = list(range(labelnum))
     unlabeled_idxs = list(range(labelnum, db_train.__len__()))
-    batch_sampler = TwoStreamBatchSampler(labeled_idxs, unlabeled_idxs, batch_size, batch_size - labeled_bs)
+    batch_sampler = TwoStreamBatchSampler(labeled_idxs, unlabeled_idxs, batch_size, batch_size - labeled_bs,
+                                          num_replicas=world_size, rank=rank)
 
     def worker_init_fn(worker_id):
         random.seed(args.seed + worker_id)
@@ -170,25 +254,66 @@ if __name__ == "__main__":
 
     optimizer = optim.SGD(model.parameters(), lr=base_lr, momentum=0.9, weight_decay=0.0001)
     
-    if args.consistency_type == 'mse':
-        consistency_criterion = losses.softmax_mse_loss
-    elif args.consistency_type == 'kl':
-        consistency_criterion = losses.softmax_kl_loss
-    else:
-        assert False, args.consistency_type
 
-    writer = SummaryWriter(snapshot_path+'/log')
+    writer = SummaryWriter(snapshot_path+'/log') if is_main else None
+    scalars = monitor.ScalarBuffer(writer, flush_every=args.log_interval, background=bool(args.async_log),
+                                   log_format='Iteration %(step)d : Loss : %(info/loss)03f, Loss_CE: %(info/loss_ce)03f, '
+                                              'Loss_Dice: %(info/loss_dice)03f, UnCLoss: %(info/u_loss)03f, FeCLoss: %(info/f_loss)03f, '
+                                              'mean_dice: %(train/Dice)03f, mean_hd95: %(train/HD95)03f')
     logging.info("{} Itertations per epoch".format(len(trainloader)))
 
     iter_num = 0
     max_epoch = max_iterations // len(trainloader) + 1
     best_performance = 0.0
-    iterator = tqdm(range(max_epoch), ncols=70)
-
-    uncl_criterion = dycon_losses.UnCLoss()
-    fecl_criterion = dycon_losses.FeCLoss(device=f"cuda:0", temperature=args.temp, gamma=args.gamma, use_focal=bool(args.use_focal), rampup_epochs=1500)
+    ckpt_manager = checkpoint.CheckpointManager(snapshot_path, keep_last=args.keep_ckpt)
+
+    # Resume from a full training state: the epoch is replayed from its starting RNG state and the
+    # already consumed batches are loaded and skipped, so the data order and augmentations are
+    # reproduced; the torch generators are then restored to their state at the checkpoint.
+    start_epoch, skip_batches, epoch_rng, resume_rng, fecl_state = 0, 0, None, None, None
+    resume_path = ckpt_manager.latest() if args.resume == 'latest' else args.resume
+    if args.resume == 'latest' and resume_path is None:
+        logging.info("No checkpoint_iter_*.pth in {}, starting from scratch".format(snapshot_path))
+    elif resume_path is not None and not os.path.isfile(resume_path):
+        raise FileNotFoundError("Resume checkpoint {} does not exist".format(resume_path))
+    if resume_path is not None:
+        state = checkpoint.load_state(resume_path)
+        net.load_state_dict(state['model'])
+        ema_model.load_state_dict(state['ema_model'])
+        optimizer.load_state_dict(state['optimizer'])
+        iter_num, best_performance = state['iter_num'], state['best_performance']
+        start_epoch, skip_batches = state['epoch'], state['i_batch']
+        epoch_rng, resume_rng, fecl_state = state['epoch_rng'], state['rng'], state.get('fecl')
+        # Distributed checkpoints hold one generator state (and FeCL memory bank) per rank
+        if isinstance(epoch_rng, list):
+            epoch_rng = epoch_rng[rank]
+        if isinstance(resume_rng, list):
+            resume_rng = resume_rng[rank]
+        if isinstance(fecl_state, list):
+            fecl_state = fecl_state[rank]
+        logging.info("Resumed from {} at iteration {}".format(resume_path, iter_num))
+
+    iterator = tqdm(range(start_epoch, max_epoch), ncols=70, disable=not is_main)
+
+    objective = dycon_losses.DyCONObjective(labeled_bs=micro_labeled_bs, consistency_type=args.consistency_type,
+                                            binary=bool(args.binary_fast_path), fused_uncl=bool(args.fused_uncl),
+                                            voxel_ratio=args.voxel_ratio)
+    fecl_criterion = dycon_losses.FeCLoss(device=device, temperature=args.temp, gamma=args.gamma, use_focal=bool(args.use_focal), rampup_epochs=1500,
+                                          lambda_cross=float(args.use_teacher_loss), global_negatives=bool(args.global_negatives),
+                                          block_size=args.fecl_block_size or None, num_anchors=args.fecl_anchors or None,
+                                          hard_negatives=args.fecl_hard_negatives or None, memory_bank_size=args.memory_bank)
+    if fecl_state is not None:
+        fecl_criterion.load_state_dict(fecl_state)
     
+    audit = None
+    if args.sync_audit > 0:
+        audit = sync_audit.SyncAudit(include_cpu=device.type == 'cpu')
+        audit.start()
+
     for epoch_num in iterator:
+        if epoch_rng is not None and epoch_num == start_epoch:
+            checkpoint.restore_rng_state(epoch_rng)
+        epoch_rng = checkpoint.capture_rng_state()
 
         if args.s_beta is not None:
             beta = args.s_beta
@@ -196,126 +321,199 @@ if __name__ == "__main__":
             beta = dycon_losses.adaptive_beta(epoch=epoch_num, total_epochs=max_epoch, max_beta=args.beta_max, min_beta=args.beta_min)
 
         for i_batch, sampled_batch in enumerate(trainloader):
-            volume_batch, label_batch = sampled_batch['image'].cuda(), sampled_batch['label'].cuda()
-            
-            noise = torch.clamp(torch.randn_like(volume_batch) * 0.1, -0.2, 0.2)
-            ema_inputs = volume_batch + noise
+            if i_batch < skip_batches:
+                continue
+            if resume_rng is not None:
+                checkpoint.restore_rng_state(resume_rng)
+            resume_rng, skip_batches = None, 0
+            if audit is not None:
+                audit.mark_step(iter_num)
 
-            _, stud_logits, stud_features = model(volume_batch)
-            with torch.no_grad():
-                _, ema_logits, ema_features = ema_model(ema_inputs)
-           
-            stud_probs = F.softmax(stud_logits, dim=1)
-            ema_probs = F.softmax(ema_logits, dim=1)
             consistency_weight = get_current_consistency_weight(iter_num//150)
-            
-            # Calculate the supervised loss
-            loss_seg = F.cross_entropy(stud_logits[:labeled_bs], label_batch[:labeled_bs]) # 0.9020
-            loss_seg_dice = losses.dice_loss(stud_probs[:labeled_bs, 1, :, :, :], label_batch[:labeled_bs] == 1) # 0.9880
-            
-            B, C, _, _, _ = stud_features.shape
-            stud_embedding = stud_features.view(B, C, -1)
-            stud_embedding = torch.transpose(stud_embedding, 1, 2) 
-            stud_embedding = F.normalize(stud_embedding, dim=-1)  
-
-            ema_embedding = ema_features.view(B, C, -1)
-            ema_embedding = torch.transpose(ema_embedding, 1, 2)
-            ema_embedding = F.normalize(ema_embedding, dim=-1)
-
-            # Mask contrastive
-            # mask_con = F.avg_pool3d(label_batch.float(), kernel_size=args.feature_scaler*4, stride=args.feature_scaler*4)
-            mask_con = F.interpolate(label_batch.unsqueeze(1).float(), scale_factor=1/(args.feature_scaler * 4), mode='trilinear', align_corners=False).squeeze(1)  # torch.Size([8, 12, 12, 12])
-            mask_con = (mask_con > 0.5).float()
-            mask_con = mask_con.reshape(B, -1)
-            mask_con = mask_con.unsqueeze(1) 
-
-            # Plot sample images
-            if iter_num % 200 == 0:
-                # mask = mask_con[0].cpu().detach().numpy().reshape(14, 14, 10)
-                # plot_samples(stud_features[0].cpu().detach().numpy(), mask, iter_num)
-                path2save = os.path.join(snapshot_path, 'BraTS19_similarity')
-                os.makedirs(path2save, exist_ok=True)
-                monitor.monitor_similarity_distributions(stud_embedding, mask_con, epoch=iter_num, path_prefix=path2save)
-
-            # # Incorporate uncertainty mask into the contrastive loss
-            # p_gs = dycon_losses.gambling_softmax(stud_logits) 
-            # entropy = -torch.sum(p_gs * torch.log(p_gs + 1e-6), dim=1, keepdim=True) 
-            # entropy = F.interpolate(entropy, scale_factor=1/(args.feature_scaler * 4), mode='trilinear', align_corners=False).squeeze(1)
-            # gambling_uncertainty = entropy.view(B, -1) 
-
-            teacher_feat = ema_embedding if args.use_teacher_loss else None
-            f_loss = fecl_criterion(feat=stud_embedding[labeled_bs:],
-                                    mask=mask_con[labeled_bs:], 
-                                    teacher_feat=teacher_feat[labeled_bs:],
-                                    gambling_uncertainty=None, # gambling_uncertainty
-                                    epoch=epoch_num)
-            u_loss = uncl_criterion(stud_logits, ema_logits, beta)
-            consistency_loss = consistency_criterion(stud_probs[labeled_bs:], ema_probs[labeled_bs:]).mean()
-            
-            # Gather losses
-            loss = args.l_weight * (loss_seg + loss_seg_dice) + consistency_weight * consistency_loss + args.u_weight * (f_loss + u_loss)
-
-            # Check for NaN or Inf values
-            if torch.isnan(loss) or torch.isinf(loss):
-                logging.warning(f"NaN or Inf found in loss at iteration {iter_num}")
-                continue
 
+            # Gradients of the `accum_steps` micro-batches are accumulated before a single clipped SGD step.
+            # Under DDP the all-reduce only runs with the last micro-batch.
             optimizer.zero_grad()
-            loss.backward()
-
-            # Apply gradient clipping
-            torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
-            optimizer.step()
+            step_losses, dice_scores, hausdorff_scores = {}, [], []
+            nonfinite = torch.zeros((), device=device)
+            micro_batches = zip(split_micro_batches(sampled_batch['image'].to(device, non_blocking=True), accum_steps),
+                                split_micro_batches(sampled_batch['label'].to(device, non_blocking=True), accum_steps))
+            # HD95 runs on the host, so with --sync_free it is only computed for the logged iterations
+            compute_hd95 = not args.sync_free or (iter_num + 1) % args.log_interval == 0
+            for micro_step, (volume_batch, label_batch) in enumerate(micro_batches):
+                sync_context = model.no_sync() if distributed and micro_step < accum_steps - 1 else contextlib.nullcontext()
+                with sync_context:
+                    noise = torch.clamp(torch.randn_like(volume_batch) * 0.1, -0.2, 0.2)
+                    ema_inputs = volume_batch + noise
+
+                    _, stud_logits, stud_features = model(volume_batch)
+                    with torch.no_grad():
+                        _, ema_logits, ema_features = ema_model(ema_inputs)
+           
+                    # CE, Dice, UnCL and consistency from a single softmax of each network
+                    terms = objective(stud_logits, ema_logits, label_batch, beta)
+                    fg_probs = terms['fg_probs']
             
-            update_ema_variables(model, ema_model, args.ema_decay, iter_num)
-
-            iter_num = iter_num + 1
-             
-            writer.add_scalar('info/loss', loss, iter_num)
-            writer.add_scalar('info/f_loss', f_loss, iter_num)
-            writer.add_scalar('info/u_loss', u_loss, iter_num)
-            writer.add_scalar('info/loss_ce', loss_seg, iter_num)
-            writer.add_scalar('info/loss_dice', loss_seg_dice, iter_num) 
-            writer.add_scalar('info/consistency_loss', consistency_loss, iter_num)
-            writer.add_scalar('info/consistency_weight', consistency_weight, iter_num)
+                    # Calculate the supervised loss
+                    loss_seg = terms['loss_ce']
+                    loss_seg_dice = terms['loss_dice']
             
-            del noise, stud_embedding, ema_logits, ema_features, ema_probs, mask_con
-
-            # Batched Dice and HD95 metrics
-            with torch.no_grad():
-                outputs_bin = (stud_probs[:, 1, :, :, :] > 0.5).float()
-                dice_score = metrics.compute_dice(outputs_bin, label_batch)
-                H, W, D = stud_logits.shape[-3:]
-                max_dist = np.linalg.norm([H, W, D])
-                hausdorff_score = metrics.compute_hd95(outputs_bin, label_batch, max_dist)
-
-            writer.add_scalar('train/Dice', dice_score.mean().item(), iter_num)
-            writer.add_scalar('train/HD95', np.mean(hausdorff_score).item(), iter_num)
+                    B, C, _, _, _ = stud_features.shape
+                    stud_embedding = stud_features.view(B, C, -1)
+                    stud_embedding = torch.transpose(stud_embedding, 1, 2) 
+                    stud_embedding = F.normalize(stud_embedding, dim=-1)  
+
+                    ema_embedding = ema_features.view(B, C, -1)
+                    ema_embedding = torch.transpose(ema_embedding, 1, 2)
+                    ema_embedding = F.normalize(ema_embedding, dim=-1)
+
+                    # Mask contrastive
+                    # mask_con = F.avg_pool3d(label_batch.float(), kernel_size=args.feature_scaler*4, stride=args.feature_scaler*4)
+                    mask_con = F.interpolate(label_batch.unsqueeze(1).float(), scale_factor=1/(args.feature_scaler * 4), mode='trilinear', align_corners=False).squeeze(1)  # torch.Size([8, 12, 12, 12])
+                    mask_con = (mask_con > 0.5).float()
+                    mask_con = mask_con.reshape(B, -1)
+                    mask_con = mask_con.unsqueeze(1) 
+
+                    # Plot sample images
+                    if is_main and micro_step == 0 and iter_num % 200 == 0:
+                        # mask = mask_con[0].cpu().detach().numpy().reshape(14, 14, 10)
+                        # plot_samples(stud_features[0].cpu().detach().numpy(), mask, iter_num)
+                        path2save = os.path.join(snapshot_path, 'BraTS19_similarity')
+                        os.makedirs(path2save, exist_ok=True)
+                        monitor.monitor_similarity_distributions(stud_embedding, mask_con, epoch=iter_num, path_prefix=path2save)
+
+                    # # Incorporate uncertainty mask into the contrastive loss
+                    # p_gs = dycon_losses.gambling_softmax(stud_logits) 
+                    # entropy = -torch.sum(p_gs * torch.log(p_gs + 1e-6), dim=1, keepdim=True) 
+                    # entropy = F.interpolate(entropy, scale_factor=1/(args.feature_scaler * 4), mode='trilinear', align_corners=False).squeeze(1)
+                    # gambling_uncertainty = entropy.view(B, -1) 
+
+                    teacher_feat = ema_embedding[micro_labeled_bs:] if (args.use_teacher_loss or args.global_negatives or args.memory_bank > 0) else None
+                    f_loss = fecl_criterion(feat=stud_embedding[micro_labeled_bs:],
+                                            mask=mask_con[micro_labeled_bs:], 
+                                            teacher_feat=teacher_feat,
+                                            gambling_uncertainty=None, # gambling_uncertainty
+                                            epoch=epoch_num)
+                    u_loss = terms['u_loss']
+                    consistency_loss = terms['consistency_loss']
             
-            logging.info(
-                'Iteration %d : Loss : %03f, Loss_CE: %03f, Loss_Dice: %03f, UnCLoss: %03f, FeCLoss: %03f, mean_dice: %03f, mean_hd95: %03f' %
-                (iter_num, loss.item(), loss_seg.item(), loss_seg_dice.item(), u_loss.item(), f_loss.item(), dice_score.mean().item(), np.mean(hausdorff_score).item()))
+                    # Gather losses
+                    loss = args.l_weight * (loss_seg + loss_seg_dice) + consistency_weight * consistency_loss + args.u_weight * (f_loss + u_loss)
+
+                    # Check for NaN or Inf values (on any rank, so that all ranks skip the step together)
+                    if args.sync_free:
+                        # Kept on the device: every micro-batch runs and the step is masked out below
+                        nonfinite = torch.maximum(nonfinite, (~torch.isfinite(loss)).float())
+                    else:
+                        nonfinite = (~torch.isfinite(loss)).float()
+                    if distributed:
+                        dist.all_reduce(nonfinite, op=dist.ReduceOp.MAX)
+
+                    # Every rank runs the backward of the forward it made, even on a skipped step: DDP
+                    # (find_unused_parameters=True) expects the reduction of this forward to complete.
+                    # The non-finite gradients are never applied and are cleared by the next zero_grad.
+                    (loss / accum_steps).backward()
+                    if not args.sync_free and nonfinite.item():
+                        break
+
+                micro_losses = {'info/loss': loss, 'info/f_loss': f_loss, 'info/u_loss': u_loss, 'info/loss_ce': loss_seg,
+                                'info/loss_dice': loss_seg_dice, 'info/consistency_loss': consistency_loss}
+                for tag, value in micro_losses.items():
+                    step_losses[tag] = step_losses.get(tag, 0) + value.detach() / accum_steps
+
+                del noise, stud_embedding, ema_logits, ema_features, terms, mask_con
+
+                # Batched Dice and HD95 metrics
+                with torch.no_grad():
+                    outputs_bin = (fg_probs > 0.5).float()
+                    dice_scores.append(metrics.compute_dice(outputs_bin, label_batch))
+                    H, W, D = stud_logits.shape[-3:]
+                    max_dist = np.linalg.norm([H, W, D])
+                    if compute_hd95:
+                        hausdorff_scores.extend(metrics.compute_hd95(outputs_bin, label_batch, max_dist))
+
+            if args.sync_free:
+                # The update and the EMA are selected on the device; skipped steps show up as 'info/skipped'
+                skip = nonfinite > 0
+                torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
+                util.masked_step(optimizer, skip)
+                update_ema_variables(net, ema_model, args.ema_decay, iter_num, skip=skip)
+            else:
+                if nonfinite.item():
+                    logging.warning(f"NaN or Inf found in loss at iteration {iter_num}")
+                    continue
+
+                # Apply gradient clipping
+                torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
+                optimizer.step()
+
+                update_ema_variables(net, ema_model, args.ema_decay, iter_num)
+            if distributed:
+                util.average_buffers(ema_model)
 
-            if iter_num > 0 and iter_num % 200 == 0:
+            iter_num = iter_num + 1
+            dice_score = torch.cat(dice_scores)
+
+            # Buffered on-device; written every `log_interval` iterations without per-step `.item()` syncs
+            if is_main:
+                step_scalars = dict(step_losses, **{
+                    'info/consistency_weight': consistency_weight,
+                    'train/Dice': dice_score.mean(),
+                })
+                if hausdorff_scores:
+                    step_scalars['train/HD95'] = np.mean(hausdorff_scores).item()
+                if args.sync_free:
+                    step_scalars['info/skipped'] = nonfinite
+                scalars.add(iter_num, step_scalars)
+
+            if audit is not None and (len(audit.per_step) >= args.sync_audit or iter_num >= max_iterations):
+                audit.stop()
+                if is_main:
+                    logging.info(audit.report())
+                audit = None
+
+            if is_main and iter_num > 0 and iter_num % 200 == 0:
+                scalars.flush()
                 model.eval()
-                avg_metric = test_3d_patch.var_all_case_BraTS19(model, args.root_dir, num_classes=args.num_classes, patch_size=patch_size, stride_xy=64, stride_z=64)
+                avg_metric = test_3d_patch.var_all_case_BraTS19(net, args.root_dir, num_classes=args.num_classes, patch_size=patch_size, stride_xy=64, stride_z=64)
                 if avg_metric > best_performance:
                     best_performance = round(avg_metric, 4)
 
-                    save_mode_path = os.path.join(snapshot_path, 'iter_{}_dice_{}.pth'.format( iter_num, round(best_performance, 4)))
-                    save_best = os.path.join(snapshot_path, '{}_best_model.pth'.format(args.model))
-                    torch.save(model.state_dict(), save_mode_path)
-                    torch.save(model.state_dict(), save_best)
+                    ckpt_manager.save_weights(net.state_dict(), 'iter_{}_dice_{}.pth'.format(iter_num, best_performance),
+                                              best_name='{}_best_model.pth'.format(args.model))
 
                 writer.add_scalar('info/Dice', avg_metric, iter_num)
                 writer.add_scalar('info/Best_dice', best_performance, iter_num)
                 logging.info('Iteration %d : Dice: %03f Best_dice: %03f' % (iter_num, avg_metric, best_performance))
                 model.train()
-
-            if iter_num % 3000 == 0:
-                save_mode_path = os.path.join(snapshot_path, 'iter_' + str(iter_num) + '.pth')
-                torch.save(model.state_dict(), save_mode_path)
-                logging.info("save model to {}".format(save_mode_path))
+            if distributed and iter_num > 0 and iter_num % 200 == 0:
+                # Keep the other ranks (and their collective timeouts) waiting for rank 0's validation
+                dist.barrier()
+
+            if iter_num % args.ckpt_interval == 0:
+                # A finished epoch is stored as the start of the next one
+                epoch_done = i_batch + 1 == len(trainloader)
+                saved_epoch_rng = checkpoint.capture_rng_state() if epoch_done else epoch_rng
+                saved_rng = None if epoch_done else checkpoint.capture_rng_state(torch_only=True)
+                saved_fecl = checkpoint.to_host(fecl_criterion.state_dict())
+                if distributed:
+                    saved_epoch_rng, saved_rng = util.all_gather_object(saved_epoch_rng), util.all_gather_object(saved_rng)
+                    saved_fecl = util.all_gather_object(saved_fecl)
+                if is_main:
+                    save_mode_path = ckpt_manager.save_state({
+                        'iter_num': iter_num,
+                        'epoch': epoch_num + 1 if epoch_done else epoch_num,
+                        'i_batch': 0 if epoch_done else i_batch + 1,
+                        'best_performance': best_performance,
+                        'model': net.state_dict(),
+                        'ema_model': ema_model.state_dict(),
+                        'optimizer': optimizer.state_dict(),
+                        'epoch_rng': saved_epoch_rng,
+                        'rng': saved_rng,
+                        'fecl': saved_fecl,
+                        'args': vars(args),
+                    }, iter_num)
+                    logging.info("save checkpoint to {}".format(save_mode_path))
 
             if iter_num >= max_iterations:
                 break
@@ -324,6 +522,10 @@ if __name__ == "__main__":
             iterator.close()
             break
             
-    writer.close()
+    scalars.close()
+    ckpt_manager.close()
+    if is_main:
+        writer.close()
+    util.distributed_cleanup()
     print("Training Finished!")
 
@@ -0,0 +1,188 @@
+import os
+import re
+import glob
+import queue
+import random
+import shutil
+import logging
+import threading
+import numpy as np
+import torch
+
+
+def capture_rng_state(torch_only=False):
+    """
+    Return the state of the random generators used during training.
+
+    Args:
+        torch_only (bool): Only capture the torch CPU/CUDA generators. Python and NumPy are only consumed
+            by the data pipeline in the main process, which is replayed when resuming mid-epoch.
+    """
+    state = {'torch': torch.get_rng_state()}
+    if not torch_only:
+        state['python'] = random.getstate()
+        state['numpy'] = np.random.get_state()
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def restore_rng_state(state):
+    """Restore generator states captured by `capture_rng_state`."""
+    if 'python' in state:
+        random.setstate(state['python'])
+    if 'numpy' in state:
+        np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def to_host(obj):
+    """
+    Recursively copy every tensor of a (nested) state to host memory.
+
+    The copy is taken synchronously, so training can keep updating the live tensors while
+    the snapshot is serialised in the background.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: to_host(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_host(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    """`torch.save` to a temporary file in the same directory, then rename it over `path`."""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def atomic_link(src, dst):
+    """Point `dst` at the content of `src` with a hard link (copy if the filesystem has none), atomically."""
+    tmp_path = dst + '.tmp'
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+def load_state(path, map_location='cpu'):
+    """Load a full training checkpoint written by `CheckpointManager.save_state`."""
+    return torch.load(path, map_location=map_location, weights_only=False)
+
+
+def load_weights(path, map_location='cpu'):
+    """Load a model state_dict from either a weights file or a full training checkpoint."""
+    state = load_state(path, map_location=map_location)
+    if isinstance(state, dict) and 'model' in state and isinstance(state['model'], dict):
+        state = state['model']
+    return state
+
+
+def _iter_of(path):
+    match = re.search(r'iter_(\d+)', os.path.basename(path))
+    return int(match.group(1)) if match else -1
+
+
+class CheckpointManager(object):
+    """
+    Writes checkpoints from a background thread with atomic renames and a retention policy.
+
+    Two families of files are kept in `snapshot_path`:
+      - full training states `checkpoint_iter_{n}.pth` (model, EMA teacher, optimizer, RNG and
+        sampler position) used by `--resume`;
+      - model weights `iter_{n}_dice_{d}.pth`, with `{model}_best_model.pth` hard-linked to the
+        latest best one instead of being written a second time.
+
+    Every save takes a host-memory snapshot immediately and returns; the files are written in
+    submission order by a single worker thread.
+
+    Args:
+        snapshot_path (str): Directory holding the checkpoints.
+        keep_last (int): Number of files kept per family, older ones are removed (0 keeps everything).
+        background (bool): Write from a worker thread. If False, saves block until written.
+    """
+    STATE_PATTERN = 'checkpoint_iter_*.pth'
+    WEIGHTS_PATTERN = 'iter_*_dice_*.pth'
+
+    def __init__(self, snapshot_path, keep_last=3, background=True):
+        self.snapshot_path = snapshot_path
+        self.keep_last = keep_last
+        self._queue = None
+        self._worker = None
+        if background:
+            self._queue = queue.Queue()
+            self._worker = threading.Thread(target=self._run, daemon=True)
+            self._worker.start()
+
+    def save_state(self, state, iter_num):
+        """Snapshot a full training state and write it as `checkpoint_iter_{iter_num}.pth`."""
+        path = os.path.join(self.snapshot_path, 'checkpoint_iter_{}.pth'.format(iter_num))
+        self._submit(self._write, to_host(state), path, self.STATE_PATTERN, None)
+        return path
+
+    def save_weights(self, state_dict, filename, best_name=None):
+        """Snapshot model weights as `filename` and optionally hard-link them as `best_name`."""
+        path = os.path.join(self.snapshot_path, filename)
+        best_path = os.path.join(self.snapshot_path, best_name) if best_name is not None else None
+        self._submit(self._write, to_host(state_dict), path, self.WEIGHTS_PATTERN, best_path)
+        return path
+
+    def latest(self):
+        """Path of the most recent full training state, or None."""
+        paths = glob.glob(os.path.join(self.snapshot_path, self.STATE_PATTERN))
+        return max(paths, key=_iter_of) if paths else None
+
+    def wait(self):
+        """Block until every submitted checkpoint is on disk."""
+        if self._queue is not None:
+            self._queue.join()
+
+    def close(self):
+        self.wait()
+        if self._worker is not None:
+            self._queue.put(None)
+            self._worker.join()
+            self._worker = None
+
+    def _submit(self, fn, *args):
+        if self._queue is not None:
+            self._queue.put((fn, args))
+        else:
+            fn(*args)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    break
+                fn, args = job
+                fn(*args)
+            except Exception:
+                logging.exception("Failed to write checkpoint")
+            finally:
+                self._queue.task_done()
+
+    def _write(self, obj, path, pattern, best_path):
+        atomic_save(obj, path)
+        if best_path is not None:
+            atomic_link(path, best_path)
+        self._apply_retention(pattern)
+
+    def _apply_retention(self, pattern):
+        if self.keep_last <= 0:
+            return
+        paths = sorted(glob.glob(os.path.join(self.snapshot_path, pattern)), key=_iter_of)
+        for path in paths[:-self.keep_last]:
+            os.remove(path)
@@ -3,6 +3,7 @@ import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.distributed as dist
 
 
 def adaptive_beta(epoch, total_epochs, max_beta=5.0, min_beta=0.5):
@@ -88,11 +89,14 @@ class UnCLoss(nn.Module):
     Returns:
         Tensor: A scalar tensor representing the mean uncertainty-aware consistency loss.
     """
-    def __init__(self):
+    def __init__(self, fused=False):
         super(UnCLoss, self).__init__()
+        self.fused = fused
 
     def forward(self, s_logits, t_logits, beta):
         EPS = 1e-6
+        if self.fused:
+            return FusedUnCL.apply(s_logits, t_logits, beta, EPS)
 
         # Compute student softmax probabilities and their entropy.
         p_s = F.softmax(s_logits, dim=1)  # (B, C, H, W, D)
@@ -113,10 +117,630 @@ class UnCLoss(nn.Module):
         loss = (p_s - p_t)**2 / (exp_H_s + exp_H_t)
 
         # Sum the differences over the class dimension, add a penalty for high entropy, and average.
-        loss = torch.mean(loss.sum(dim=1) + beta * (H_s + H_t))
+        loss = torch.mean(loss.sum(dim=1) + beta * (H_s + H_t).squeeze(1))
 
         return loss.mean()
 
+def _uncl_probs(logits, eps):
+    """Probabilities, the log term of the entropy and the entropy (B, H, W, D) of UnCL."""
+    if eps:
+        p = F.softmax(logits, dim=1)
+        log_p = torch.log(p + eps)
+    else:
+        log_p = F.log_softmax(logits, dim=1)
+        p = log_p.exp()
+    return p, log_p, -torch.sum(p * log_p, dim=1)
+
+class FusedUnCL(torch.autograd.Function):
+    """
+    UnCLoss as a single autograd node that only saves the two logit tensors.
+
+    The forward pass computes the loss one volume at a time and keeps none of the probabilities,
+    entropies or weights; the backward pass recomputes them per volume and applies the closed-form
+    gradient. With W = exp(β H_s) + exp(β H_t), S = Σ_c (p_s - p_t)^2 and per-voxel loss
+    S / W + β (H_s + H_t):
+        dL/dp_s = 2 (p_s - p_t) / W + β (1 - S exp(β H_s) / W^2) dH_s/dp_s,
+        dH/dp_c = -(log(p_c + eps) + p_c / (p_c + eps)),
+    (symmetrically for the teacher) followed by the softmax Jacobian dL/dz = p (g - Σ_c p_c g_c).
+
+    Args:
+        s_logits (Tensor): Student logits (B, C, H, W, D).
+        t_logits (Tensor): Teacher logits (B, C, H, W, D).
+        beta (float): Entropy scaling.
+        eps (float): UnCLoss uses log(p + 1e-6); 0 uses the exact log-softmax.
+
+    Returns:
+        Tensor: The scalar loss, equal to `UnCLoss()(s_logits, t_logits, beta)` for eps=1e-6.
+    """
+    @staticmethod
+    def forward(ctx, s_logits, t_logits, beta, eps=1e-6):
+        ctx.save_for_backward(s_logits, t_logits)
+        ctx.beta, ctx.eps = beta, eps
+        dtype = torch.promote_types(s_logits.dtype, torch.float32)
+        total = torch.zeros((), dtype=dtype, device=s_logits.device)
+        for s_b, t_b in zip(s_logits.to(dtype).split(1), t_logits.to(dtype).split(1)):
+            p_s, _, H_s = _uncl_probs(s_b, eps)
+            p_t, _, H_t = _uncl_probs(t_b, eps)
+            weight = torch.exp(beta * H_s) + torch.exp(beta * H_t)
+            total += torch.sum(torch.sum((p_s - p_t) ** 2, dim=1) / weight + beta * (H_s + H_t))
+        return (total / (s_logits.numel() // s_logits.shape[1])).to(s_logits.dtype)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        s_logits, t_logits = ctx.saved_tensors
+        beta, eps = ctx.beta, ctx.eps
+        need_s, need_t = ctx.needs_input_grad[:2]
+        dtype = torch.promote_types(s_logits.dtype, torch.float32)
+        scale = grad_output.to(dtype) / (s_logits.numel() // s_logits.shape[1])
+        grads_s, grads_t = [], []
+        for s_b, t_b in zip(s_logits.to(dtype).split(1), t_logits.to(dtype).split(1)):
+            p_s, log_s, H_s = _uncl_probs(s_b, eps)
+            p_t, log_t, H_t = _uncl_probs(t_b, eps)
+            exp_s, exp_t = torch.exp(beta * H_s), torch.exp(beta * H_t)
+            weight = exp_s + exp_t
+            diff = p_s - p_t
+            coef = torch.sum(diff ** 2, dim=1) / weight ** 2
+            diff = 2 * diff / weight.unsqueeze(1)
+            for need, p, log_p, exp_H, sign, grads in ((need_s, p_s, log_s, exp_s, 1, grads_s), (need_t, p_t, log_t, exp_t, -1, grads_t)):
+                if not need:
+                    continue
+                dH = log_p + (p / (p + eps) if eps else 1)
+                g = sign * diff - (beta * (1 - coef * exp_H)).unsqueeze(1) * dH
+                grads.append(scale * p * (g - torch.sum(p * g, dim=1, keepdim=True)))
+        grad_s = torch.cat(grads_s).to(s_logits.dtype) if need_s else None
+        grad_t = torch.cat(grads_t).to(t_logits.dtype) if need_t else None
+        return grad_s, grad_t, None, None
+
+def entropy_bins(entropy, num_bins):
+    """Index of the equal-width bin of the normalised entropy (in [0, 1]), (B, H, W, D) long."""
+    return (entropy * num_bins).long().clamp_(0, num_bins - 1)
+
+def binary_entropy_bins(logit_diff, num_bins):
+    """
+    `entropy_bins` of the two-class entropy H(sigmoid(d)) / log 2, computed from |d| alone.
+
+    The binary entropy decreases with |d|, so the bin edges k / num_bins map to thresholds on |d|
+    (found once by bisection) and no full-resolution entropy has to be evaluated.
+    """
+    def entropy(d):
+        p = 1 / (1 + math.exp(-d))
+        return -(p * math.log(p) + (1 - p) * math.log(1 - p)) / math.log(2) if 0 < p < 1 else 0.0
+
+    thresholds = []
+    for k in range(num_bins - 1, 0, -1):  # ascending |d| thresholds
+        lo, hi = 0.0, 50.0
+        for _ in range(60):
+            mid = (lo + hi) / 2
+            lo, hi = (mid, hi) if entropy(mid) > k / num_bins else (lo, mid)
+        thresholds.append(hi)
+    thresholds = torch.tensor(thresholds, dtype=logit_diff.dtype, device=logit_diff.device)
+    return num_bins - 1 - torch.bucketize(logit_diff.abs(), thresholds)
+
+def stratified_voxel_sample(bins, ratio, classes=None, num_bins=4, floor=0.1):
+    """
+    Poisson-sample voxels of a batch, stratified by teacher entropy and teacher-predicted class.
+
+    Voxels are grouped into strata by the bin of their normalised teacher entropy H / log C
+    (`entropy_bins`/`binary_entropy_bins`, `num_bins` equal bins on [0, 1]) and, if `classes` is
+    given, by the teacher argmax. The expected sample size, ratio * #voxels, is allocated to stratum h
+    in proportion to N_h (c_h + floor), c_h being the centre of its entropy bin, i.e. the inclusion
+    probability of a stratum grows with its entropy. UnCL and the consistency terms are largest on
+    uncertain voxels, so this samples them more densely than the confident background (strata whose
+    probability would exceed 1 are taken whole and the rest is spread over the others). Every voxel
+    is then kept independently with the inclusion probability π of its stratum; weighting a kept
+    voxel by 1/π gives unbiased (Horvitz-Thompson) estimates of voxel sums.
+
+    Args:
+        bins (Tensor): Teacher entropy bin (B, H, W, D) long, in [0, num_bins).
+        ratio (float): Expected fraction of voxels kept, in (0, 1].
+        classes (Tensor, optional): Teacher-predicted class (B, H, W, D).
+        num_bins (int): Number of entropy bins (1 with `classes=None`: uniform sampling).
+        floor (float): Added to the bin centre of every stratum, so that confident strata are still
+            sampled.
+
+    Returns:
+        (Tensor, Tensor): Indices of the kept voxels into the flattened (B * H * W * D) batch, and
+        their inclusion probabilities.
+    """
+    with torch.no_grad():
+        strata = bins.flatten()
+        if classes is not None:
+            strata = strata + num_bins * classes.flatten()
+        counts = torch.bincount(strata).tolist()
+        weights = [(h % num_bins + 0.5) / num_bins + floor for h in range(len(counts))]
+
+        # π_h = c w_h with Σ_h N_h min(1, c w_h) = budget; saturated strata are taken whole.
+        budget, open_strata = ratio * strata.numel(), [h for h, n in enumerate(counts) if n > 0]
+        probs = [0.0] * len(counts)
+        while open_strata:
+            scale = budget / sum(counts[h] * weights[h] for h in open_strata)
+            full = [h for h in open_strata if scale * weights[h] >= 1]
+            if not full:
+                for h in open_strata:
+                    probs[h] = scale * weights[h]
+                break
+            for h in full:
+                probs[h] = 1.0
+                budget -= counts[h]
+            open_strata = [h for h in open_strata if h not in full]
+
+        pi = torch.tensor(probs, device=strata.device)[strata]
+        index = torch.nonzero(torch.rand_like(pi) < pi).squeeze(1)
+        return index, pi[index]
+
+class DyCONObjective(nn.Module):
+    """
+    The logit-level terms of the DyCON objective (CE, Dice, UnCL and consistency) computed from a
+    single log-softmax per network.
+
+    The student and teacher logits are turned into log-probabilities, probabilities and entropies
+    once, and every term is derived from these shared intermediates instead of each loss running its
+    own softmax/log over the full-resolution (B, C, H, W, D) volumes:
+      - CE is the NLL of the student log-probabilities on the labeled part of the batch.
+      - Dice is `losses.dice_loss` on the foreground probability of the labeled part.
+      - UnCL is `UnCLoss` on the whole batch, with the exact entropies -Σ p log p (UnCLoss uses
+        log(p + 1e-6), a difference below C * 1e-6 per voxel).
+      - The consistency term is `losses.softmax_mse_loss` / `losses.softmax_kl_loss` applied to the
+        probabilities of the unlabeled part, as the trainers call them, i.e. the softmax of the
+        probabilities. This is kept so that the objective is unchanged.
+
+    With `binary=True` (two-class logits only) every term is computed from the logit difference
+    d = logits[:, 1] - logits[:, 0] on single-channel maps: p_1 = sigmoid(d), log p_1 = logsigmoid(d),
+    H = softplus(d) - p_1 d, Σ_c (p_s - p_t)^2 = 2 (p_s1 - p_t1)^2 and softmax(p)_1 = sigmoid(2 p_1 - 1).
+    The terms are the same functions of the logits as in the two-channel path.
+
+    With `fused_uncl=True` UnCL is computed by `FusedUnCL` (exact entropies), which keeps only the
+    logits for backward instead of the entropies, weights and differences of the UnCL graph.
+
+    With `voxel_ratio < 1` UnCL and the consistency term are estimated on the voxels drawn by
+    `stratified_voxel_sample` (exact entropies), each weighted by the inverse of its inclusion
+    probability, so that both estimates are unbiased for the full-volume means (as are their
+    gradients, since the sample only depends on the teacher). CE and Dice stay full-volume.
+
+    Args:
+        labeled_bs (int): Number of labeled volumes at the front of the batch.
+        consistency_type (str): 'mse' or 'kl'.
+        binary (bool): Use the two-class closed forms.
+        fused_uncl (bool): Compute UnCL with `FusedUnCL`.
+        voxel_ratio (float): Expected fraction of voxels UnCL and consistency are evaluated on.
+        voxel_bins (int): Number of teacher-entropy strata of the voxel sample (0: uniform sampling,
+            without entropy or class strata).
+    """
+    def __init__(self, labeled_bs, consistency_type='mse', binary=False, fused_uncl=False, voxel_ratio=1.0, voxel_bins=4):
+        super(DyCONObjective, self).__init__()
+        if consistency_type not in ('mse', 'kl'):
+            raise ValueError("consistency_type must be 'mse' or 'kl', got '{}'".format(consistency_type))
+        self.labeled_bs = labeled_bs
+        self.consistency_type = consistency_type
+        self.binary = binary
+        self.fused_uncl = fused_uncl
+        if not 0 < voxel_ratio <= 1:
+            raise ValueError("voxel_ratio must be in (0, 1], got {}".format(voxel_ratio))
+        self.voxel_ratio = voxel_ratio
+        self.voxel_bins = voxel_bins
+
+    def sampled_terms(self, s_logits, t_logits, beta):
+        """UnCL and consistency estimated on a stratified voxel sample (see the class docstring)."""
+        B, C = s_logits.shape[:2]
+        V = s_logits[0, 0].numel()
+        with torch.no_grad():
+            if self.voxel_bins == 0:
+                bins, classes = torch.zeros_like(t_logits[:, 0], dtype=torch.long), None
+            elif self.binary:
+                bins = binary_entropy_bins(t_logits[:, 1] - t_logits[:, 0], self.voxel_bins)
+                classes = (t_logits[:, 1] > t_logits[:, 0]).long()
+            else:
+                log_p = F.log_softmax(t_logits, dim=1)
+                bins = entropy_bins(-torch.sum(log_p.exp() * log_p, dim=1) / math.log(C), self.voxel_bins)
+                classes = log_p.argmax(dim=1)
+        index, pi = stratified_voxel_sample(bins, self.voxel_ratio, classes, max(self.voxel_bins, 1))
+        b, v = index // V, index % V
+        s_rows = s_logits.reshape(B, C, V)[b, :, v]  # (n, C)
+        t_rows = t_logits.reshape(B, C, V)[b, :, v]
+
+        log_p_s = F.log_softmax(s_rows, dim=1)
+        p_s = log_p_s.exp()
+        log_p_t = F.log_softmax(t_rows, dim=1)
+        p_t = log_p_t.exp()
+        H_s = -torch.sum(p_s * log_p_s, dim=1)
+        H_t = -torch.sum(p_t * log_p_t, dim=1)
+        uncl = torch.sum((p_s - p_t) ** 2, dim=1) / (torch.exp(beta * H_s) + torch.exp(beta * H_t)) + beta * (H_s + H_t)
+        u_loss = torch.sum(uncl / pi) / (B * V)
+
+        unlabeled = b >= self.labeled_bs
+        p_s, p_t = p_s[unlabeled], p_t[unlabeled]
+        if self.consistency_type == 'mse':
+            consistency = torch.mean((F.softmax(p_s, dim=1) - F.softmax(p_t, dim=1)) ** 2, dim=1)
+        else:
+            consistency = F.kl_div(F.log_softmax(p_s, dim=1), F.softmax(p_t, dim=1), reduction='none').mean(dim=1)
+        consistency_loss = torch.sum(consistency / pi[unlabeled]) / ((B - self.labeled_bs) * V)
+        return u_loss, consistency_loss
+
+    def forward(self, s_logits, t_logits, labels, beta):
+        """
+        Args:
+            s_logits (Tensor): Student logits (B, C, H, W, D).
+            t_logits (Tensor): Teacher logits (B, C, H, W, D), no gradient is sent to them.
+            labels (Tensor): Labels (B, H, W, D); only the first `labeled_bs` are used.
+            beta (float): Entropy scaling of UnCL.
+
+        Returns:
+            dict: 'loss_ce', 'loss_dice', 'u_loss', 'consistency_loss' (scalars) and 'fg_probs'
+            (the student foreground probability (B, H, W, D), for metrics).
+        """
+        lbs = self.labeled_bs
+        if self.binary:
+            if s_logits.shape[1] != 2:
+                raise ValueError("The binary objective needs two-class logits, got {} channels".format(s_logits.shape[1]))
+            d_s = s_logits[:, 1] - s_logits[:, 0]
+            p_s = torch.sigmoid(d_s)
+            with torch.no_grad():
+                d_t = t_logits[:, 1].detach() - t_logits[:, 0].detach()
+                p_t = torch.sigmoid(d_t)
+            loss_ce = F.binary_cross_entropy_with_logits(d_s[:lbs], labels[:lbs].to(d_s.dtype))
+            fg_s = p_s
+        else:
+            log_p_s = F.log_softmax(s_logits, dim=1)
+            p_s = log_p_s.exp()
+            with torch.no_grad():
+                log_p_t = F.log_softmax(t_logits.detach(), dim=1)
+                p_t = log_p_t.exp()
+            loss_ce = F.nll_loss(log_p_s[:lbs], labels[:lbs])
+            fg_s = p_s[:, 1]
+
+        # Dice on the labeled part.
+        score, target = fg_s[:lbs], (labels[:lbs] == 1).float()
+        intersect = torch.sum(score * target)
+        loss_dice = 1 - (2 * intersect + 1e-5) / (torch.sum(score * score) + torch.sum(target) + 1e-5)
+
+        if self.voxel_ratio < 1:
+            u_loss, consistency_loss = self.sampled_terms(s_logits, t_logits.detach(), beta)
+            return {'loss_ce': loss_ce, 'loss_dice': loss_dice, 'u_loss': u_loss,
+                    'consistency_loss': consistency_loss, 'fg_probs': fg_s}
+
+        # UnCL on the whole batch.
+        if self.fused_uncl:
+            u_loss = FusedUnCL.apply(s_logits, t_logits.detach(), beta, 0.0)
+        else:
+            if self.binary:
+                H_s = F.softplus(d_s) - p_s * d_s
+                H_t = F.softplus(d_t) - p_t * d_t
+                sq_diff = 2 * (p_s - p_t) ** 2
+            else:
+                H_s = -torch.sum(p_s * log_p_s, dim=1)  # (B, H, W, D)
+                H_t = -torch.sum(p_t * log_p_t, dim=1)
+                sq_diff = torch.sum((p_s - p_t) ** 2, dim=1)
+            weight = torch.exp(beta * H_s) + torch.exp(beta * H_t)
+            u_loss = torch.mean(sq_diff / weight + beta * (H_s + H_t))
+
+        # Consistency on the unlabeled part.
+        if self.binary:
+            a_s, a_t = 2 * p_s[lbs:] - 1, 2 * p_t[lbs:] - 1
+            if self.consistency_type == 'mse':
+                consistency_loss = torch.mean((torch.sigmoid(a_s) - torch.sigmoid(a_t)) ** 2)
+            else:
+                # F.kl_div(..., reduction='mean') averages over the two channels as well.
+                q = torch.sigmoid(a_t)
+                kl = q * (F.logsigmoid(a_t) - F.logsigmoid(a_s)) + (1 - q) * (F.logsigmoid(-a_t) - F.logsigmoid(-a_s))
+                consistency_loss = 0.5 * torch.mean(kl)
+        elif self.consistency_type == 'mse':
+            consistency_loss = torch.mean((F.softmax(p_s[lbs:], dim=1) - F.softmax(p_t[lbs:], dim=1)) ** 2)
+        else:
+            consistency_loss = F.kl_div(F.log_softmax(p_s[lbs:], dim=1), F.softmax(p_t[lbs:], dim=1), reduction='mean')
+
+        return {'loss_ce': loss_ce, 'loss_dice': loss_dice, 'u_loss': u_loss,
+                'consistency_loss': consistency_loss, 'fg_probs': fg_s}
+
+class CrossNegativeSum(torch.autograd.Function):
+    """
+    Sum of exponentiated similarities between anchors and an external set of (detached) negative keys,
+    computed over chunks of keys so that no (N, M) similarity matrix is ever kept in memory.
+
+    For anchor i of batch element b and key k:
+        s_bik = <feat_bi, keys_k> / τ,  m_bk = max_i s_bik (detached, as the in-batch column max)
+        out_bi = Σ_k [label_bi != key_label_k] * exp(s_bik - m_bk)
+    The backward pass recomputes each chunk, d out_bi / d feat_bi = Σ_k w_bik * exp(s_bik - m_bk) * keys_k / τ.
+
+    Args:
+        feat (Tensor): Anchor embeddings of shape (B, N, D).
+        keys (Tensor): Key embeddings of shape (M, D), no gradient is returned for them.
+        labels (Tensor): Anchor labels of shape (B, N).
+        key_labels (Tensor): Key labels of shape (M,).
+        temperature (float): Scaling factor τ.
+        chunk_size (int): Number of keys processed at once.
+
+    Returns:
+        Tensor: Negative sums of shape (B, N).
+    """
+    @staticmethod
+    def _chunks(feat, keys, labels, key_labels, temperature, chunk_size):
+        for start in range(0, keys.shape[0], chunk_size):
+            key_chunk = keys[start:start + chunk_size]
+            logits = torch.matmul(feat, key_chunk.t()) / temperature  # (B, N, c)
+            logits = logits - logits.max(dim=1, keepdim=True)[0]
+            neg_mask = labels.unsqueeze(-1) != key_labels[start:start + chunk_size]
+            yield key_chunk, torch.exp(logits) * neg_mask
+
+    @staticmethod
+    def forward(ctx, feat, keys, labels, key_labels, temperature, chunk_size):
+        ctx.save_for_backward(feat, keys, labels, key_labels)
+        ctx.temperature, ctx.chunk_size = temperature, chunk_size
+        out = feat.new_zeros(feat.shape[:2])
+        for _, exp_logits in CrossNegativeSum._chunks(feat, keys, labels, key_labels, temperature, chunk_size):
+            out += exp_logits.sum(dim=-1)
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        feat, keys, labels, key_labels = ctx.saved_tensors
+        grad_feat = torch.zeros_like(feat)
+        for key_chunk, exp_logits in CrossNegativeSum._chunks(feat, keys, labels, key_labels, ctx.temperature, ctx.chunk_size):
+            grad_feat += torch.matmul(exp_logits * grad_out.unsqueeze(-1), key_chunk)
+        return grad_feat / ctx.temperature, None, None, None, None, None
+
+
+def _tiles(anchors, keys, temperature, block_size, symmetric):
+    """Yield (anchor slice, key slice, logits tile) of anchors @ keys^T / τ, zeroing self-similarities if `symmetric`."""
+    for i0 in range(0, anchors.shape[1], block_size):
+        rows = slice(i0, i0 + block_size)
+        for j0 in range(0, keys.shape[1], block_size):
+            cols = slice(j0, j0 + block_size)
+            logits = torch.matmul(anchors[:, rows], keys[:, cols].transpose(1, 2)) / temperature
+            if symmetric and i0 == j0:
+                logits.diagonal(dim1=1, dim2=2).zero_()
+            yield rows, cols, logits
+
+
+class BlockwiseFeCL(torch.autograd.Function):
+    """
+    Student term of `FeCLoss` computed over (anchor, key) tiles of size `block_size`, so memory is O(B·N)
+    plus one B×block×block tile instead of several B×N×N matrices. Loss and gradients match the dense
+    implementation: with S_ij = <f_i, f_j> / τ (S_ii = 0), m_j = max_i S_ij and E_ij = exp(S_ij - m_j),
+
+        n_i = Σ_j [y_i != y_j] E_ij (+ extra_neg_i),   D_ij = E_ij / (E_ij + n_i + ε)
+        loss = mean_i  c_i · Σ_{j != i, y_j = y_i} g(D_ij) / (#positives_i - 1)
+
+    where g(D) = -log(D + ε), times (1 - D)^γ for focal pairs (D < pos_thresh), and c_i the optional
+    per-anchor weights. The forward runs three passes over the tiles (column max, negative sum, loss);
+    the backward recomputes the tiles and uses grad_S = G, grad_F = (G + G^T) F / τ, with
+
+        G_ij = E_ij · (a_ij (n_i + ε) / Z_ij² + h_i [y_i != y_j]),   Z_ij = E_ij + n_i + ε,
+        a_ij = c_i g'(D_ij) for positive pairs,   h_i = dL/dn_i = -Σ_j a_ij E_ij / Z_ij².
+
+    Args:
+        feat (Tensor): Student embeddings of shape (B, N, D).
+        labels (Tensor): Patch labels of shape (B, N).
+        extra_neg (Tensor or None): Additional negative sums of shape (B, N), e.g. from `CrossNegativeSum`.
+        weights (Tensor or None): Per-anchor weights of shape (B, N) (gambling uncertainty).
+        temperature (float): Scaling factor τ.
+        gamma (float): Focal exponent.
+        pos_thresh (float): Positive pairs with D below this threshold are focal-weighted.
+        use_focal (bool): Apply the focal weighting.
+        block_size (int): Tile size along N.
+
+    Returns:
+        Tensor: Scalar loss.
+    """
+    EPS = 1e-18
+
+    @staticmethod
+    def _pair_loss(division, gamma, pos_thresh, use_focal):
+        """g(D) and g'(D) of positive pairs."""
+        eps = BlockwiseFeCL.EPS
+        log_division = torch.log(division + eps)
+        if not use_focal:
+            return -log_division, -1.0 / (division + eps)
+        focal = division < pos_thresh
+        one_minus = 1 - division
+        value = -log_division * torch.where(focal, one_minus.pow(gamma), torch.ones_like(division))
+        slope = torch.where(focal, gamma * one_minus.pow(gamma - 1) * log_division - one_minus.pow(gamma) / (division + eps),
+                            -1.0 / (division + eps))
+        return value, slope
+
+    @staticmethod
+    def _masks(labels, rows, cols):
+        same = labels[:, rows].unsqueeze(-1) == labels[:, cols].unsqueeze(1)
+        positive = same.clone()
+        if rows == cols:
+            positive.diagonal(dim1=1, dim2=2).fill_(False)
+        return same, positive
+
+    @staticmethod
+    def forward(ctx, feat, labels, extra_neg, weights, temperature, gamma, pos_thresh, use_focal, block_size):
+        B, N, _ = feat.shape
+        eps = BlockwiseFeCL.EPS
+
+        # Pass 1: column max over the anchors, as subtracted by the dense loss
+        col_max = feat.new_full((B, N), -float('inf'))
+        for rows, cols, logits in _tiles(feat, feat, temperature, block_size, True):
+            col_max[:, cols] = torch.maximum(col_max[:, cols], logits.max(dim=1)[0])
+
+        # Pass 2: sum over negatives and number of positives of every anchor
+        neg_sum = feat.new_zeros((B, N))
+        pos_count = feat.new_zeros((B, N))
+        for rows, cols, logits in _tiles(feat, feat, temperature, block_size, True):
+            same = labels[:, rows].unsqueeze(-1) == labels[:, cols].unsqueeze(1)
+            exp_logits = torch.exp(logits - col_max[:, cols].unsqueeze(1))
+            neg_sum[:, rows] += (exp_logits * ~same).sum(dim=-1)
+            pos_count[:, rows] += same.sum(dim=-1)
+        if extra_neg is not None:
+            neg_sum = neg_sum + extra_neg
+        pos_count = pos_count - 1 + eps
+
+        # Pass 3: per-anchor loss and the gradient w.r.t. the negative sum
+        coef = 1.0 / (B * N * pos_count)
+        if weights is not None:
+            coef = coef * weights
+        row_loss = feat.new_zeros((B, N))
+        neg_grad = feat.new_zeros((B, N))
+        for rows, cols, logits in _tiles(feat, feat, temperature, block_size, True):
+            same, positive = BlockwiseFeCL._masks(labels, rows, cols)
+            exp_logits = torch.exp(logits - col_max[:, cols].unsqueeze(1))
+            denominator = exp_logits + neg_sum[:, rows].unsqueeze(-1) + eps
+            value, slope = BlockwiseFeCL._pair_loss(exp_logits / denominator, gamma, pos_thresh, use_focal)
+            row_loss[:, rows] += (value * positive).sum(dim=-1)
+            neg_grad[:, rows] -= (slope * positive * exp_logits / denominator.square()).sum(dim=-1)
+        neg_grad = neg_grad * coef
+
+        ctx.save_for_backward(feat, labels, col_max, neg_sum, coef, neg_grad, row_loss, pos_count)
+        ctx.has_extra_neg, ctx.has_weights = extra_neg is not None, weights is not None
+        ctx.params = (temperature, gamma, pos_thresh, use_focal, block_size)
+        return (row_loss * coef).sum()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        feat, labels, col_max, neg_sum, coef, neg_grad, row_loss, pos_count = ctx.saved_tensors
+        temperature, gamma, pos_thresh, use_focal, block_size = ctx.params
+        B, N, _ = feat.shape
+        eps = BlockwiseFeCL.EPS
+
+        grad_feat = torch.zeros_like(feat)
+        for rows, cols, logits in _tiles(feat, feat, temperature, block_size, True):
+            same, positive = BlockwiseFeCL._masks(labels, rows, cols)
+            exp_logits = torch.exp(logits - col_max[:, cols].unsqueeze(1))
+            denominator = exp_logits + neg_sum[:, rows].unsqueeze(-1) + eps
+            _, slope = BlockwiseFeCL._pair_loss(exp_logits / denominator, gamma, pos_thresh, use_focal)
+            grad_exp = slope * positive * coef[:, rows].unsqueeze(-1) * (neg_sum[:, rows].unsqueeze(-1) + eps) / denominator.square()
+            grad_exp = grad_exp + neg_grad[:, rows].unsqueeze(-1) * ~same
+            grad_logits = grad_exp * exp_logits
+            grad_feat[:, rows] += torch.matmul(grad_logits, feat[:, cols])
+            grad_feat[:, cols] += torch.matmul(grad_logits.transpose(1, 2), feat[:, rows])
+
+        grad_feat = grad_feat * (grad_output / temperature)
+        grad_extra = neg_grad * grad_output if ctx.has_extra_neg else None
+        grad_weights = row_loss / (B * N * pos_count) * grad_output if ctx.has_weights else None
+        return grad_feat, None, grad_extra, grad_weights, None, None, None, None, None
+
+
+class BlockwiseCrossNegative(torch.autograd.Function):
+    """
+    Auxiliary teacher cross-negative term of `FeCLoss` computed over tiles:
+
+        loss = Σ_{hard} -log(1 - <f_i, t_j> + ε) / #hard,   hard = [y_i != y_j] & (<f_i, t_j> > thresh)
+
+    (0 when there is no hard negative), with d loss / d f_i = Σ_j hard_ij t_j / ((1 - <f_i, t_j> + ε) #hard).
+
+    Args:
+        feat (Tensor): Student embeddings of shape (B, N, D).
+        teacher_feat (Tensor): Teacher embeddings of shape (B, N, D).
+        labels (Tensor): Patch labels of shape (B, N).
+        thresh (float): Similarity above which a cross negative is hard.
+        block_size (int): Tile size along N.
+
+    Returns:
+        Tensor: Scalar loss.
+    """
+    @staticmethod
+    def _hard_tiles(feat, teacher_feat, labels, thresh, block_size):
+        for rows, cols, cross_sim in _tiles(feat, teacher_feat, 1.0, block_size, False):
+            hard = (labels[:, rows].unsqueeze(-1) != labels[:, cols].unsqueeze(1)) & (cross_sim > thresh)
+            yield rows, cols, cross_sim, hard
+
+    @staticmethod
+    def forward(ctx, feat, teacher_feat, labels, thresh, block_size):
+        total, count = feat.new_zeros(()), feat.new_zeros(())
+        for _, _, cross_sim, hard in BlockwiseCrossNegative._hard_tiles(feat, teacher_feat, labels, thresh, block_size):
+            total += (-torch.log(1 - cross_sim + 1e-18) * hard).sum()
+            count += hard.sum()
+        ctx.save_for_backward(feat, teacher_feat, labels, count)
+        ctx.params = (thresh, block_size)
+        return total / (count + 1e-18)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        feat, teacher_feat, labels, count = ctx.saved_tensors
+        thresh, block_size = ctx.params
+        grad_feat = torch.zeros_like(feat) if ctx.needs_input_grad[0] else None
+        grad_teacher = torch.zeros_like(teacher_feat) if ctx.needs_input_grad[1] else None
+        for rows, cols, cross_sim, hard in BlockwiseCrossNegative._hard_tiles(feat, teacher_feat, labels, thresh, block_size):
+            grad_sim = hard / (1 - cross_sim + 1e-18)
+            if grad_feat is not None:
+                grad_feat[:, rows] += torch.matmul(grad_sim, teacher_feat[:, cols])
+            if grad_teacher is not None:
+                grad_teacher[:, cols] += torch.matmul(grad_sim.transpose(1, 2), feat[:, rows])
+        scale = grad_output / (count + 1e-18)
+        return (grad_feat * scale if grad_feat is not None else None,
+                grad_teacher * scale if grad_teacher is not None else None, None, None, None)
+
+
+class TeacherMemoryBank(nn.Module):
+    """
+    FIFO queues of past teacher patch embeddings, one for background (0) and one for foreground (1) patches,
+    stored in fp16 with a fixed capacity. Both queues live in a single preallocated (2, capacity, D) buffer
+    written as a ring, so enqueueing is O(batch) and never reallocates; the buffers follow the module
+    (`.to()`, `state_dict()`), so the bank can be checkpointed with the training state.
+
+    Args:
+        capacity (int): Embeddings kept per class.
+        feat_dim (int): Embedding dimension D.
+        device: Device of the queues.
+        dtype: Storage type of the queues.
+    """
+    def __init__(self, capacity, feat_dim=256, device=None, dtype=torch.float16):
+        super(TeacherMemoryBank, self).__init__()
+        self.capacity = capacity
+        self.register_buffer('queue', torch.zeros(2, capacity, feat_dim, dtype=dtype, device=device))
+        self.register_buffer('ptr', torch.zeros(2, dtype=torch.long, device=device))
+        self.register_buffer('count', torch.zeros(2, dtype=torch.long, device=device))
+
+    @torch.no_grad()
+    def enqueue(self, teacher_feat, mask):
+        """
+        Push teacher embeddings (B, N, D) with patch labels (B, 1, N) into their class queue,
+        overwriting the oldest entries once a queue is full.
+        """
+        keys = teacher_feat.reshape(-1, teacher_feat.shape[-1])
+        is_fg = mask.reshape(-1) > 0.5
+        for cls, cls_keys in enumerate((keys[~is_fg], keys[is_fg])):
+            cls_keys = cls_keys[-self.capacity:]
+            n = cls_keys.shape[0]
+            if n == 0:
+                continue
+            slots = (self.ptr[cls] + torch.arange(n, device=keys.device)) % self.capacity
+            self.queue[cls].index_copy_(0, slots, cls_keys.to(self.queue.dtype))
+            self.ptr[cls] = (self.ptr[cls] + n) % self.capacity
+            self.count[cls] = torch.clamp(self.count[cls] + n, max=self.capacity)
+
+    def contrast(self, anchors, labels, temperature):
+        """
+        Contrast anchors against the bank: the other class' queue gives negatives, the own class' queue positives.
+
+        As for in-batch keys, every bank column is shifted by its (detached) max over the anchors.
+
+        Args:
+            anchors: Tensor of shape (B, A, D) - student embeddings.
+            labels: Tensor of shape (B, A) - anchor labels.
+            temperature (float): Scaling factor τ.
+
+        Returns:
+            neg_sum (B, A): Sum of exponentiated negative logits.
+            pos_exp (B, A, capacity): Exponentiated positive logits (0 for empty slots).
+            pos_valid (B, A, capacity): Mask of filled positive slots.
+        """
+        B, A, D = anchors.shape
+        valid = torch.arange(self.capacity, device=anchors.device) < self.count.unsqueeze(-1)  # (2, K)
+        logits = torch.matmul(anchors, self.queue.to(anchors.dtype).reshape(-1, D).t()) / temperature
+        logits = logits.view(B, A, 2, self.capacity)
+        logits = logits - logits.max(dim=1, keepdim=True)[0].detach()
+        exp_logits = torch.exp(logits) * valid
+
+        is_fg = (labels > 0.5).unsqueeze(-1)
+        neg_sum = torch.where(is_fg, exp_logits[:, :, 0], exp_logits[:, :, 1]).sum(dim=-1)
+        pos_exp = torch.where(is_fg, exp_logits[:, :, 1], exp_logits[:, :, 0])
+        pos_valid = torch.where(is_fg, valid[1], valid[0])
+        return neg_sum, pos_exp, pos_valid
+
+    def positive_loss(self, pos_exp, pos_valid, neg_sum, focal_gamma=None, pos_thresh=None):
+        """
+        Per-anchor sum of -log(D) over the bank positives (optionally focal-weighted) and their number.
+        """
+        division = pos_exp / (pos_exp + neg_sum.unsqueeze(-1) + 1e-18)
+        loss_matrix = -torch.log(division + 1e-18) * pos_valid
+        if focal_gamma is not None:
+            loss_matrix = loss_matrix * torch.where(division < pos_thresh, (1 - division).pow(focal_gamma), torch.ones_like(division))
+        return loss_matrix.sum(dim=-1), pos_valid.sum(dim=-1)
+
+
 class FeCLoss(nn.Module):
     """
     FeCLoss with an auxiliary teacher-based hard negative branch and gambling softmax uncertainty mask for guiding positive samples.
@@ -136,9 +760,25 @@ class FeCLoss(nn.Module):
         gamma: Exponent for focal weighting.
         use_focal: Boolean flag to enable focal weighting on the primary loss.
         rampup_epochs: Number of epochs over which the thresholds are ramped up.
-        lambda_cross: Weight for the auxiliary teacher-based negative loss.
+        lambda_cross: Weight for the auxiliary teacher-based negative loss (0 disables it).
+        global_negatives: Add the teacher embeddings of the whole (all-gathered) batch as extra negatives
+            to the student denominator. Requires `teacher_feat`; gradients only flow to the local student features.
+        chunk_size: Number of global negatives compared at once, bounding the memory of the extra similarities.
+        block_size: If set, compute the loss over N×N tiles of this size with `BlockwiseFeCL` and
+            `BlockwiseCrossNegative` (memory linear in N, same loss and gradients as the dense path).
+        num_anchors: If set, only this many anchors per volume are contrasted against all N keys
+            (O(A·N) instead of O(N²)), sampled half from foreground and half from background patches.
+            Takes precedence over `block_size`.
+        hard_negatives: With `num_anchors`, keep at most this many negatives per anchor: the most similar
+            ones above the hard-negative threshold of the schedule (all negatives if None).
+        memory_bank_size: If > 0, keep a `TeacherMemoryBank` of this many past teacher embeddings per class,
+            used as extra negatives (other class) and positives (same class); `teacher_feat` is enqueued
+            after every call. Not available with `block_size`.
+        feat_dim: Embedding dimension of the memory bank.
     """
-    def __init__(self, device, temperature=0.6, gamma=2.0, use_focal=False, rampup_epochs=2000, lambda_cross=1.0):
+    def __init__(self, device, temperature=0.6, gamma=2.0, use_focal=False, rampup_epochs=2000, lambda_cross=1.0,
+                 global_negatives=False, chunk_size=4096, block_size=None, num_anchors=None, hard_negatives=None,
+                 memory_bank_size=0, feat_dim=256):
         super(FeCLoss, self).__init__()
         self.device = device
         self.temperature = temperature
@@ -146,6 +786,175 @@ class FeCLoss(nn.Module):
         self.use_focal = use_focal
         self.rampup_epochs = rampup_epochs
         self.lambda_cross = lambda_cross
+        self.global_negatives = global_negatives
+        self.chunk_size = chunk_size
+        self.block_size = block_size
+        self.num_anchors = num_anchors
+        self.hard_negatives = hard_negatives
+        self.memory_bank = TeacherMemoryBank(memory_bank_size, feat_dim, device=device) if memory_bank_size > 0 else None
+        if self.memory_bank is not None and block_size is not None and num_anchors is None:
+            raise ValueError("FeCLoss memory_bank_size is not supported with block_size")
+
+    @staticmethod
+    def gather_keys(teacher_feat, mask):
+        """
+        Collect teacher embeddings and patch labels from every process as a flat set of keys.
+
+        Args:
+            teacher_feat: Tensor of shape (B, N, D) - local teacher embeddings.
+            mask: Tensor of shape (B, 1, N) - local patch labels.
+
+        Returns:
+            keys (W*B*N, D), key_labels (W*B*N,), detached. Local keys only when not running distributed.
+        """
+        keys = teacher_feat.detach().reshape(-1, teacher_feat.shape[-1]).contiguous()
+        key_labels = mask.detach().reshape(-1).contiguous()
+        if dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1:
+            world_size = dist.get_world_size()
+            all_keys = [torch.empty_like(keys) for _ in range(world_size)]
+            all_labels = [torch.empty_like(key_labels) for _ in range(world_size)]
+            dist.all_gather(all_keys, keys)
+            dist.all_gather(all_labels, key_labels)
+            keys, key_labels = torch.cat(all_keys), torch.cat(all_labels)
+        return keys, key_labels
+
+    def global_negative_sum(self, anchors, labels, teacher_feat, mask):
+        """Negative sums (B, A) of anchors (B, A, D) with labels (B, A) against the teacher embeddings of the global batch."""
+        if teacher_feat is None:
+            raise ValueError("FeCLoss(global_negatives=True) requires teacher_feat")
+        keys, key_labels = self.gather_keys(teacher_feat, mask)
+        return CrossNegativeSum.apply(anchors, keys.to(anchors.dtype), labels, key_labels, self.temperature, self.chunk_size)
+
+    def forward_blockwise(self, feat, mask, teacher_feat=None, gambling_uncertainty=None, epoch=0):
+        """Tiled equivalent of `forward` that never builds a B×N×N matrix, see `BlockwiseFeCL`."""
+        labels = mask.squeeze(1)
+        extra_neg = self.global_negative_sum(feat, labels, teacher_feat, mask) if self.global_negatives else None
+
+        # The uncertainty-weighted loss replaces the focal one, as in `forward`
+        pos_thresh = sigmoid_rampup(epoch, self.rampup_epochs, min_threshold=1.3, max_threshold=1.5)
+        use_focal = self.use_focal and gambling_uncertainty is None
+        loss_student = BlockwiseFeCL.apply(feat, labels, extra_neg, gambling_uncertainty, self.temperature,
+                                           self.gamma, pos_thresh, use_focal, self.block_size)
+
+        loss_cross = 0.0
+        if teacher_feat is not None and self.lambda_cross > 0:
+            cross_neg_thresh = sigmoid_rampup(epoch, self.rampup_epochs, min_threshold=0.3, max_threshold=0.5)
+            loss_cross = BlockwiseCrossNegative.apply(feat, teacher_feat, labels, cross_neg_thresh, self.block_size)
+
+        return loss_student + self.lambda_cross * loss_cross
+
+    @staticmethod
+    def cross_negative_loss(cross_sim, hard_neg_mask):
+        """
+        Mean of -log(1 - s) over the hard cross negatives, 0 when there is none.
+
+        A masked reduction rather than a `mask.sum() > 0` branch, so the value stays on the device.
+
+        Args:
+            cross_sim: Tensor of shape (B, A, N) - student-teacher similarities.
+            hard_neg_mask: Bool tensor of the same shape - hard negatives.
+
+        Returns:
+            Tensor: Scalar loss.
+        """
+        loss_cross_term = torch.where(hard_neg_mask, -torch.log(1 - cross_sim + 1e-18), torch.zeros_like(cross_sim))
+        return torch.sum(loss_cross_term) / (torch.sum(hard_neg_mask.float()) + 1e-18)
+
+    @staticmethod
+    def sample_anchors(labels, num_anchors):
+        """
+        Draw `num_anchors` patch indices per volume, balanced between foreground and background.
+
+        If a class has fewer patches than its half, the remaining anchors are taken from the other class.
+
+        Args:
+            labels: Tensor of shape (B, N) - binary patch labels.
+            num_anchors (int): Anchors per volume (at most N).
+
+        Returns:
+            Tensor: Anchor indices of shape (B, A).
+        """
+        num_anchors = min(num_anchors, labels.shape[1])
+        indices = []
+        for sample_labels in labels:
+            foreground = torch.nonzero(sample_labels > 0.5).squeeze(1)
+            background = torch.nonzero(sample_labels <= 0.5).squeeze(1)
+            num_bg = min(background.numel(), max(num_anchors // 2, num_anchors - foreground.numel()))
+            num_fg = num_anchors - num_bg
+            foreground = foreground[torch.randperm(foreground.numel(), device=labels.device)[:num_fg]]
+            background = background[torch.randperm(background.numel(), device=labels.device)[:num_bg]]
+            indices.append(torch.cat([foreground, background]))
+        return torch.stack(indices)
+
+    def forward_sampled(self, feat, mask, teacher_feat=None, gambling_uncertainty=None, epoch=0):
+        """
+        FeCLoss on `num_anchors` sampled anchors per volume, each contrasted against all N keys.
+
+        Each anchor row is shifted by its own (detached) max, so it is a per-anchor softmax rather
+        than the column-shifted normalisation of the dense loss; the loss is averaged over the anchors.
+        """
+        B, N, D = feat.shape
+        labels = mask.squeeze(1)
+        anchor_idx = self.sample_anchors(labels, self.num_anchors)  # (B, A)
+        anchors = feat.gather(1, anchor_idx.unsqueeze(-1).expand(-1, -1, D))  # (B, A, D)
+        anchor_labels = labels.gather(1, anchor_idx)
+
+        similarity = torch.matmul(anchors, feat.transpose(1, 2))  # (B, A, N)
+        not_self = torch.arange(N, device=feat.device) != anchor_idx.unsqueeze(-1)
+        same = anchor_labels.unsqueeze(-1) == labels.unsqueeze(1)
+        pos_mask = same & not_self
+        neg_mask = ~same
+        if self.hard_negatives is not None:
+            neg_thresh = sigmoid_rampup(epoch, self.rampup_epochs, min_threshold=0.3, max_threshold=0.5)
+            hard_neg_mask = neg_mask & (similarity.detach() > neg_thresh)
+            k = min(self.hard_negatives, N)
+            candidates = similarity.detach().masked_fill(~hard_neg_mask, -float('inf'))
+            top_values, top_idx = candidates.topk(k, dim=-1)
+            neg_mask = torch.zeros_like(neg_mask).scatter_(-1, top_idx, top_values > -float('inf'))
+
+        logits = similarity / self.temperature
+        logits = logits - logits.masked_fill(~not_self, -float('inf')).max(dim=-1, keepdim=True)[0].detach()
+        exp_logits = torch.exp(logits)
+        neg_sum = torch.sum(exp_logits * neg_mask, dim=-1)  # (B, A)
+        if self.global_negatives:
+            neg_sum = neg_sum + self.global_negative_sum(anchors, anchor_labels, teacher_feat, mask)
+        if self.memory_bank is not None:
+            bank_neg_sum, bank_pos_exp, bank_pos_valid = self.memory_bank.contrast(anchors, anchor_labels, self.temperature)
+            neg_sum = neg_sum + bank_neg_sum
+
+        division = exp_logits / (exp_logits + neg_sum.unsqueeze(-1) + 1e-18)
+        loss_matrix = -torch.log(division + 1e-18) * pos_mask
+        num_pos = torch.sum(pos_mask, dim=-1) + 1e-18
+
+        use_focal = self.use_focal and gambling_uncertainty is None
+        pos_thresh = sigmoid_rampup(epoch, self.rampup_epochs, min_threshold=1.3, max_threshold=1.5)
+        if use_focal:
+            focal_weights = torch.where(division < pos_thresh, (1 - division).pow(self.gamma), torch.ones_like(division))
+            loss_matrix = loss_matrix * focal_weights
+        loss_per_anchor = torch.sum(loss_matrix, dim=-1)
+        if self.memory_bank is not None:
+            bank_loss, bank_count = self.memory_bank.positive_loss(bank_pos_exp, bank_pos_valid, neg_sum,
+                                                                   self.gamma if use_focal else None, pos_thresh)
+            loss_per_anchor, num_pos = loss_per_anchor + bank_loss, num_pos + bank_count
+        loss_per_anchor = loss_per_anchor / num_pos
+
+        if gambling_uncertainty is not None:
+            loss_student = (loss_per_anchor * gambling_uncertainty.gather(1, anchor_idx)).mean()
+        else:
+            loss_student = loss_per_anchor.mean()
+
+        # Auxiliary Cross-Negative Loss (Teacher-Student) of the sampled anchors
+        loss_cross = 0.0
+        if teacher_feat is not None and self.lambda_cross > 0:
+            cross_sim = torch.matmul(anchors, teacher_feat.transpose(1, 2))  # (B, A, N)
+            cross_neg_thresh = sigmoid_rampup(epoch, self.rampup_epochs, min_threshold=0.3, max_threshold=0.5)
+            cross_hard_neg_mask = ~same & (cross_sim > cross_neg_thresh)
+            loss_cross = self.cross_negative_loss(cross_sim, cross_hard_neg_mask)
+
+        if self.memory_bank is not None and teacher_feat is not None:
+            self.memory_bank.enqueue(teacher_feat, mask)
+
+        return loss_student + self.lambda_cross * loss_cross
 
     def forward(self, feat, mask, teacher_feat=None, gambling_uncertainty=None, epoch=0):
         """
@@ -166,6 +975,11 @@ class FeCLoss(nn.Module):
             Total loss (scalar): student loss + lambda_cross * teacher auxiliary loss,
             with positive samples optionally weighted by the uncertainty mask.
         """
+        if self.num_anchors is not None:
+            return self.forward_sampled(feat, mask, teacher_feat, gambling_uncertainty, epoch)
+        if self.block_size is not None:
+            return self.forward_blockwise(feat, mask, teacher_feat, gambling_uncertainty, epoch)
+
         B, N, _ = feat.shape
 
         # Primary FeCLoss (Student Only)
@@ -183,36 +997,53 @@ class FeCLoss(nn.Module):
         exp_logits = torch.exp(feat_logits)  # (B, N, N)
         neg_sum = torch.sum(exp_logits * mem_mask_neg, dim=-1)  # (B, N)
 
+        # Teacher embeddings of the global batch as extra negatives
+        if self.global_negatives:
+            neg_sum = neg_sum + self.global_negative_sum(feat, mask.squeeze(1), teacher_feat, mask)
+
+        # Past teacher embeddings of the memory bank as extra negatives
+        if self.memory_bank is not None:
+            bank_neg_sum, bank_pos_exp, bank_pos_valid = self.memory_bank.contrast(feat, mask.squeeze(1), self.temperature)
+            neg_sum = neg_sum + bank_neg_sum
+
         denominator = exp_logits + neg_sum.unsqueeze(dim=-1)
         division = exp_logits / (denominator + 1e-18)  # Softmax-like probability.
 
         loss_matrix = -torch.log(division + 1e-18)
         loss_matrix = loss_matrix * mem_mask * neg_identity
 
-        loss_student = torch.sum(loss_matrix, dim=-1) / (torch.sum(mem_mask, dim=-1) - 1 + 1e-18)
+        # ... and positives
+        bank_loss, bank_focal_loss, bank_count = 0.0, 0.0, 0.0
+        if self.memory_bank is not None:
+            bank_loss, bank_count = self.memory_bank.positive_loss(bank_pos_exp, bank_pos_valid, neg_sum)
+            if self.use_focal:
+                pos_thresh = sigmoid_rampup(epoch, self.rampup_epochs, min_threshold=1.3, max_threshold=1.5)
+                bank_focal_loss, _ = self.memory_bank.positive_loss(bank_pos_exp, bank_pos_valid, neg_sum, self.gamma, pos_thresh)
+
+        loss_student = (torch.sum(loss_matrix, dim=-1) + bank_loss) / (torch.sum(mem_mask, dim=-1) - 1 + bank_count + 1e-18)
         loss_student = loss_student.mean()
 
         # Apply focal weighting to the student loss
         if self.use_focal:
             similarity = division  # Using normalized similarity as proxy.
-            focal_weights = torch.ones_like(similarity)
             pos_thresh = sigmoid_rampup(epoch, self.rampup_epochs, min_threshold=1.3, max_threshold=1.5)
             neg_thresh = sigmoid_rampup(epoch, self.rampup_epochs, min_threshold=0.3, max_threshold=0.5)
             hard_pos_mask = mem_mask.bool() & (similarity < pos_thresh)
-            focal_weights[hard_pos_mask] = (1 - similarity[hard_pos_mask]).pow(self.gamma)
             hard_neg_mask = mem_mask_neg.bool() & (similarity > neg_thresh)
-            focal_weights[hard_neg_mask] = similarity[hard_neg_mask].pow(self.gamma)
-            loss_student = torch.sum(loss_matrix * focal_weights, dim=-1) / (torch.sum(mem_mask, dim=-1) - 1 + 1e-18)
+            # Selected with `torch.where` rather than boolean-mask assignment, which would sync with the host
+            focal_weights = torch.where(hard_pos_mask, (1 - similarity).pow(self.gamma),
+                                        torch.where(hard_neg_mask, similarity.pow(self.gamma), torch.ones_like(similarity)))
+            loss_student = (torch.sum(loss_matrix * focal_weights, dim=-1) + bank_focal_loss) / (torch.sum(mem_mask, dim=-1) - 1 + bank_count + 1e-18)
             loss_student = loss_student.mean()
 
         # Incorporate Gambling Softmax Uncertainty Mask for Positives
         if gambling_uncertainty is not None:
-            loss_student_per_patch = torch.sum(loss_matrix, dim=-1) / (torch.sum(mem_mask, dim=-1) - 1 + 1e-18) 
+            loss_student_per_patch = (torch.sum(loss_matrix, dim=-1) + bank_loss) / (torch.sum(mem_mask, dim=-1) - 1 + bank_count + 1e-18) 
             loss_student = (loss_student_per_patch * gambling_uncertainty).mean()
 
         # Auxiliary Cross-Negative Loss (Teacher-Student)
         loss_cross = 0.0
-        if teacher_feat is not None:
+        if teacher_feat is not None and self.lambda_cross > 0:
             # Compute cross-similarity between student and teacher embeddings.
             cross_sim = torch.matmul(feat, teacher_feat.transpose(1, 2)) 
             mem_mask_cross = torch.eq(mask, mask.transpose(1, 2)).float()
@@ -223,18 +1054,19 @@ class FeCLoss(nn.Module):
             cross_hard_neg_mask = mem_mask_cross_neg.bool() & (cross_sim > cross_neg_thresh)
             
             # Compute auxiliary loss for these hard negatives: penalty increases as similarity increases.
-            if cross_hard_neg_mask.sum() > 0:
-                loss_cross_term = -torch.log(1 - cross_sim + 1e-18)
-                loss_cross_term = loss_cross_term * cross_hard_neg_mask.float()
-                loss_cross = torch.sum(loss_cross_term) / (torch.sum(cross_hard_neg_mask.float()) + 1e-18)
-            else:
-                loss_cross = 0.0
+            loss_cross = self.cross_negative_loss(cross_sim, cross_hard_neg_mask)
+
+        if self.memory_bank is not None and teacher_feat is not None:
+            self.memory_bank.enqueue(teacher_feat, mask)
 
         # Total Loss
         total_loss = loss_student + self.lambda_cross * loss_cross
         return total_loss
 
 if __name__ == "__main__":
+    # Quick sanity check; timings and memory are measured by `benchmarks/loss_bench.py`
+    device = 'cuda:0' if torch.cuda.is_available() else 'cpu'
+
     # Test the UnCLoss
     s_logits = torch.randn(8, 2, 16, 16, 16)
     t_logits = torch.randn(8, 2, 16, 16, 16)
@@ -244,10 +1076,10 @@ if __name__ == "__main__":
     print(f"uncl_loss: {loss}")
     
     # Test the FeCLoss
-    feat = torch.randn(8, 128, 128).cuda()
-    mask = torch.randint(0, 2, (8, 1, 128)).cuda()
-    decoded_logits = torch.randn(8, 128).cuda()
+    feat = torch.randn(8, 128, 128, device=device)
+    mask = torch.randint(0, 2, (8, 1, 128), device=device)
+    decoded_logits = torch.randn(8, 128, device=device)
     
-    fecl = FeCLoss(device='cuda:0', use_focal=True)
+    fecl = FeCLoss(device=device, use_focal=True)
     loss = fecl(feat=feat, mask=mask, teacher_feat=None, gambling_uncertainty=decoded_logits)
     print(f"fecl_loss: {loss}")
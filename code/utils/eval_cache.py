@@ -0,0 +1,160 @@
+import os
+import json
+import zlib
+import time
+import sqlite3
+import inspect
+import hashlib
+import numpy as np
+import torch
+
+# Bump to invalidate every cached result when something the code digests do not see changes.
+CACHE_VERSION = 1
+
+
+def state_digest(model):
+    """SHA-256 of the weights of a model (or a state dict): names, dtypes, shapes and values of every tensor."""
+    state_dict = model.state_dict() if isinstance(model, torch.nn.Module) else model
+    digest = hashlib.sha256()
+    for name in sorted(state_dict):
+        tensor = state_dict[name]
+        if not torch.is_tensor(tensor):
+            continue
+        tensor = tensor.detach().cpu().contiguous().reshape(-1)
+        digest.update('{}:{}:{}'.format(name, tensor.dtype, tuple(state_dict[name].shape)).encode())
+        digest.update(tensor.view(torch.uint8).numpy().tobytes() if tensor.numel() else b'')
+    return digest.hexdigest()
+
+
+def file_digest(path, chunk_size=1 << 22):
+    """SHA-256 of the content of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def config_digest(config):
+    """SHA-256 of a JSON-serialisable configuration (a dict of the settings a result depends on)."""
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def code_digest(*objects):
+    """
+    SHA-256 of the source code of functions, classes and modules, so that cached results are invalidated when
+    the code computing them changes. Objects without retrievable source (builtins, C extensions)
+    contribute their qualified name only.
+    """
+    digest = hashlib.sha256('version {}'.format(CACHE_VERSION).encode())
+    for obj in objects:
+        if obj is None:
+            continue
+        try:
+            source = inspect.getsource(obj)
+        except (OSError, TypeError):
+            source = getattr(obj, '__module__', '') + '.' + getattr(obj, '__qualname__', repr(obj))
+        digest.update(source.encode())
+    return digest.hexdigest()
+
+
+def encode_array(array, level=6):
+    """zlib-compressed bytes of an array, stored as uint8 when its values fit (label maps)."""
+    array = np.ascontiguousarray(array)
+    stored = array
+    if (array.dtype.kind in 'biu' and array.size) and array.min() >= 0 and array.max() < 256:
+        stored = array.astype(np.uint8)
+    return zlib.compress(stored.tobytes(), level), str(stored.dtype), str(array.dtype)
+
+
+def decode_array(data, shape, stored_dtype, dtype):
+    return np.frombuffer(zlib.decompress(data), dtype=stored_dtype).reshape(shape).astype(dtype)
+
+
+class EvaluationCache(object):
+    """
+    Content-addressed SQLite store of per-case predictions and metrics.
+
+    Results are keyed by the digest of the model weights (`state_digest`), the digest of the case file
+    (`file_digest`, memoised per path, size and modification time so unchanged files are not hashed
+    again) and the digest of the configuration they depend on (`config_digest`): the inference
+    settings for a prediction, and those plus the metric settings for the metrics, each together with
+    the `code_digest` of the code computing them, so a changed metric or inference implementation
+    does not return stale results. Re-evaluating an
+    unchanged checkpoint reads the metrics back, changing only a metric setting (e.g. `nms`) reuses
+    the predictions, and an interrupted run keeps the prediction of every case it finished, each one
+    being committed on its own.
+
+    Predictions are stored zlib-compressed. The cache is used from one thread.
+
+    Args:
+        path (str): SQLite database file, created if missing.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT);
+        CREATE TABLE IF NOT EXISTS predictions (model TEXT, case_digest TEXT, config TEXT, shape TEXT, stored_dtype TEXT,
+                                                dtype TEXT, data BLOB, created REAL, PRIMARY KEY (model, case_digest, config));
+        CREATE TABLE IF NOT EXISTS metrics (model TEXT, case_digest TEXT, config TEXT, value TEXT, created REAL,
+                                            PRIMARY KEY (model, case_digest, config));
+    """
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._conn = sqlite3.connect(path)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(self.SCHEMA)
+        self._conn.commit()
+
+    def case_digest(self, path):
+        """Digest of a case file, hashed again only if its size or modification time changed."""
+        stat = os.stat(path)
+        path = os.path.abspath(path)
+        row = self._conn.execute('SELECT size, mtime_ns, digest FROM files WHERE path = ?', (path, )).fetchone()
+        if row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+            return row[2]
+        digest = file_digest(path)
+        with self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', (path, stat.st_size, stat.st_mtime_ns, digest))
+        return digest
+
+    def prediction(self, model, case, config):
+        """Cached prediction, or None."""
+        row = self._conn.execute('SELECT shape, stored_dtype, dtype, data FROM predictions WHERE model = ? AND case_digest = ? AND config = ?',
+                                 (model, case, config)).fetchone()
+        if row is None:
+            return None
+        return decode_array(row[3], json.loads(row[0]), row[1], row[2])
+
+    def put_prediction(self, model, case, config, prediction):
+        data, stored_dtype, dtype = encode_array(prediction)
+        with self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                               (model, case, config, json.dumps(list(prediction.shape)), stored_dtype, dtype,
+                                sqlite3.Binary(data), time.time()))
+
+    def metrics(self, model, case, config):
+        """Cached metrics (a float or a tuple), or None."""
+        row = self._conn.execute('SELECT value FROM metrics WHERE model = ? AND case_digest = ? AND config = ?',
+                                 (model, case, config)).fetchone()
+        if row is None:
+            return None
+        value = json.loads(row[0])
+        return tuple(value) if isinstance(value, list) else value
+
+    def put_metrics(self, model, case, config, value):
+        value = [float(v) for v in value] if isinstance(value, (tuple, list, np.ndarray)) else float(value)
+        with self._conn:
+            self._conn.execute('INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?)',
+                               (model, case, config, json.dumps(value), time.time()))
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
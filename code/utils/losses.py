@@ -62,15 +62,23 @@ def entropy_loss_map(p, C=2):
     return ent
 
 
-def softmax_mse_loss(input_logits, target_logits, sigmoid=False):
+def softmax_mse_loss(input_logits, target_logits, sigmoid=False, binary=False):
     """Takes softmax on both sides and returns MSE loss
 
     Note:
     - Returns the sum over all examples. Divide by the batch size afterwards
       if you want the mean.
     - Sends gradients to inputs but not the targets.
+    - binary=True (two-class inputs): the softmax is computed as the sigmoid of the channel
+      difference on a single channel; both channels have the same error, so the result is that
+      channel expanded (without a copy) to the input shape.
     """
     assert input_logits.size() == target_logits.size()
+    if binary:
+        assert input_logits.shape[1] == 2
+        input_fg = torch.sigmoid(input_logits[:, 1:] - input_logits[:, :1])
+        target_fg = torch.sigmoid(target_logits[:, 1:] - target_logits[:, :1])
+        return ((input_fg - target_fg)**2).expand_as(input_logits)
     if sigmoid:
         input_softmax = torch.sigmoid(input_logits)
         target_softmax = torch.sigmoid(target_logits)
@@ -82,15 +90,26 @@ def softmax_mse_loss(input_logits, target_logits, sigmoid=False):
     return mse_loss
 
 
-def softmax_kl_loss(input_logits, target_logits, sigmoid=False):
+def softmax_kl_loss(input_logits, target_logits, sigmoid=False, binary=False):
     """Takes softmax on both sides and returns KL divergence
 
     Note:
     - Returns the sum over all examples. Divide by the batch size afterwards
       if you want the mean.
     - Sends gradients to inputs but not the targets.
+    - binary=True (two-class inputs): computed from the channel difference with logsigmoid on
+      single-channel maps.
     """
     assert input_logits.size() == target_logits.size()
+    if binary:
+        assert input_logits.shape[1] == 2
+        input_diff = input_logits[:, 1] - input_logits[:, 0]
+        target_diff = target_logits[:, 1] - target_logits[:, 0]
+        target_fg = torch.sigmoid(target_diff)
+        kl_div = target_fg * (F.logsigmoid(target_diff) - F.logsigmoid(input_diff)) + \
+            (1 - target_fg) * (F.logsigmoid(-target_diff) - F.logsigmoid(-input_diff))
+        # reduction='mean' of F.kl_div also averages over the two channels
+        return 0.5 * torch.mean(kl_div)
     if sigmoid:
         input_log_softmax = torch.log(torch.sigmoid(input_logits))
         target_softmax = torch.sigmoid(target_logits)
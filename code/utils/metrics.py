@@ -8,7 +8,7 @@
 
 import numpy as np
 from medpy import metric
-from medpy.metric import hd95
+from scipy.ndimage import binary_erosion, distance_transform_edt, generate_binary_structure
 
 
 def cal_dice(prediction, label, num=2):
@@ -25,13 +25,69 @@ def cal_dice(prediction, label, num=2):
     return total_dice
 
 
+def surface_distances(result, reference, voxelspacing=None, connectivity=1):
+    """
+    Directed surface distances between two binary volumes, as in medpy's `__surface_distances`.
+
+    Both volumes are cropped to the bounding box of their union grown by one voxel (clipped to the
+    volume), which is all the erosion that extracts the one-voxel surfaces needs, and each surface is
+    extracted and distance-transformed once. The Euclidean distance transform is exact, so the crop
+    does not change any distance.
+
+    Args:
+        result, reference: Binary arrays of the same shape.
+        voxelspacing (sequence, optional): Voxel size per axis (e.g. in mm).
+        connectivity (int): Neighbourhood of the surface extraction (1: faces).
+
+    Returns:
+        Distances from every surface voxel of `result` to the surface of `reference`, and the
+        other way round.
+    """
+    result = np.atleast_1d(np.asarray(result).astype(bool))
+    reference = np.atleast_1d(np.asarray(reference).astype(bool))
+    if not result.any():
+        raise RuntimeError("The first supplied array does not contain any binary object.")
+    if not reference.any():
+        raise RuntimeError("The second supplied array does not contain any binary object.")
+
+    union = result | reference
+    crop = []
+    for axis in range(union.ndim):
+        nonzero = np.flatnonzero(union.any(axis=tuple(a for a in range(union.ndim) if a != axis)))
+        crop.append(slice(max(nonzero[0] - 1, 0), min(nonzero[-1] + 2, union.shape[axis])))
+    result, reference = result[tuple(crop)], reference[tuple(crop)]
+
+    footprint = generate_binary_structure(result.ndim, connectivity)
+    result_border = result ^ binary_erosion(result, structure=footprint, iterations=1)
+    reference_border = reference ^ binary_erosion(reference, structure=footprint, iterations=1)
+    sampling = None if voxelspacing is None else np.broadcast_to(np.asarray(voxelspacing, dtype=np.float64), (result.ndim, ))
+    to_reference = distance_transform_edt(~reference_border, sampling=sampling)[result_border]
+    to_result = distance_transform_edt(~result_border, sampling=sampling)[reference_border]
+    return to_reference, to_result
+
+
+def surface_metrics(result, reference, voxelspacing=None, connectivity=1, tolerance=1.0):
+    """
+    Surface metrics of `result` against `reference` from one pair of directed distance sets.
+
+    Returns:
+        dict: `hd` and `hd95` (symmetric, as medpy's `hd`/`hd95`), `asd` (from `result` to
+        `reference`, as medpy's `asd`), `assd` (the mean over both directions' distances, as
+        medpy's `assd`) and `surface_dice`, the fraction of surface voxels of both volumes within
+        `tolerance` (in the units of `voxelspacing`) of the other surface.
+    """
+    to_reference, to_result = surface_distances(result, reference, voxelspacing, connectivity)
+    both = np.hstack((to_reference, to_result))
+    return {'hd': max(to_reference.max(), to_result.max()), 'hd95': np.percentile(both, 95), 'asd': to_reference.mean(),
+            'assd': both.mean(), 'surface_dice': np.mean(both <= tolerance)}
+
+
 def calculate_metric_percase(pred, gt):
     dc = metric.binary.dc(pred, gt)
     jc = metric.binary.jc(pred, gt)
-    hd = metric.binary.hd95(pred, gt)
-    asd = metric.binary.asd(pred, gt)
+    surface = surface_metrics(pred, gt)
 
-    return dc, jc, hd, asd
+    return dc, jc, surface['hd95'], surface['asd']
 
 
 def dice(input, target, ignore_index=None):
@@ -69,7 +125,7 @@ def compute_hd95(pred, target, max_dist):
             hd95_scores.append(max_dist)  # Return max distance if either set is empty
         else:
             try:
-                hd95_scores.append(hd95(p, t))
+                hd95_scores.append(surface_metrics(p, t)['hd95'])
             except RuntimeError as e:
                 print(f"RuntimeError: {e}")
                 hd95_scores.append(max_dist)
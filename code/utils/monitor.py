@@ -1,4 +1,8 @@
 import os
+import queue
+import logging
+import threading
+import collections
 import torch
 from torch.nn import functional as F
 
@@ -48,4 +52,98 @@ def monitor_similarity_distributions(feat, mask, epoch, path_prefix="../misc/sim
     plt.tight_layout()
     plt.savefig(os.path.join(path_prefix, f"epoch_{epoch}_similarity_distributions.png"))
     plt.close()
-    # plt.show()
\ No newline at end of file
+    # plt.show()
+
+
+class ScalarBuffer(object):
+    """
+    Buffers per-iteration training scalars and writes them to TensorBoard (and the log) in bulk.
+
+    Tensors are detached and kept on their device when added, so queuing a value does not force a
+    host-device synchronisation. Every `flush_every` steps the pending tensors are stacked and copied
+    to the host with a single transfer per device, then written with their original step numbers,
+    so the reported values are exactly those of per-step logging.
+
+    Args:
+        writer: SummaryWriter that receives the scalars.
+        flush_every (int): Number of steps buffered between two flushes.
+        log_format (str, optional): %-style format string used to emit one `logging.info` line per step.
+            The step is available as `step` and every scalar under its tag, e.g. '%(info/loss)03f';
+            tags missing from a step are printed as nan.
+        background (bool): If True, the host copy and the writes happen in a worker thread, so the
+            training loop never waits on them.
+    """
+    def __init__(self, writer, flush_every=50, log_format=None, background=False):
+        self.writer = writer
+        self.flush_every = max(1, int(flush_every))
+        self.log_format = log_format
+        self._pending = []
+        self._queue = None
+        self._worker = None
+        if background:
+            self._queue = queue.Queue()
+            self._worker = threading.Thread(target=self._run, daemon=True)
+            self._worker.start()
+
+    def add(self, step, scalars):
+        """
+        Queue the scalars of one step.
+
+        Args:
+            step (int): Global step the values belong to.
+            scalars (dict): Mapping of tag -> 1-element tensor or Python number.
+        """
+        values = {}
+        for tag, value in scalars.items():
+            values[tag] = value.detach() if torch.is_tensor(value) else value
+        self._pending.append((step, values))
+        if len(self._pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Write every pending step (or hand them to the worker thread)."""
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        if self._queue is not None:
+            self._queue.put(pending)
+        else:
+            self._write(pending)
+
+    def close(self):
+        """Flush the remaining steps and wait for the worker thread, if any."""
+        self.flush()
+        if self._worker is not None:
+            self._queue.put(None)
+            self._worker.join()
+            self._worker = None
+
+    def _run(self):
+        while True:
+            pending = self._queue.get()
+            if pending is None:
+                break
+            try:
+                self._write(pending)
+            except Exception:
+                logging.exception("Failed to write buffered scalars")
+
+    def _write(self, pending):
+        # One stack + host copy per device instead of one `.item()` per scalar.
+        by_device = {}
+        for i, (_, values) in enumerate(pending):
+            for tag, value in values.items():
+                if torch.is_tensor(value):
+                    by_device.setdefault(value.device, []).append((i, tag, value))
+
+        host = [dict(values) for _, values in pending]
+        for items in by_device.values():
+            stacked = torch.stack([value.reshape(()).to(torch.float64) for _, _, value in items])
+            for (i, tag, _), value in zip(items, stacked.cpu().tolist()):
+                host[i][tag] = value
+
+        for (step, _), values in zip(pending, host):
+            for tag, value in values.items():
+                self.writer.add_scalar(tag, value, step)
+            if self.log_format is not None:
+                logging.info(self.log_format % collections.defaultdict(lambda: float('nan'), values, step=step))
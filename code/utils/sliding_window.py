@@ -0,0 +1,458 @@
+"""
+Device-agnostic sliding-window inference for 3D segmentation networks.
+
+`SlidingWindowPredictor` pads a (C, X, Y, Z) volume to at least the patch size, tiles it into
+windows, runs the network on batches of windows (optionally mirrored and in mixed precision) and
+blends the window predictions with uniform or Gaussian weights, on CPU as well as on CUDA. It
+serves the DyCON backbones (`UNet3D`/`VNet`, which return `(sdf, seg, features)`) through
+`test_3d_patch.test_single_case`, and nnU-Net's `Generic_UNet` through `SegmentationNetwork.predict_3D`.
+
+Given a region of interest (`intensity_roi`, or `coarse_roi` from a downsampled pass of the same
+predictor), only the windows that intersect it are evaluated and the rest is filled as background.
+
+For volumes whose score map does not fit in memory, `SlidingWindowPredictor.stream` yields the
+finished slabs along the first spatial axis, keeping only the window overlap in memory, and
+`write_slab` stores them in a `np.memmap` or HDF5 score map (`open_score_map`) as float16 or uint8.
+"""
+import math
+import tempfile
+import itertools
+import functools
+import contextlib
+
+import h5py
+import numpy as np
+import torch
+import torch.nn.functional as F
+from scipy.ndimage import gaussian_filter
+
+_WINDOW_BYTES = {}
+
+
+def stride_grid(shape, patch_size, strides):
+    """Per-axis window starts every `stride` voxels, the last window flush with the border (DyCON evaluators)."""
+    return tuple(tuple(min(stride * i, size - patch) for i in range(math.ceil((size - patch) / stride) + 1))
+                 for size, patch, stride in zip(shape, patch_size, strides))
+
+
+def step_size_grid(shape, patch_size, step_size):
+    """Per-axis window starts spread evenly, at most `step_size * patch` apart (nnU-Net)."""
+    assert 0 < step_size <= 1, 'step_size must be larger than 0 and smaller or equal to 1'
+    grid = []
+    for size, patch in zip(shape, patch_size):
+        num_steps = int(np.ceil((size - patch) / (patch * step_size))) + 1
+        actual_step_size = (size - patch) / (num_steps - 1) if num_steps > 1 else 0
+        grid.append(tuple(int(np.round(actual_step_size * i)) for i in range(num_steps)))
+    return tuple(grid)
+
+
+def autocast(device):
+    """Mixed-precision context for inference on `device`: float16 on CUDA, bfloat16 on CPU."""
+    device_type = torch.device(device).type
+    return torch.autocast(device_type=device_type, dtype=torch.float16 if device_type == 'cuda' else torch.bfloat16)
+
+
+def window_origins(shape, patch_size, stride_xy, stride_z):
+    """Corners (xs, ys, zs) of the sliding windows over a (padded) volume, in x, y, z loop order."""
+    return list(itertools.product(*stride_grid(shape, patch_size, (stride_xy, stride_xy, stride_z))))
+
+
+def pad_to_patch(image, patch_size, mode='constant', **kwargs):
+    """
+    Pad the spatial axes of a (C, X, Y, Z) array to at least `patch_size`, centred.
+
+    Returns:
+        The padded array and the spatial slices of the original volume in it.
+    """
+    pads = [max(0, p - s) for s, p in zip(image.shape[1:], patch_size)]
+    width = [(0, 0)] + [(p // 2, p - p // 2) for p in pads]
+    slicer = tuple(slice(lo, lo + s) for (lo, _), s in zip(width[1:], image.shape[1:]))
+    if any(pads):
+        image = np.pad(image, width, mode=mode, **kwargs)
+    return image, slicer
+
+
+@functools.lru_cache(maxsize=8)
+def gaussian_importance_map(patch_size, device, sigma_scale=1. / 8):
+    """
+    Importance weights of a window, highest at its centre, as in `SegmentationNetwork._get_gaussian`:
+    a Gaussian with sigma = patch_size * sigma_scale scaled to a maximum of 1 (no zeros).
+    Cached (LRU) per patch size and device; callers must not modify the returned tensor.
+    """
+    tmp = np.zeros(patch_size)
+    tmp[tuple(i // 2 for i in patch_size)] = 1
+    gaussian = gaussian_filter(tmp, [i * sigma_scale for i in patch_size], 0, mode='constant', cval=0)
+    gaussian = (gaussian / np.max(gaussian)).astype(np.float32)
+    gaussian[gaussian == 0] = np.min(gaussian[gaussian != 0])
+    return torch.from_numpy(gaussian).to(device)
+
+
+@functools.lru_cache(maxsize=16)
+def normalisation_map(shape, patch_size, grid, device, gaussian=False):
+    """
+    Sum of the window weights at every voxel, as a float32 tensor on `device`.
+
+    With uniform weights this is the number of windows covering the voxel, the outer product of the
+    per-axis coverage counts of the window grid (per-axis starts, see `stride_grid`). With Gaussian
+    weights the importance maps of all windows are accumulated. The map depends only on the volume
+    shape, the patch, the grid and the weighting and is cached (LRU) on those; callers must not modify it.
+    """
+    if gaussian:
+        return coverage_map(shape, patch_size, itertools.product(*grid), device, gaussian)
+    axes = []
+    for size, patch, starts in zip(shape, patch_size, grid):
+        axis = torch.zeros(size, dtype=torch.float32)
+        for start in starts:
+            axis[start:start + patch] += 1
+        axes.append(axis)
+    return (axes[0][:, None, None] * axes[1][None, :, None] * axes[2][None, None, :]).to(device)
+
+
+def coverage_map(shape, patch_size, origins, device, gaussian=False):
+    """Sum of the weights of the windows at `origins` at every voxel (not cached, for any set of windows)."""
+    weights = gaussian_importance_map(patch_size, device) if gaussian else 1.
+    total = torch.zeros(shape, dtype=torch.float32, device=device)
+    for origin in origins:
+        total[tuple(slice(o, o + p) for o, p in zip(origin, patch_size))] += weights
+    return total
+
+
+def windows_in_roi(roi, origins, patch_size):
+    """
+    Which windows contain at least one voxel of the boolean `roi` (X, Y, Z).
+
+    The voxel count of every window is read off a summed-volume table of the ROI, so the test costs
+    one pass over the volume whatever the number of windows.
+    """
+    table = np.pad(np.asarray(roi, dtype=bool).cumsum(0, dtype=np.int64).cumsum(1).cumsum(2), ((1, 0), (1, 0), (1, 0)))
+    lo = np.asarray(origins, dtype=np.int64).reshape(-1, 3)
+    hi = lo + np.asarray(patch_size)
+    count = 0
+    for corner in itertools.product((0, 1), repeat=3):
+        index = tuple(np.where(c, hi[:, i], lo[:, i]) for i, c in enumerate(corner))
+        count = count + (-1) ** (3 - sum(corner)) * table[index]
+    return count > 0
+
+
+def dilate(mask, margin):
+    """Grow a boolean (X, Y, Z) tensor by `margin` voxels (a cube structuring element, one axis at a time)."""
+    if margin <= 0:
+        return mask
+    grown = mask[None, None].float()
+    for axis in range(3):
+        kernel = [1, 1, 1]
+        kernel[axis] = 2 * margin + 1
+        grown = F.max_pool3d(grown, kernel, stride=1, padding=[k // 2 for k in kernel])
+    return grown[0, 0] > 0
+
+
+def intensity_roi(image, background=0., margin=0):
+    """
+    Voxels of a (C, X, Y, Z) volume where any channel differs from the `background` intensity (the
+    zero background around the brain in BraTS), grown by `margin` voxels.
+    """
+    roi = torch.from_numpy(np.any(np.asarray(image) != background, axis=0))
+    return dilate(roi, margin).numpy()
+
+
+def coarse_roi(predictor, image, scale=2, threshold=0.1, margin=8):
+    """
+    Foreground of a cheap pass of `predictor` over the volume downsampled `scale` times per axis.
+
+    The foreground probability (the only channel of a one-channel output, one minus the background
+    channel otherwise) is upsampled to the volume, thresholded at `threshold` (low, to favour recall)
+    and grown by `margin` voxels.
+
+    Returns:
+        The ROI as a boolean (X, Y, Z) array, and the number of windows of the coarse pass.
+    """
+    volume = torch.from_numpy(np.ascontiguousarray(image, dtype=np.float32))[None].to(predictor.device)
+    small = F.interpolate(volume, scale_factor=1. / scale, mode='trilinear', align_corners=False)[0]
+    probs = predictor(small.cpu().numpy())
+    foreground = probs[0] if probs.shape[0] == 1 else 1 - probs[0]
+    foreground = F.interpolate(foreground[None, None].float(), size=volume.shape[2:], mode='trilinear', align_corners=False)[0, 0]
+    return dilate(foreground > threshold, margin).cpu().numpy(), predictor.stats['evaluated']
+
+
+def open_score_map(shape, dtype='float16', path=None):
+    """
+    Writable score map of `shape` for `write_slab`: a `.npy` memory map, an HDF5 dataset 'score' (a
+    path ending with .h5, chunked per slab), or a memory map on an anonymous temporary file (no path).
+    """
+    dtype = np.dtype(dtype)
+    if path is None:
+        return np.memmap(tempfile.TemporaryFile(), dtype=dtype, mode='w+', shape=tuple(shape))
+    if path.endswith('.h5'):
+        h5f = h5py.File(path, 'w')
+        return h5f.create_dataset('score', shape=tuple(shape), dtype=dtype, chunks=(1, 1) + tuple(shape[2:]))
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=tuple(shape))
+
+
+def write_slab(out, index, probs):
+    """Store probabilities (C, n, Y, Z) in `out[:, index]`, quantised to 0..255 if `out` is uint8."""
+    probs = probs.cpu().numpy()
+    if out.dtype == np.uint8:
+        probs = np.rint(probs * 255)
+    out[:, index] = probs.astype(out.dtype)
+
+
+def windows_per_batch(model, window_shape, memory_budget):
+    """
+    Number of windows stacked per forward so that the activations fit in `memory_budget` MB.
+
+    The activation memory of one (C, X, Y, Z) window is bounded by the sum of the outputs of every
+    leaf module, measured once per (model, window shape) with forward hooks on a zero window.
+    """
+    key = (id(model), tuple(window_shape))
+    if key not in _WINDOW_BYTES:
+        device = next(model.parameters()).device
+        total = [0]
+
+        def count(module, inputs, output):
+            for out in (output if isinstance(output, (tuple, list)) else (output, )):
+                if torch.is_tensor(out):
+                    total[0] += out.numel() * out.element_size()
+
+        leaves = [m for m in model.modules() if not list(m.children())]
+        handles = [m.register_forward_hook(count) for m in leaves]
+        try:
+            with torch.no_grad():
+                model(torch.zeros((1, ) + tuple(window_shape), device=device))
+        finally:
+            for handle in handles:
+                handle.remove()
+        _WINDOW_BYTES[key] = max(1, total[0])
+    return max(1, int(memory_budget * 2**20 // _WINDOW_BYTES[key]))
+
+
+class SlidingWindowPredictor(object):
+    """
+    Sliding-window prediction of a (C, X, Y, Z) volume with any 3D segmentation network.
+
+    Args:
+        model: Network; returns logits of shape (K, classes, X, Y, Z) or a tuple holding them.
+        patch_size (tuple): Window shape.
+        strides (tuple, optional): Window strides per axis (`stride_grid`); otherwise `step_size` is used.
+        step_size (float): Stride as a fraction of the patch (`step_size_grid`, nnU-Net).
+        gaussian (bool): Weight the windows with `gaussian_importance_map` instead of uniformly.
+        mirror_axes (tuple): Spatial axes (0, 1, 2) whose flips are averaged as test-time augmentation.
+        batch_flips (bool): Stack all flips of the windows into one forward instead of one forward per flip.
+        mixed_precision (bool): Run the network under autocast (float16 on CUDA, bfloat16 on CPU).
+        batch_size (int): Windows stacked per forward.
+        memory_budget (float, optional): Derive the batch size from this activation budget in MB instead (the
+            budget covers the stacked flips).
+        nonlin: Maps the logits to the blended probabilities (default: softmax over the classes).
+        output_index (int): Element of a tuple output holding the logits (1 for the DyCON backbones).
+        pad_mode (str), pad_kwargs (dict): `np.pad` mode and arguments used when the volume is smaller than a window.
+        accumulate_device: Device of the blended map (default: the model's device).
+        background (tuple, optional): Probabilities of the voxels that no evaluated window covers, per class
+            (default: the first class for several classes, 0 for a single foreground channel).
+
+    After every call (or stream) `stats` holds the number of windows of the grid, evaluated and skipped.
+    """
+    def __init__(self, model, patch_size, strides=None, step_size=0.5, gaussian=False, mirror_axes=(), batch_flips=True,
+                 mixed_precision=False, batch_size=1, memory_budget=None, nonlin=None, output_index=0, pad_mode='constant',
+                 pad_kwargs=None, accumulate_device=None, background=None):
+        self.model = model
+        self.patch_size = tuple(int(p) for p in patch_size)
+        self.strides = tuple(strides) if strides is not None else None
+        self.step_size = step_size
+        self.gaussian = gaussian
+        self.mirror_axes = tuple(mirror_axes)
+        self.batch_flips = batch_flips
+        self.mixed_precision = mixed_precision
+        self.batch_size = batch_size
+        self.memory_budget = memory_budget
+        self.nonlin = nonlin if nonlin is not None else (lambda logits: F.softmax(logits, dim=1))
+        self.output_index = output_index
+        self.pad_mode = pad_mode
+        self.pad_kwargs = pad_kwargs or {}
+        self.accumulate_device = accumulate_device
+        self.background = background
+        self.stats = {}
+
+    @property
+    def device(self):
+        return next(self.model.parameters()).device
+
+    @property
+    def flips(self):
+        """Tensor dims flipped for every mirror combination, the identity first."""
+        return [tuple(a + 2 for a in axes) for r in range(len(self.mirror_axes) + 1)
+                for axes in itertools.combinations(self.mirror_axes, r)]
+
+    def grid(self, shape):
+        if self.strides is not None:
+            return stride_grid(shape, self.patch_size, self.strides)
+        return step_size_grid(shape, self.patch_size, self.step_size)
+
+    def autocast(self):
+        return autocast(self.device) if self.mixed_precision else contextlib.nullcontext()
+
+    def logits(self, x):
+        output = self.model(x)
+        return output if torch.is_tensor(output) else output[self.output_index]
+
+    def predict_windows(self, x):
+        """
+        Probabilities (float32) of a batch of windows (K, C, X, Y, Z), averaged over the mirror flips.
+
+        With `batch_flips` the F flips of the K windows go through the network as one batch of F * K
+        windows; the predictions are flipped back on the device and summed in the same order as with one
+        forward per flip, so both only differ by the rounding of the convolutions for another batch size.
+        """
+        flips = self.flips
+        with torch.no_grad(), self.autocast():
+            if self.batch_flips and len(flips) > 1:
+                stacked = torch.cat([torch.flip(x, dims) if dims else x for dims in flips])
+                preds = self.nonlin(self.logits(stacked)).float().split(x.shape[0])
+            else:
+                preds = (self.nonlin(self.logits(torch.flip(x, dims) if dims else x)).float() for dims in flips)
+            result = None
+            for dims, pred in zip(flips, preds):
+                pred = torch.flip(pred, dims) if dims else pred
+                result = pred if result is None else result + pred
+        return result / len(flips) if len(flips) > 1 else result
+
+    def __call__(self, image, roi=None):
+        """
+        Args:
+            image: Array of shape (C, X, Y, Z).
+            roi: Boolean array of shape (X, Y, Z); only the windows intersecting it are evaluated (at least one).
+
+        Returns:
+            Tensor: Blended probabilities of shape (classes, X, Y, Z) on the accumulation device.
+        """
+        device = self.device
+        padded, slicer = pad_to_patch(np.asarray(image), self.patch_size, self.pad_mode, **self.pad_kwargs)
+        volume = torch.from_numpy(np.ascontiguousarray(padded, dtype=np.float32)).to(device)
+        shape = tuple(volume.shape[1:])
+        grid = self.grid(shape)
+        origins = list(itertools.product(*grid))
+        num_windows = len(origins)
+        if roi is not None:
+            roi, _ = pad_to_patch(np.asarray(roi)[None], self.patch_size)
+            keep = windows_in_roi(roi[0], origins, self.patch_size)
+            keep[np.argmax(keep)] = True  # at least one window, for the classes of the output
+            origins = [origin for origin, k in zip(origins, keep) if k]
+        self.stats = {'windows': num_windows, 'evaluated': len(origins), 'skipped': num_windows - len(origins)}
+        batch_size = self.windows_per_batch(volume.shape[0])
+        weights = gaussian_importance_map(self.patch_size, device) if self.gaussian else None
+        accumulate_device = self.accumulate_device or device
+
+        scores = None
+        for start in range(0, len(origins), batch_size):
+            windows = [(slice(None), ) + tuple(slice(o, o + p) for o, p in zip(origin, self.patch_size))
+                       for origin in origins[start:start + batch_size]]
+            pred = self.predict_windows(torch.stack([volume[window] for window in windows]))
+            if weights is not None:
+                pred = pred * weights
+            pred = pred.to(accumulate_device)
+            if scores is None:
+                scores = torch.zeros((pred.shape[1], ) + shape, dtype=torch.float32, device=accumulate_device)
+            for window, window_pred in zip(windows, pred):
+                scores[window] += window_pred
+        if len(origins) == num_windows:
+            scores = scores / normalisation_map(shape, self.patch_size, grid, accumulate_device, self.gaussian)
+        else:
+            coverage = coverage_map(shape, self.patch_size, origins, accumulate_device, self.gaussian)
+            scores = self.normalise(scores, coverage)
+        return scores[(slice(None), ) + slicer]
+
+    def stream(self, image, roi=None):
+        """
+        Predict a volume slab by slab along its first spatial axis.
+
+        The windows are evaluated row by row (one row per start along x). Once the windows of a row
+        start at x0, no later window covers the voxels before x0, so those are normalised and yielded,
+        and only the `patch_size[0]` voxels of the current row (plus the row's weights) stay in
+        memory. Only the x range of a row is read from `image`, which can be a `np.memmap` or an
+        HDF5 dataset. The output equals `__call__` for volumes at least as large as a window
+        (smaller ones are predicted in one go).
+
+        Args:
+            image: Array-like of shape (C, X, Y, Z).
+            roi: Boolean array of shape (X, Y, Z), as in `__call__`.
+
+        Yields:
+            (slice, Tensor): The x range and the blended probabilities (classes, n, Y, Z) of a finished slab.
+        """
+        shape = tuple(image.shape[1:])
+        if any(s < p for s, p in zip(shape, self.patch_size)):
+            yield slice(0, shape[0]), self(np.asarray(image), roi=roi)
+            return
+        device = self.device
+        accumulate_device = self.accumulate_device or device
+        origins = list(itertools.product(*self.grid(shape)))
+        num_windows = len(origins)
+        if roi is not None:
+            keep = windows_in_roi(roi, origins, self.patch_size)
+            keep[np.argmax(keep)] = True  # at least one window, for the classes of the output
+            origins = [origin for origin, k in zip(origins, keep) if k]
+        self.stats = {'windows': num_windows, 'evaluated': len(origins), 'skipped': num_windows - len(origins)}
+        batch_size = self.windows_per_batch(image.shape[0])
+        weights = gaussian_importance_map(self.patch_size, device) if self.gaussian else None
+        patch_x = self.patch_size[0]
+
+        start, scores, coverage = 0, None, None    # the buffers hold x in [start, start + len)
+        for x0, row in itertools.groupby(origins, key=lambda origin: origin[0]):
+            row = list(row)
+            if scores is not None:
+                # finished: [start, x0), partly beyond the buffer if the rows in between were skipped
+                done = min(x0, start + scores.shape[1]) - start
+                yield slice(start, start + done), self.normalise(scores[:, :done], coverage[:done])
+                scores, coverage, start = scores[:, done:], coverage[done:], start + done
+                for lo in range(start, x0, patch_x):
+                    hi = min(x0, lo + patch_x)
+                    yield slice(lo, hi), self.background_slab(scores.shape[0], (hi - lo, ) + shape[1:], accumulate_device)
+            slab = torch.from_numpy(np.ascontiguousarray(image[:, x0:x0 + patch_x], dtype=np.float32)).to(device)
+            for first in range(0, len(row), batch_size):
+                windows = [(slice(None), slice(None)) + tuple(slice(o, o + p) for o, p in zip(origin[1:], self.patch_size[1:]))
+                           for origin in row[first:first + batch_size]]
+                pred = self.predict_windows(torch.stack([slab[window] for window in windows]))
+                if weights is not None:
+                    pred = pred * weights
+                pred = pred.to(accumulate_device)
+                if scores is None:
+                    # the rows before the first evaluated one were skipped: [0, x0) is background
+                    for lo in range(0, x0, patch_x):
+                        hi = min(x0, lo + patch_x)
+                        yield slice(lo, hi), self.background_slab(pred.shape[1], (hi - lo, ) + shape[1:], accumulate_device)
+                if scores is None or scores.shape[1] == 0:
+                    start = x0
+                    scores = torch.zeros((pred.shape[1], patch_x) + shape[1:], dtype=torch.float32, device=accumulate_device)
+                    coverage = torch.zeros((patch_x, ) + shape[1:], dtype=torch.float32, device=accumulate_device)
+                elif scores.shape[1] < x0 + patch_x - start:
+                    grow = x0 + patch_x - start - scores.shape[1]
+                    scores = torch.cat([scores, scores.new_zeros((scores.shape[0], grow) + shape[1:])], dim=1)
+                    coverage = torch.cat([coverage, coverage.new_zeros((grow, ) + shape[1:])])
+                offset = x0 - start
+                for window, window_pred in zip(windows, pred):
+                    region = (slice(offset, offset + patch_x), ) + window[2:]
+                    scores[(slice(None), ) + region] += window_pred
+                    coverage[region] += weights if weights is not None else 1.
+        yield slice(start, start + scores.shape[1]), self.normalise(scores, coverage)
+        for lo in range(start + scores.shape[1], shape[0], patch_x):
+            hi = min(shape[0], lo + patch_x)
+            yield slice(lo, hi), self.background_slab(scores.shape[0], (hi - lo, ) + shape[1:], accumulate_device)
+
+    def windows_per_batch(self, channels):
+        """Windows per forward: `batch_size`, or as many as fit in `memory_budget` with their flips."""
+        if self.memory_budget is None:
+            return self.batch_size
+        batch_size = windows_per_batch(self.model, (channels, ) + self.patch_size, self.memory_budget)
+        return max(1, batch_size // len(self.flips)) if self.batch_flips else batch_size
+
+    def background_probabilities(self, channels, device):
+        background = self.background
+        if background is None:
+            background = [float(c == 0 and channels > 1) for c in range(channels)]
+        return torch.tensor(background, dtype=torch.float32, device=device).view(-1, 1, 1, 1)
+
+    def background_slab(self, channels, shape, device):
+        return self.background_probabilities(channels, device).expand((channels, ) + tuple(shape)).clone()
+
+    def normalise(self, scores, coverage):
+        """Divide the accumulated scores by the window weights; the voxels no window covers are background."""
+        background = self.background_probabilities(scores.shape[0], scores.device)
+        return torch.where(coverage > 0, scores / coverage.masked_fill(coverage == 0, 1), background)
@@ -0,0 +1,185 @@
+"""
+Host-device synchronisation audit of the training step.
+
+`SyncAudit` wraps the tensor operations that make the host wait for the device (reading a value
+with `.item()`/`bool()`/`float()`, copies to the host, and the data-dependent shapes of `nonzero`,
+boolean-mask indexing, `masked_select`, `unique`, ...) and records every call with the location in
+our code that triggered it, per training step. On CUDA, `torch.cuda.set_sync_debug_mode('warn')`
+additionally reports the synchronisations made inside other operators.
+
+Usage:
+    audit = SyncAudit(include_cpu=device.type == 'cpu')
+    audit.start()
+    for step in ...:
+        audit.mark_step(step)
+        ...
+    audit.stop()
+    logging.info(audit.report())
+"""
+import os
+import sys
+import warnings
+import threading
+from collections import OrderedDict
+
+import torch
+
+_TORCH_DIR = os.path.dirname(torch.__file__)
+_THIS_FILE = os.path.abspath(__file__)
+
+
+def _is_bool_index(index):
+    if isinstance(index, tuple):
+        return any(_is_bool_index(i) for i in index)
+    return torch.is_tensor(index) and index.dtype == torch.bool
+
+
+def _to_host(args, kwargs):
+    # Only a copy off an accelerator: `.to(device)` of a CPU tensor is a no-op in a CPU run
+    # (explicit `.cpu()` calls are still recorded with `include_cpu`)
+    targets = [a for a in list(args[1:]) + [kwargs.get('device')] if isinstance(a, (str, torch.device))]
+    return args[0].device.type != 'cpu' and any(torch.device(a).type == 'cpu' for a in targets)
+
+
+class SyncAudit(object):
+    """
+    Count and locate host-device synchronisations per step.
+
+    Args:
+        include_cpu (bool): Also record the operations on CPU tensors. They do not synchronise
+            anything, but they show where the step would synchronise on an accelerator, so a CPU run
+            can be audited.
+        root (str, optional): Locations are reported relative to this directory (default: cwd).
+    """
+    # (owner, attribute, kind, predicate on the call arguments)
+    _PATCHES = [
+        (torch.Tensor, 'item', 'item', None),
+        (torch.Tensor, 'tolist', 'tolist', None),
+        (torch.Tensor, '__bool__', 'bool', None),
+        (torch.Tensor, '__int__', 'int', None),
+        (torch.Tensor, '__float__', 'float', None),
+        (torch.Tensor, '__index__', 'index', None),
+        (torch.Tensor, '__array__', 'numpy', None),
+        (torch.Tensor, 'numpy', 'numpy', None),
+        (torch.Tensor, 'cpu', 'to host', None),
+        (torch.Tensor, 'to', 'to host', lambda args, kwargs: _to_host(args, kwargs)),
+        (torch.Tensor, 'nonzero', 'nonzero', None),
+        (torch, 'nonzero', 'nonzero', None),
+        (torch, 'masked_select', 'masked_select', None),
+        (torch.Tensor, 'masked_select', 'masked_select', None),
+        (torch, 'unique', 'unique', None),
+        (torch.Tensor, 'unique', 'unique', None),
+        (torch, 'bincount', 'bincount', None),
+        (torch, 'repeat_interleave', 'repeat_interleave', lambda args, kwargs: 'output_size' not in kwargs),
+        (torch, 'where', 'nonzero', lambda args, kwargs: len(args) + len(kwargs) == 1),
+        (torch.Tensor, '__getitem__', 'bool-mask index', lambda args, kwargs: _is_bool_index(args[1])),
+        (torch.Tensor, '__setitem__', 'bool-mask assign', lambda args, kwargs: _is_bool_index(args[1])),
+    ]
+
+    def __init__(self, include_cpu=False, root=None):
+        self.include_cpu = include_cpu
+        self.root = os.path.abspath(root or os.getcwd())
+        self.step = None
+        self.counts = OrderedDict()          # (kind, location) -> number of calls
+        self.per_step = OrderedDict()        # step -> number of calls
+        self._originals = []
+        self._local = threading.local()
+        self._warnings = None
+        self._debug_mode = None
+
+    def start(self):
+        """Install the hooks."""
+        if self._originals:
+            return
+        for owner, name, kind, predicate in self._PATCHES:
+            original = getattr(owner, name)
+            self._originals.append((owner, name, original))
+            setattr(owner, name, self._wrap(original, kind, predicate))
+        if torch.cuda.is_available():
+            self._debug_mode = torch.cuda.get_sync_debug_mode()
+            torch.cuda.set_sync_debug_mode('warn')
+            self._warnings = warnings.catch_warnings(record=True)
+            self._caught = self._warnings.__enter__()
+            warnings.simplefilter('always')
+
+    def stop(self):
+        """Remove the hooks (and collect the CUDA sync warnings)."""
+        for owner, name, original in reversed(self._originals):
+            setattr(owner, name, original)
+        self._originals = []
+        if self._warnings is not None:
+            self.collect_warnings()
+            self._warnings.__exit__(None, None, None)
+            self._warnings = None
+            torch.cuda.set_sync_debug_mode(self._debug_mode)
+
+    def mark_step(self, step):
+        """Attribute the following synchronisations to `step`."""
+        if self._warnings is not None:
+            self.collect_warnings()
+        self.step = step
+        self.per_step.setdefault(step, 0)
+
+    def collect_warnings(self):
+        """Record the CUDA sync warnings caught since the last call (outside the hooked operations)."""
+        caught, self._caught[:] = list(self._caught), []
+        for w in caught:
+            if 'synchroniz' in str(w.message):
+                self._record('cuda sync', self._relative(w.filename, w.lineno, '?'))
+            else:
+                warnings.showwarning(w.message, w.category, w.filename, w.lineno)
+
+    def report(self, top=None):
+        """A table of every synchronisation point: kind, location, calls and calls per step."""
+        steps = max(1, len(self.per_step))
+        rows = sorted(self.counts.items(), key=lambda kv: -kv[1])[:top]
+        lines = ['Host-device syncs over {} step(s): {} in total, {:.1f} per step'.format(
+            len(self.per_step), sum(self.counts.values()), sum(self.counts.values()) / steps)]
+        lines.append('{:<18} {:>7} {:>9}  {}'.format('kind', 'calls', 'per step', 'location'))
+        for (kind, location), count in rows:
+            lines.append('{:<18} {:>7d} {:>9.2f}  {}'.format(kind, count, count / steps, location))
+        return '\n'.join(lines)
+
+    def _wrap(self, original, kind, predicate):
+        audit = self
+
+        def hooked(*args, **kwargs):
+            if getattr(audit._local, 'active', False):
+                return original(*args, **kwargs)
+            audit._local.active = True
+            try:
+                if audit._syncs(args, kwargs) and (predicate is None or predicate(args, kwargs)):
+                    audit._record(kind, audit._location())
+                return original(*args, **kwargs)
+            finally:
+                audit._local.active = False
+        hooked.__wrapped__ = original
+        return hooked
+
+    def _syncs(self, args, kwargs):
+        tensors = [a for a in list(args) + list(kwargs.values()) if torch.is_tensor(a)]
+        if not tensors:
+            return False
+        return self.include_cpu or any(t.device.type != 'cpu' for t in tensors)
+
+    def _record(self, kind, location):
+        key = (kind, location)
+        self.counts[key] = self.counts.get(key, 0) + 1
+        if self.step is not None:
+            self.per_step[self.step] = self.per_step.get(self.step, 0) + 1
+
+    def _location(self):
+        # Innermost frame outside torch and this module
+        frame = sys._getframe(1)
+        while frame is not None:
+            filename = os.path.abspath(frame.f_code.co_filename)
+            if not (filename.startswith(_TORCH_DIR) or filename == _THIS_FILE):
+                return self._relative(filename, frame.f_lineno, frame.f_code.co_name)
+            frame = frame.f_back
+        return '?'
+
+    def _relative(self, filename, lineno, name):
+        filename = os.path.abspath(filename)
+        if filename.startswith(self.root + os.sep):
+            filename = os.path.relpath(filename, self.root)
+        return '{}:{} ({})'.format(filename, lineno, name)
@@ -2,6 +2,10 @@ import cv2
 import h5py
 import os
 import math
+import itertools
+import collections
+import multiprocessing
+import concurrent.futures
 from natsort import natsorted
 import nibabel as nib
 import numpy as np
@@ -11,6 +15,11 @@ import torch.nn.functional as F
 from tqdm import tqdm
 from skimage.measure import label
 
+from utils.eval_cache import EvaluationCache, state_digest, config_digest, code_digest
+from utils import metrics as metric_engine, sliding_window
+from utils.metrics import surface_metrics
+from utils.sliding_window import SlidingWindowPredictor, intensity_roi, coarse_roi, open_score_map, write_slab
+
 def normalize_image(data: np.ndarray):
         data_min = np.min(data)
         # normalization = (each element - min element) / (max - min)
@@ -25,321 +34,292 @@ def getLargestCC(segmentation):
         largestCC = segmentation
     return largestCC
 
-def var_all_case_LA(model, root_dir, num_classes, patch_size=(112, 112, 80), stride_xy=18, stride_z=4):
-    with open(os.path.join(root_dir, 'test.list'), 'r') as f:
-        image_list = f.readlines()
-
-    image_list = [root_dir + "/LA_data/" + item.replace('\n', '') + "/mri_norm2.h5" for item in image_list]
-    
-    loader = tqdm(image_list)
-    total_dice = 0.0
-    for image_path in loader:
-        h5f = h5py.File(image_path, 'r')
-        image = h5f['image'][:] # (175, 132, 88)
-        label = h5f['label'][:] # (175, 132, 88)
-
-        prediction, score_map = test_single_case(model, image, stride_xy, stride_z, patch_size, num_classes=num_classes)
-        if np.sum(prediction)==0:
-            dice = 0
-        else:
-            dice = metric.binary.dc(prediction, label)
-        total_dice += dice
-    avg_dice = total_dice / len(image_list)
-    print('average metric is {}'.format(avg_dice))
-    return avg_dice
-
-
-def var_all_case_BraTS19(model, root_path, num_classes, patch_size=(96, 96, 64), stride_xy=16, stride_z=4):
-    image_list = []
-    with open(os.path.join(root_path, "val.txt"), 'r') as f:
-        case_ids = [line.strip() for line in f if line.strip()]
-        image_list = [os.path.join(root_path, "data", f"{case_id}.h5") for case_id in case_ids]    
-    loader = tqdm(image_list)
-    total_dice = 0.0
-    for image_path in loader:
-        h5f = h5py.File(image_path, 'r')
-        image1 = h5f['image'][:] # (192, 192, 64), dtype: float64
-        label1 = h5f['label'][:] # (192, 192, 64), dtype: uint8
-        image = np.transpose(image1, (2, 1, 0))
-        label = np.transpose(label1, (2, 1, 0))
-        
-        prediction, score_map = test_single_case(model, image, stride_xy, stride_z, patch_size, num_classes=num_classes)
-        if np.sum(prediction)==0:
-            dice = 0
-        else:
-            dice = metric.binary.dc(prediction, label)
-        total_dice += dice
-    avg_dice = total_dice / len(image_list)
-    print('average metric is {}'.format(avg_dice))
-    return avg_dice
-
-def test_all_case_BraTS19(model, image_list, num_classes, patch_size=(96, 96, 64), stride_xy=16, stride_z=4, save_result=True, 
-                  test_save_path=None, preproc_fn=None, metric_detail=0, nms=0):
-
-    loader = tqdm(image_list) if not metric_detail else image_list
-    total_metric = 0.0
-    ith = 0
-    for image_path in loader:
-        h5f = h5py.File(image_path, 'r')
+def read_case(image_path, label_key='label', transpose=None):
+    """Image and label of an h5 case, optionally transposed (the BraTS19 h5 files are stored (z, y, x))."""
+    with h5py.File(image_path, 'r') as h5f:
         image = h5f['image'][:]
-        label = h5f['label'][:]
-        if preproc_fn is not None:
-            image = preproc_fn(image)
-        prediction, score_map = test_single_case(model, image, stride_xy, stride_z, patch_size, num_classes=num_classes)
-        if nms:
-            prediction = getLargestCC(prediction)
-            
-        if np.sum(prediction)==0:
-            single_metric = (0,0,0,0)
-        else:
-            single_metric = calculate_metric_percase(prediction, label[:])
-            
-        if metric_detail:
+        label = h5f[label_key][:]
+    if transpose is not None:
+        image, label = np.transpose(image, transpose), np.transpose(label, transpose)
+    return image, label
+
+
+def evaluate_case(prediction, label, metrics='all', nms=0, save_prefix=None, image=None):
+    """
+    Metrics of one case: the Dice, or (Dice, Jaccard, HD95, ASD) with `metrics='all'`.
+
+    An empty prediction scores 0. With `nms` only the largest connected component is kept, and with
+    `save_prefix` the prediction, the image and the label are saved as `<prefix>_pred/img/gt.nii.gz`.
+    Runs in the metric worker processes of `evaluate_all_cases`.
+    """
+    if nms:
+        prediction = getLargestCC(prediction)
+    if metrics == 'dice':
+        result = metric.binary.dc(prediction, label) if np.sum(prediction) else 0
+    elif np.sum(prediction) == 0:
+        result = (0, 0, 0, 0)
+    else:
+        result = calculate_metric_percase(prediction, label)
+    if save_prefix is not None:
+        nib.save(nib.Nifti1Image(prediction.astype(np.float32), np.eye(4)), save_prefix + "_pred.nii.gz")
+        nib.save(nib.Nifti1Image(image[:].astype(np.float32), np.eye(4)), save_prefix + "_img.nii.gz")
+        nib.save(nib.Nifti1Image(label[:].astype(np.float32), np.eye(4)), save_prefix + "_gt.nii.gz")
+    return result
+
+
+def evaluate_all_cases(model, image_list, num_classes, patch_size, stride_xy, stride_z, label_key='label', transpose=None,
+                       preproc_fn=None, metrics='all', nms=0, metric_detail=0, save_path=None, batch_size=1, gaussian=False,
+                       mirror_axes=(), roi=None, stream=None, readers=2, workers=0, cache=None):
+    """
+    Evaluate a model on a list of h5 cases, the single driver behind every `var_all_case_*`/`test_all_case*`.
+
+    Three stages overlap: a pool of `readers` threads reads (and prefetches) the next cases while the
+    main thread runs the sliding-window inference of the current one (`test_single_case`, with
+    `batch_size` windows per forward), and a pool of `workers` processes computes the metrics of the
+    previous ones (`evaluate_case`). The pool is opt-in: every spawned worker imports torch and the
+    metric modules again, which outweighs the overlap unless the metrics dominate, so `workers=0`
+    (the default) computes them inline, and `None` uses one process per core. The Dice alone
+    (`metrics='dice'`) is always computed inline.
+    The metrics are collected and averaged in the order of `image_list`, so the result does not depend
+    on the number of readers or workers.
+
+    With `cache` (an `EvaluationCache` or the path of its database), the predictions and metrics are
+    looked up by the digests of the model weights, the case file and the settings they depend on:
+    cases with cached metrics are not read at all, and cases with a cached prediction skip the
+    inference. The keys include the source code of the inference (`test_single_case`,
+    `utils.sliding_window`, `preproc_fn`) and of the metrics (`evaluate_case`, `calculate_metric_percase`,
+    `utils.metrics`).
+
+    Returns:
+        ndarray: Metrics per case, of shape (cases, ) for the Dice or (cases, 4).
+    """
+    if workers is None:
+        workers = min(len(image_list), os.cpu_count() or 1)
+    if metrics == 'dice':
+        workers = 0
+    own_cache = isinstance(cache, str)
+    if own_cache:
+        cache = EvaluationCache(cache)
+    cached, keys = [None] * len(image_list), [None] * len(image_list)
+    if cache is not None:
+        model_key = state_digest(model)
+        inference_key = config_digest({'num_classes': num_classes, 'patch_size': patch_size, 'stride_xy': stride_xy,
+                                       'stride_z': stride_z, 'transpose': transpose, 'batch_size': batch_size,
+                                       'gaussian': gaussian, 'mirror_axes': mirror_axes, 'roi': roi, 'stream': stream,
+                                       'code': code_digest(test_single_case, foreground_probability, sliding_window, preproc_fn)})
+        metric_key = config_digest({'inference': inference_key, 'label_key': label_key, 'metrics': metrics, 'nms': nms,
+                                    'code': code_digest(evaluate_case, getLargestCC, calculate_metric_percase, metric_engine)})
+        for ith, image_path in enumerate(image_list):
+            keys[ith] = cache.case_digest(image_path)
+            if save_path is None:
+                cached[ith] = cache.metrics(model_key, keys[ith], metric_key)
+    to_read = [image_path for image_path, result in zip(image_list, cached) if result is None]
+    cache_hits = collections.Counter(metrics=len(image_list) - len(to_read))
+
+    metric_pool = concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) if workers else None
+    read_pool = concurrent.futures.ThreadPoolExecutor(readers) if readers else None
+    total_windows = collections.Counter()
+    results, pending = [], collections.deque()
+    try:
+        upcoming = iter(to_read)
+        for image_path in itertools.islice(upcoming, max(1, 2 * readers)):
+            pending.append(read_pool.submit(read_case, image_path, label_key, transpose) if read_pool else image_path)
+        for ith in (tqdm(range(len(image_list))) if not metric_detail else range(len(image_list))):
+            if cached[ith] is not None:
+                results.append(cached[ith])
+                continue
+            case = pending.popleft()
+            image, label = case.result() if read_pool else read_case(case, label_key, transpose)
+            for image_path in itertools.islice(upcoming, 1):
+                pending.append(read_pool.submit(read_case, image_path, label_key, transpose) if read_pool else image_path)
+            if preproc_fn is not None:
+                image = preproc_fn(image)
+            prediction = cache.prediction(model_key, keys[ith], inference_key) if cache is not None else None
+            if prediction is None:
+                prediction, _ = test_single_case(model, image, stride_xy, stride_z, patch_size, num_classes=num_classes,
+                                                 batch_size=batch_size, gaussian=gaussian, mirror_axes=mirror_axes, roi=roi,
+                                                 score_out=stream, stats=total_windows)
+                if cache is not None:
+                    cache.put_prediction(model_key, keys[ith], inference_key, prediction)
+            else:
+                cache_hits['predictions'] += 1
+            save_prefix = None if save_path is None else save_path + "%02d" % ith
+            args = (prediction, label, metrics, nms, save_prefix, image if save_prefix is not None else None)
+            results.append(metric_pool.submit(evaluate_case, *args) if metric_pool else evaluate_case(*args))
+        for ith, r in enumerate(results):
+            if isinstance(r, concurrent.futures.Future):
+                results[ith] = r = r.result()
+            if cache is not None and cached[ith] is None:
+                cache.put_metrics(model_key, keys[ith], metric_key, r)
+    finally:
+        # cancel what has not started yet (`shutdown(cancel_futures=True)` needs Python 3.9)
+        for future in itertools.chain(pending, results):
+            if isinstance(future, concurrent.futures.Future):
+                future.cancel()
+        if metric_pool is not None:
+            metric_pool.shutdown(wait=True)
+        if read_pool is not None:
+            read_pool.shutdown(wait=True)
+        if own_cache:
+            cache.close()
+
+    if metric_detail and metrics != 'dice':
+        for ith, single_metric in enumerate(results):
             print('%02d,\t%.5f, %.5f, %.5f, %.5f' % (ith, single_metric[0], single_metric[1], single_metric[2], single_metric[3]))
-
-        total_metric += np.asarray(single_metric)
-        
-        # if save_result:
-        #     nib.save(nib.Nifti1Image(prediction.astype(np.float32), np.eye(4)), test_save_path +  "%02d_pred.nii.gz" % ith)
-        #     #nib.save(nib.Nifti1Image(score_map[0].astype(np.float32), np.eye(4)), test_save_path +  "%02d_scores.nii.gz" % ith)
-        #     nib.save(nib.Nifti1Image(image[:].astype(np.float32), np.eye(4)), test_save_path + "%02d_img.nii.gz" % ith)
-        #     nib.save(nib.Nifti1Image(label[:].astype(np.float32), np.eye(4)), test_save_path + "%02d_gt.nii.gz" % ith)
-        ith += 1
-
-    avg_metric = total_metric / len(image_list)
+    if cache is not None:
+        print('cache: metrics of {} and predictions of {} of {} cases reused'.format(
+            cache_hits['metrics'], cache_hits['predictions'], len(image_list)))
+    if roi is not None and total_windows['windows']:
+        print('windows skipped: {} of {} ({:.1%}), coarse pass windows: {}'.format(
+            total_windows['skipped'], total_windows['windows'], total_windows['skipped'] / total_windows['windows'],
+            total_windows['coarse_windows']))
+    return np.asarray(results, dtype=np.float64)
+
+
+def average_metric(results, performance_path=None):
+    """Average the per-case metrics in case order, print it and optionally write it to `performance_path`."""
+    total_metric = 0.0
+    for single_metric in results:
+        total_metric += single_metric
+    avg_metric = total_metric / len(results)
     print('average metric is {}'.format(avg_metric))
-    
-    with open(test_save_path+'../performance.txt', 'w') as f:
-        f.writelines('average metric is {} \n'.format(avg_metric))
+    if performance_path is not None:
+        with open(performance_path, 'w') as f:
+            f.writelines('average metric is {} \n'.format(avg_metric))
     return avg_metric
 
-def var_all_case_Pancreas(model, root_path, num_classes, patch_size=(112, 112, 80), stride_xy=18, stride_z=4):
-    image_list = []
-    with open(os.path.join(root_path, "test1.list"), "r") as f:
-        case_ids = [line.strip() for line in f if line.strip()]
-        image_list = [os.path.join(root_path, f"Pancreas_data/{case_id}") for case_id in case_ids]
 
-    loader = tqdm(image_list)
-    total_dice = 0.0
-    for image_path in loader:
-        h5f = h5py.File(image_path, 'r')
-        image = h5f['image'][:]  # 
-        label = h5f['label'][:].astype(np.uint8)
+def _case_list(list_path, pattern):
+    with open(list_path, 'r') as f:
+        return [pattern.format(line.strip()) for line in f if line.strip()]
 
-        prediction, score_map = test_single_case(model, image, stride_xy, stride_z, patch_size, num_classes=num_classes)
-        if np.sum(prediction)==0:
-            dice = 0
-        else:
-            dice = metric.binary.dc(prediction, label)
-        total_dice += dice
-    avg_dice = total_dice / len(image_list)
-    print('average metric is {}'.format(avg_dice))
-    return avg_dice
 
-def test_all_case_Pancreas(model, image_list, num_classes, device, patch_size=(96, 96, 64), stride_xy=16, stride_z=4, save_result=True, 
-                  test_save_path=None, preproc_fn=None, metric_detail=0, nms=0):
-    
-    loader = tqdm(image_list) if not metric_detail else image_list
-    total_metric = 0.0
-    ith = 0
-    for image_path in loader:
-        # id = image_path.split('/')[-2]
-        h5f = h5py.File(image_path, 'r')
-        image = h5f['image'][:]
-        label = h5f['label'][:]
-        if preproc_fn is not None:
-            image = preproc_fn(image)
-        prediction, score_map = test_single_case(model, image, stride_xy, stride_z, patch_size, device, num_classes=num_classes)
-        if nms:
-            prediction = getLargestCC(prediction)
-            
-        if np.sum(prediction)==0:
-            single_metric = (0,0,0,0)
-        else:
-            single_metric = calculate_metric_percase(prediction, label[:])
-            
-        if metric_detail:
-            print('%02d,\t%.5f, %.5f, %.5f, %.5f' % (ith, single_metric[0], single_metric[1], single_metric[2], single_metric[3]))
+def var_all_case_LA(model, root_dir, num_classes, patch_size=(112, 112, 80), stride_xy=18, stride_z=4, batch_size=1, gaussian=False, mirror_axes=(), roi=None, stream=None, readers=2):
+    image_list = _case_list(os.path.join(root_dir, 'test.list'), root_dir + "/LA_data/{}/mri_norm2.h5")
+    results = evaluate_all_cases(model, image_list, num_classes, patch_size, stride_xy, stride_z, metrics='dice',
+                                 batch_size=batch_size, gaussian=gaussian, mirror_axes=mirror_axes, roi=roi, stream=stream,
+                                 readers=readers)
+    return average_metric(results)
 
-        total_metric += np.asarray(single_metric)
-        
-        # if save_result:
-        #     nib.save(nib.Nifti1Image(prediction.astype(np.float32), np.eye(4)), test_save_path +  "%02d_pred.nii.gz" % ith)
-        #     #nib.save(nib.Nifti1Image(score_map[0].astype(np.float32), np.eye(4)), test_save_path +  "%02d_scores.nii.gz" % ith)
-        #     nib.save(nib.Nifti1Image(image[:].astype(np.float32), np.eye(4)), test_save_path + "%02d_img.nii.gz" % ith)
-        #     nib.save(nib.Nifti1Image(label[:].astype(np.float32), np.eye(4)), test_save_path + "%02d_gt.nii.gz" % ith)
-        ith += 1
 
-    avg_metric = total_metric / len(image_list)
-    print('average metric is {}'.format(avg_metric))
-    
-    with open(test_save_path+'../performance.txt', 'w') as f:
-        f.writelines('average metric is {} \n'.format(avg_metric))
-    return avg_metric
+def var_all_case_BraTS19(model, root_path, num_classes, patch_size=(96, 96, 64), stride_xy=16, stride_z=4, batch_size=1, gaussian=False, mirror_axes=(), roi=None, stream=None, readers=2):
+    image_list = _case_list(os.path.join(root_path, "val.txt"), os.path.join(root_path, "data", "{}.h5"))
+    results = evaluate_all_cases(model, image_list, num_classes, patch_size, stride_xy, stride_z, transpose=(2, 1, 0),
+                                 metrics='dice', batch_size=batch_size, gaussian=gaussian, mirror_axes=mirror_axes, roi=roi,
+                                 stream=stream, readers=readers)
+    return average_metric(results)
 
-def var_all_case_ISLES22(root_path, model, num_classes, device, patch_size=(96, 96, 64), stride_xy=16, stride_z=4):
-    image_list = []
-    with open(os.path.join(root_path, "val.list"), 'r') as f:
-        case_ids = [line.strip() for line in f if line.strip()]
-        image_list = [os.path.join(root_path, f"{case_id}.h5") for case_id in case_ids]
-    
-    loader = tqdm(image_list)
-    total_dice = 0.0
-    for image_path in loader:
-        h5f = h5py.File(image_path, 'r')
-        image = h5f['image'][:] # (192, 192, 64), dtype: float64
-        label = h5f['mask'][:] # (192, 192, 64), dtype: uint8
-
-        prediction, score_map = test_single_case(model, image, stride_xy, stride_z, patch_size, device, num_classes=num_classes)
-        if np.sum(prediction)==0:
-            dice = 0
-        else:
-            dice = metric.binary.dc(prediction, label)
-        total_dice += dice
-    avg_dice = total_dice / len(image_list)
-    print('average metric is {}'.format(avg_dice))
-    return avg_dice
 
-def test_all_case_ISLES22(model, image_list, num_classes, patch_size=(96, 96, 64), stride_xy=16, stride_z=4, save_result=True, 
-                  test_save_path=None, preproc_fn=None, metric_detail=0, nms=0):
-    
-    loader = tqdm(image_list) if not metric_detail else image_list
-    total_metric = 0.0
-    ith = 0
-    for image_path in loader:
-        h5f = h5py.File(image_path, 'r')
-        image = h5f['image'][:]
-        label = h5f['mask'][:]
-        if preproc_fn is not None:
-            image = preproc_fn(image)
-        prediction, score_map = test_single_case(model, image, stride_xy, stride_z, patch_size, num_classes=num_classes)
-        if nms:
-            prediction = getLargestCC(prediction)
-            
-        if np.sum(prediction)==0:
-            single_metric = (0,0,0,0)
-        else:
-            single_metric = calculate_metric_percase(prediction, label[:])
-            
-        if metric_detail:
-            print('%02d,\t%.5f, %.5f, %.5f, %.5f' % (ith, single_metric[0], single_metric[1], single_metric[2], single_metric[3]))
+def test_all_case_BraTS19(model, image_list, num_classes, patch_size=(96, 96, 64), stride_xy=16, stride_z=4, save_result=True, 
+                  test_save_path=None, preproc_fn=None, metric_detail=0, nms=0, batch_size=1, gaussian=False, mirror_axes=(), roi=None, stream=None, readers=2, workers=0, cache=None):
+    results = evaluate_all_cases(model, image_list, num_classes, patch_size, stride_xy, stride_z, preproc_fn=preproc_fn,
+                                 nms=nms, metric_detail=metric_detail, batch_size=batch_size, gaussian=gaussian,
+                                 mirror_axes=mirror_axes, roi=roi, stream=stream, readers=readers, workers=workers, cache=cache)
+    return average_metric(results, test_save_path + '../performance.txt')
 
-        total_metric += np.asarray(single_metric)
-        
-        # if save_result:
-        #     nib.save(nib.Nifti1Image(prediction.astype(np.float32), np.eye(4)), test_save_path +  "%02d_pred.nii.gz" % ith)
-        #     #nib.save(nib.Nifti1Image(score_map[0].astype(np.float32), np.eye(4)), test_save_path +  "%02d_scores.nii.gz" % ith)
-        #     nib.save(nib.Nifti1Image(image[:].astype(np.float32), np.eye(4)), test_save_path + "%02d_img.nii.gz" % ith)
-        #     nib.save(nib.Nifti1Image(label[:].astype(np.float32), np.eye(4)), test_save_path + "%02d_gt.nii.gz" % ith)
-        ith += 1
 
-    avg_metric = total_metric / len(image_list)
-    print('average metric is {}'.format(avg_metric))
-    
-    with open(test_save_path+'../performance.txt', 'w') as f:
-        f.writelines('average metric is {} \n'.format(avg_metric))
-    return avg_metric
+def var_all_case_Pancreas(model, root_path, num_classes, patch_size=(112, 112, 80), stride_xy=18, stride_z=4, batch_size=1, gaussian=False, mirror_axes=(), roi=None, stream=None, readers=2):
+    image_list = _case_list(os.path.join(root_path, "test1.list"), os.path.join(root_path, "Pancreas_data/{}"))
+    results = evaluate_all_cases(model, image_list, num_classes, patch_size, stride_xy, stride_z, metrics='dice',
+                                 batch_size=batch_size, gaussian=gaussian, mirror_axes=mirror_axes, roi=roi, stream=stream,
+                                 readers=readers)
+    return average_metric(results)
 
-def test_all_case(model, image_list, num_classes, device, patch_size=(112, 112, 80), stride_xy=18, stride_z=4, save_result=True,
-                   test_save_path=None, preproc_fn=None, metric_detail=0, nms=0):
-    
-    loader = tqdm(image_list) if not metric_detail else image_list
-    total_metric = 0.0
-    ith = 0
-    for image_path in loader:
-        # id = image_path.split('/')[-2]
-        h5f = h5py.File(image_path, 'r')
-        image = h5f['image'][:]
-        label = h5f['label'][:]
-        if preproc_fn is not None:
-            image = preproc_fn(image)
-        prediction, score_map = test_single_case(model, image, stride_xy, stride_z, patch_size, device, num_classes=num_classes)
-        if nms:
-            prediction = getLargestCC(prediction)
-            
-        if np.sum(prediction)==0:
-            single_metric = (0,0,0,0)
-        else:
-            single_metric = calculate_metric_percase(prediction, label[:])
-            
-        if metric_detail:
-            print('%02d,\t%.5f, %.5f, %.5f, %.5f' % (ith, single_metric[0], single_metric[1], single_metric[2], single_metric[3]))
 
-        total_metric += np.asarray(single_metric)
-        
-        if save_result:
-            nib.save(nib.Nifti1Image(prediction.astype(np.float32), np.eye(4)), test_save_path +  "%02d_pred.nii.gz" % ith)
-            #nib.save(nib.Nifti1Image(score_map[0].astype(np.float32), np.eye(4)), test_save_path +  "%02d_scores.nii.gz" % ith)
-            nib.save(nib.Nifti1Image(image[:].astype(np.float32), np.eye(4)), test_save_path + "%02d_img.nii.gz" % ith)
-            nib.save(nib.Nifti1Image(label[:].astype(np.float32), np.eye(4)), test_save_path + "%02d_gt.nii.gz" % ith)
-        ith += 1
+def test_all_case_Pancreas(model, image_list, num_classes, device, patch_size=(96, 96, 64), stride_xy=16, stride_z=4, save_result=True, 
+                  test_save_path=None, preproc_fn=None, metric_detail=0, nms=0, batch_size=1, gaussian=False, mirror_axes=(), roi=None, stream=None, readers=2, workers=0, cache=None):
+    results = evaluate_all_cases(model, image_list, num_classes, patch_size, stride_xy, stride_z, preproc_fn=preproc_fn,
+                                 nms=nms, metric_detail=metric_detail, batch_size=batch_size, gaussian=gaussian,
+                                 mirror_axes=mirror_axes, roi=roi, stream=stream, readers=readers, workers=workers, cache=cache)
+    return average_metric(results, test_save_path + '../performance.txt')
 
-    avg_metric = total_metric / len(image_list)
-    print('average metric is {}'.format(avg_metric))
-    
-    with open(test_save_path+'/performance.txt', 'w') as f:
-        f.writelines('average metric is {} \n'.format(avg_metric))
-    return avg_metric
 
+def var_all_case_ISLES22(root_path, model, num_classes, device, patch_size=(96, 96, 64), stride_xy=16, stride_z=4, batch_size=1, gaussian=False, mirror_axes=(), roi=None, stream=None, readers=2):
+    image_list = _case_list(os.path.join(root_path, "val.list"), os.path.join(root_path, "{}.h5"))
+    results = evaluate_all_cases(model, image_list, num_classes, patch_size, stride_xy, stride_z, label_key='mask',
+                                 metrics='dice', batch_size=batch_size, gaussian=gaussian, mirror_axes=mirror_axes, roi=roi,
+                                 stream=stream, readers=readers)
+    return average_metric(results)
 
-def test_single_case(model, image, stride_xy, stride_z, patch_size, num_classes=1):
-    w, h, d = image.shape
-
-    # if the size of image is less than patch_size, then padding it
-    add_pad = False
-    if w < patch_size[0]:
-        w_pad = patch_size[0]-w
-        add_pad = True
-    else:
-        w_pad = 0
-    if h < patch_size[1]:
-        h_pad = patch_size[1]-h
-        add_pad = True
-    else:
-        h_pad = 0
-    if d < patch_size[2]:
-        d_pad = patch_size[2]-d
-        add_pad = True
-    else:
-        d_pad = 0
-    wl_pad, wr_pad = w_pad//2,w_pad-w_pad//2
-    hl_pad, hr_pad = h_pad//2,h_pad-h_pad//2
-    dl_pad, dr_pad = d_pad//2,d_pad-d_pad//2
-    if add_pad:
-        image = np.pad(image, [(wl_pad,wr_pad),(hl_pad,hr_pad), (dl_pad, dr_pad)], mode='constant', constant_values=0)
-    ww,hh,dd = image.shape
 
-    sx = math.ceil((ww - patch_size[0]) / stride_xy) + 1
-    sy = math.ceil((hh - patch_size[1]) / stride_xy) + 1
-    sz = math.ceil((dd - patch_size[2]) / stride_z) + 1
-    # print("{}, {}, {}".format(sx, sy, sz))
-    score_map = np.zeros((num_classes, ) + image.shape).astype(np.float32)
-    cnt = np.zeros(image.shape).astype(np.float32)
+def test_all_case_ISLES22(model, image_list, num_classes, patch_size=(96, 96, 64), stride_xy=16, stride_z=4, save_result=True, 
+                  test_save_path=None, preproc_fn=None, metric_detail=0, nms=0, batch_size=1, gaussian=False, mirror_axes=(), roi=None, stream=None, readers=2, workers=0, cache=None):
+    results = evaluate_all_cases(model, image_list, num_classes, patch_size, stride_xy, stride_z, label_key='mask',
+                                 preproc_fn=preproc_fn, nms=nms, metric_detail=metric_detail, batch_size=batch_size,
+                                 gaussian=gaussian, mirror_axes=mirror_axes, roi=roi, stream=stream, readers=readers,
+                                 workers=workers, cache=cache)
+    return average_metric(results, test_save_path + '../performance.txt')
 
-    for x in range(0, sx):
-        xs = min(stride_xy*x, ww-patch_size[0])
-        for y in range(0, sy):
-            ys = min(stride_xy * y,hh-patch_size[1])
-            for z in range(0, sz):
-                zs = min(stride_z * z, dd-patch_size[2])
-                test_patch = image[xs:xs+patch_size[0], ys:ys+patch_size[1], zs:zs+patch_size[2]]
-                test_patch = np.expand_dims(np.expand_dims(test_patch,axis=0),axis=0).astype(np.float32)
-                test_patch = torch.from_numpy(test_patch).cuda()
 
-                with torch.no_grad():
-                    _, y, _ = model(test_patch)
-                    y = F.softmax(y, dim=1)
-                y = y.cpu().data.numpy()
-                y = y[0,1,:,:,:]
-                score_map[:, xs:xs+patch_size[0], ys:ys+patch_size[1], zs:zs+patch_size[2]] \
-                  = score_map[:, xs:xs+patch_size[0], ys:ys+patch_size[1], zs:zs+patch_size[2]] + y
-                cnt[xs:xs+patch_size[0], ys:ys+patch_size[1], zs:zs+patch_size[2]] \
-                  = cnt[xs:xs+patch_size[0], ys:ys+patch_size[1], zs:zs+patch_size[2]] + 1
-    score_map = score_map/np.expand_dims(cnt,axis=0)
-    label_map = (score_map[0]>0.5).astype(int)
-    if add_pad:
-        label_map = label_map[wl_pad:wl_pad+w,hl_pad:hl_pad+h,dl_pad:dl_pad+d]
-        score_map = score_map[:,wl_pad:wl_pad+w,hl_pad:hl_pad+h,dl_pad:dl_pad+d]
+def test_all_case(model, image_list, num_classes, device, patch_size=(112, 112, 80), stride_xy=18, stride_z=4, save_result=True,
+                   test_save_path=None, preproc_fn=None, metric_detail=0, nms=0, batch_size=1, gaussian=False, mirror_axes=(), roi=None, stream=None, readers=2, workers=0, cache=None):
+    results = evaluate_all_cases(model, image_list, num_classes, patch_size, stride_xy, stride_z, preproc_fn=preproc_fn,
+                                 nms=nms, metric_detail=metric_detail, save_path=test_save_path if save_result else None,
+                                 batch_size=batch_size, gaussian=gaussian, mirror_axes=mirror_axes, roi=roi, stream=stream,
+                                 readers=readers, workers=workers, cache=cache)
+    return average_metric(results, test_save_path + '/performance.txt')
+
+
+def foreground_probability(logits):
+    """softmax(logits)[:, 1]; for two-class logits computed as the sigmoid of the logit difference."""
+    if logits.shape[1] == 2:
+        return torch.sigmoid(logits[:, 1] - logits[:, 0])
+    return F.softmax(logits, dim=1)[:, 1]
+
+
+def test_single_case(model, image, stride_xy, stride_z, patch_size, num_classes=1, batch_size=1, memory_budget=None,
+                     gaussian=False, mirror_axes=(), batch_flips=True, roi=None, roi_scale=2, roi_threshold=0.1,
+                     roi_margin=8, stats=None, score_out=None):
+    """
+    Sliding-window prediction of one volume, averaging the foreground probability of the overlapping windows.
+
+    A thin wrapper of `SlidingWindowPredictor`: `batch_size` windows are stacked into each forward
+    (or as many as fit in `memory_budget` MB), the score map is accumulated on the model's device
+    and, with `gaussian`, every window is weighted by a Gaussian importance map so that the voxels
+    near a window border (where the context is poorest) count less. `mirror_axes` (spatial axes 0, 1, 2)
+    averages the prediction over their flips as test-time augmentation, all flips of the stacked
+    windows in a single forward unless `batch_flips` is False.
+
+    With `roi`, inference runs in two stages: a region of interest is found first, from the non-zero
+    voxels ('intensity') or from the foreground (> `roi_threshold`) of a pass over the volume
+    downsampled `roi_scale` times ('coarse'), grown by `roi_margin` voxels; then only the windows
+    intersecting it are evaluated and the rest of the volume is background. `stats`, if given, is
+    updated with the number of windows, evaluated and skipped (and of the coarse pass); pass a
+    `collections.Counter` to add them up over the cases.
+
+    With `score_out` the volume is streamed: the windows run slab by slab along x, only the window
+    overlap is held in memory and the finished slabs of the foreground probability are written to
+    `score_out`, a writable (1, X, Y, Z) array such as `open_score_map` returns (float16, or uint8
+    quantised to 0..255), or a dtype name for a temporary memory map. The score map returned is then
+    `score_out` with its single channel and the label map is uint8. `image` may be a `np.memmap`.
+    """
+    predictor = SlidingWindowPredictor(model, patch_size, strides=(stride_xy, stride_xy, stride_z), gaussian=gaussian,
+                                       mirror_axes=mirror_axes, batch_flips=batch_flips, batch_size=batch_size,
+                                       memory_budget=memory_budget, output_index=1,
+                                       nonlin=lambda logits: foreground_probability(logits).unsqueeze(1))
+    roi_mask, coarse_windows = None, 0
+    if roi == 'intensity':
+        roi_mask = intensity_roi(image[None], margin=roi_margin)
+    elif roi == 'coarse':
+        roi_mask, coarse_windows = coarse_roi(predictor, image[None], roi_scale, roi_threshold, roi_margin)
+    elif roi is not None:
+        raise ValueError("roi must be None, 'intensity' or 'coarse', got {!r}".format(roi))
+    if score_out is not None:
+        if isinstance(score_out, str):
+            score_out = open_score_map((1, ) + image.shape, score_out)
+        label_map = np.zeros(image.shape, dtype=np.uint8)
+        for index, probs in predictor.stream(image[None], roi=roi_mask):
+            label_map[index] = (probs[0] > 0.5).cpu().numpy()
+            write_slab(score_out, index, probs)
+        score_map = score_out
+    else:
+        score_map = predictor(image[None], roi=roi_mask).cpu().numpy()
+        # every channel of the score map holds the foreground probability; keep one for two-class models
+        if num_classes != 2:
+            score_map = np.repeat(score_map, num_classes, axis=0)
+        label_map = (score_map[0]>0.5).astype(int)
+    if stats is not None:
+        stats.update(collections.Counter(predictor.stats, coarse_windows=coarse_windows))
     return label_map, score_map
 
 
@@ -435,7 +415,8 @@ def test_single_case_plus(model_l, model_r, image, stride_xy, stride_z, patch_si
     sy = math.ceil((hh - patch_size[1]) / stride_xy) + 1
     sz = math.ceil((dd - patch_size[2]) / stride_z) + 1
     # print("{}, {}, {}".format(sx, sy, sz))
-    score_map = np.zeros((num_classes, ) + image.shape).astype(np.float32)
+    # every channel of the score map holds the foreground probability; keep one for two-class models
+    score_map = np.zeros((1 if num_classes == 2 else num_classes, ) + image.shape).astype(np.float32)
     cnt = np.zeros(image.shape).astype(np.float32)
 
     for x in range(0, sx):
@@ -452,10 +433,9 @@ def test_single_case_plus(model_l, model_r, image, stride_xy, stride_z, patch_si
                     y1_l, _ = model_l(test_patch)
                     y1_r, _ = model_r(test_patch)
                     y1 = (y1_l + y1_r) / 2
-                    y = F.softmax(y1, dim=1)
+                    y = foreground_probability(y1)
 
-                y = y.cpu().data.numpy()
-                y = y[0,1,:,:,:]
+                y = y[0].cpu().numpy()
                 score_map[:, xs:xs+patch_size[0], ys:ys+patch_size[1], zs:zs+patch_size[2]] \
                   = score_map[:, xs:xs+patch_size[0], ys:ys+patch_size[1], zs:zs+patch_size[2]] + y
                 cnt[xs:xs+patch_size[0], ys:ys+patch_size[1], zs:zs+patch_size[2]] \
@@ -494,7 +474,7 @@ def calculate_metric_percase(pred, gt):
         hd = 0.0 # float('inf')  # or another value that indicates an undefined HD
         asd = 0.0 # float('inf')  # same here
     else:
-        hd = metric.binary.hd95(pred, gt)
-        asd = metric.binary.asd(pred, gt)
+        surface = surface_metrics(pred, gt)
+        hd, asd = surface['hd95'], surface['asd']
     
     return dice, jc, hd, asd
@@ -6,6 +6,7 @@
 #
 import os
 import pickle
+import datetime
 import numpy as np
 import re
 from scipy.ndimage import distance_transform_edt as distance
@@ -52,81 +53,6 @@ def load_model(path):
     return model
 
 
-def load_checkpoint(path, model, optimizer, from_ddp=False):
-    """loads previous checkpoint
-
-    Args:
-        path (str): path to checkpoint
-        model (model): model to restore checkpoint to
-        optimizer (optimizer): torch optimizer to load optimizer state_dict to
-        from_ddp (bool, optional): load DistributedDataParallel checkpoint to regular model. Defaults to False.
-
-    Returns:
-        model, optimizer, epoch_num, loss
-    """
-    # load checkpoint
-    checkpoint = torch.load(path)
-    # transfer state_dict from checkpoint to model
-    model.load_state_dict(checkpoint["state_dict"])
-    # transfer optimizer state_dict from checkpoint to model
-    optimizer.load_state_dict(checkpoint["optimizer_state_dict"])
-    # track loss
-    loss = checkpoint["loss"]
-    return model, optimizer, checkpoint["epoch"], loss.item()
-
-
-def restore_model(logger, snapshot_path, model_num=None):
-    """wrapper function to read log dir and load restore a previous checkpoint
-
-    Args:
-        logger (Logger): logger object (for info output to console)
-        snapshot_path (str): path to checkpoint directory
-
-    Returns:
-        model, optimizer, start_epoch, performance
-    """
-    try:
-        # check if there is previous progress to be restored:
-        logger.info(f"Snapshot path: {snapshot_path}")
-        iter_num = []
-        name = "model_iter"
-        if model_num:
-            name = model_num
-        for filename in os.listdir(snapshot_path):
-            if name in filename:
-                basename, extension = os.path.splitext(filename)
-                iter_num.append(int(basename.split("_")[2]))
-        iter_num = max(iter_num)
-        for filename in os.listdir(snapshot_path):
-            if name in filename and str(iter_num) in filename:
-                model_checkpoint = filename
-    except Exception as e:
-        logger.warning(f"Error finding previous checkpoints: {e}")
-
-    try:
-        logger.info(f"Restoring model checkpoint: {model_checkpoint}")
-        model, optimizer, start_epoch, performance = load_checkpoint(
-            snapshot_path + "/" + model_checkpoint, model, optimizer
-        )
-        logger.info(f"Models restored from iteration {iter_num}")
-        return model, optimizer, start_epoch, performance
-    except Exception as e:
-        logger.warning(f"Unable to restore model checkpoint: {e}, using new model")
-
-
-def save_checkpoint(epoch, model, optimizer, loss, path):
-    """Saves model as checkpoint"""
-    torch.save(
-        {
-            "epoch": epoch,
-            "state_dict": model.state_dict(),
-            "optimizer_state_dict": optimizer.state_dict(),
-            "loss": loss,
-        },
-        path,
-    )
-
-
 class UnifLabelSampler(Sampler):
     """Samples elements uniformely accross pseudolabels.
     Args:
@@ -237,11 +163,89 @@ def compute_sdf(img_gt, out_shape):
 
 
 # set up process group for distributed computing
-def distributed_setup(rank, world_size):
-    os.environ["MASTER_ADDR"] = "localhost"
-    os.environ["MASTER_PORT"] = "12355"
+def distributed_setup(rank=None, world_size=None, backend="gloo", master_addr=None, master_port=None, timeout_minutes=60):
+    """Initialise the default process group.
+
+    Under `torchrun` the rank, world size and rendezvous address are read from the environment
+    (RANK, WORLD_SIZE, MASTER_ADDR, MASTER_PORT); explicit arguments take precedence.
+    The gloo backend also runs on CPU-only (multi-node) machines, use nccl for GPU-only jobs.
+
+    Returns:
+        rank, world_size
+    """
+    rank = int(os.environ.get("RANK", 0)) if rank is None else rank
+    world_size = int(os.environ.get("WORLD_SIZE", 1)) if world_size is None else world_size
+    if master_addr is not None:
+        os.environ["MASTER_ADDR"] = master_addr
+    if master_port is not None:
+        os.environ["MASTER_PORT"] = str(master_port)
+    os.environ.setdefault("MASTER_ADDR", "localhost")
+    os.environ.setdefault("MASTER_PORT", "12355")
     print("setting up dist process group now")
-    dist.init_process_group("nccl", rank=rank, world_size=world_size)
+    dist.init_process_group(backend, rank=rank, world_size=world_size,
+                            timeout=datetime.timedelta(minutes=timeout_minutes))
+    return rank, world_size
+
+
+def distributed_cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def broadcast_module(module, src=0):
+    """Copy parameters and buffers of `module` from rank `src` to every rank."""
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        dist.broadcast(tensor.data, src=src)
+
+
+def average_buffers(module):
+    """Average the floating-point buffers (e.g. BatchNorm running stats) of `module` over all ranks."""
+    world_size = get_world_size()
+    for buf in module.buffers():
+        if torch.is_floating_point(buf):
+            dist.all_reduce(buf.data)
+            buf.data.div_(world_size)
+
+
+def all_gather_object(obj):
+    """Return the list of `obj` from every rank (a single-element list when not distributed)."""
+    if not is_distributed():
+        return [obj]
+    gathered = [None] * get_world_size()
+    dist.all_gather_object(gathered, obj)
+    return gathered
+
+
+@torch.no_grad()
+def masked_step(optimizer, skip):
+    """
+    `optimizer.step()` that is undone when `skip` (a 0-dim bool tensor) is True, without reading `skip` on the host.
+
+    The parameters and tensor optimizer state are copied before the step and selected back with `torch.where`;
+    state first created by the step is reset to zeros, which for SGD momentum is the same as never creating it.
+    Costs one extra copy of the parameters and of the optimizer state.
+    """
+    params = [p for group in optimizer.param_groups for p in group['params'] if p.grad is not None]
+    saved_params = [p.detach().clone() for p in params]
+    saved_state = [{k: v.clone() for k, v in optimizer.state[p].items() if torch.is_tensor(v)} for p in params]
+    optimizer.step()
+    for p, old_param, old_state in zip(params, saved_params, saved_state):
+        p.copy_(torch.where(skip, old_param, p))
+        for k, v in optimizer.state[p].items():
+            if torch.is_tensor(v):
+                v.copy_(torch.where(skip, old_state[k] if k in old_state else torch.zeros_like(v), v))
 
 
 def load_ddp_to_nddp(state_dict):